@@ -23,10 +23,14 @@ from decorator import Constructor, constructor
 
 if __debug__:
     from dprint import dprint
+    from random import getrandbits, random
     from time import time
     from decorator import attach_profiler
 
 class BloomFilter(Constructor):
+    """
+    A bloom filter that stores its bits in one python long.
+    """
     def _init_(self, m_size, k_functions, prefix, filter_):
         assert isinstance(m_size, int)
         assert 0 < m_size
@@ -35,7 +39,7 @@ class BloomFilter(Constructor):
         assert 0 < k_functions <= m_size
         assert isinstance(prefix, str)
         assert 0 <= len(prefix) < 256
-        assert isinstance(filter_, long)
+        assert self._check_filter(filter_, m_size), type(filter_)
 
         self._m_size = m_size
         self._k_functions = k_functions
@@ -82,7 +86,7 @@ class BloomFilter(Constructor):
         assert isinstance(bytes_, str)
         assert 0 < len(bytes_)
         if __debug__: dprint("constructing bloom filter based on ", len(bytes_), " bytes and k_functions ", k_functions)
-        self._init_(len(bytes_) * 8, k_functions, prefix, long(sum(ord(c) << (i*8) for i, c in enumerate(bytes_))))
+        self._init_(len(bytes_) * 8, k_functions, prefix, self._filter_from_bytes(bytes_))
 
     @constructor(int, float)
     def _init_m_f(self, m_size, f_error_rate, prefix=""):
@@ -95,7 +99,7 @@ class BloomFilter(Constructor):
         # self._n = int(m * ((log(2) ** 2) / abs(log(f))))
         # self._k = int(ceil(log(2) * (m / self._n)))
         if __debug__: dprint("constructing bloom filter based on m_size ", m_size, " bits and f_error_rate ", f_error_rate)
-        self._init_(m_size, self._get_k_functions(m_size, self._get_n_capacity(m_size, f_error_rate)), prefix, 0L)
+        self._init_(m_size, self._get_k_functions(m_size, self._get_n_capacity(m_size, f_error_rate)), prefix, self._empty_filter(m_size))
 
     @constructor(float, int)
     def _init_n_f(self, f_error_rate, n_capacity, prefix=""):
@@ -106,7 +110,26 @@ class BloomFilter(Constructor):
         m_size = abs((n_capacity * log(f_error_rate)) / (log(2) ** 2))
         m_size = int(ceil(m_size / 8.0) * 8)
         if __debug__: dprint("constructing bloom filter based on f_error_rate ", f_error_rate, " and ", n_capacity, " capacity")
-        self._init_(m_size, self._get_k_functions(m_size, n_capacity), prefix, 0L)
+        self._init_(m_size, self._get_k_functions(m_size, n_capacity), prefix, self._empty_filter(m_size))
+
+    @staticmethod
+    def _check_filter(filter_, m_size):
+        return isinstance(filter_, long)
+
+    @staticmethod
+    def _empty_filter(m_size):
+        return 0L
+
+    @staticmethod
+    def _filter_from_bytes(bytes_):
+        # the first byte contains the least significant bits
+        return long(bytes_[::-1].encode("HEX"), 16)
+
+    @staticmethod
+    def _filter_to_bytes(filter_, m_size):
+        # the first byte contains the least significant bits.  M_SIZE bits require (M_SIZE + 7) / 8
+        # bytes, i.e. two hex digits per byte
+        return ("%0*x" % ((m_size + 7) / 8 * 2, filter_)).decode("HEX")[::-1]
 
     def _hashes(self, key):
         h = self._salt.copy()
@@ -230,8 +253,308 @@ class BloomFilter(Constructor):
 
     @property
     def bytes(self):
+        return self._filter_to_bytes(self._filter, self._m_size)
+
+class BytearrayBloomFilter(BloomFilter):
+    """
+    A bloom filter that stores its bits in a bytearray.
+
+    Setting a bit in a python long creates a new long for every operation, which is expensive for
+    the large filters that are used during sync.  The bytearray is modified in place.  Bit POS is
+    stored in byte POS / 8 at bit POS % 8, making the bytes property, and hence the wire format,
+    identical to BloomFilter.
+    """
+    @staticmethod
+    def _check_filter(filter_, m_size):
+        return isinstance(filter_, bytearray) and len(filter_) == (m_size + 7) / 8
+
+    @staticmethod
+    def _empty_filter(m_size):
+        return bytearray((m_size + 7) / 8)
+
+    @staticmethod
+    def _filter_from_bytes(bytes_):
+        return bytearray(bytes_)
+
+    @staticmethod
+    def _filter_to_bytes(filter_, m_size):
+        return str(filter_)
+
+    def add(self, key):
+        """
+        Add KEY to the BloomFilter.
+        """
+        self.add_keys((key,))
+
+    def add_keys(self, keys):
+        """
+        Add a sequence of KEYS to the BloomFilter.
+        """
         filter_ = self._filter
-        return "".join(chr((filter_ & (0xff << c)) >> c) for c in xrange(0, self._m_size, 8))
+        salt_copy = self._salt.copy
+        m_size = self._m_size
+        fmt_unpack = self._fmt_unpack
+
+        for key in keys:
+            assert isinstance(key, str)
+            h = salt_copy()
+            h.update(key)
+            for pos in fmt_unpack(h.digest()):
+                pos %= m_size
+                filter_[pos >> 3] |= 1 << (pos & 7)
+
+    def clear(self):
+        """
+        Set all bits in the filter to zero.
+        """
+        self._filter = self._empty_filter(self._m_size)
+
+    def __contains__(self, key):
+        filter_ = self._filter
+        m_size = self._m_size
+
+        h = self._salt.copy()
+        h.update(key)
+
+        for pos in self._fmt_unpack(h.digest()):
+            pos %= m_size
+            if not filter_[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def not_filter(self, iterator):
+        """
+        Yields all tuples in iterator where the first element in the tuple is NOT in the bloom
+        filter.
+        """
+        filter_ = self._filter
+        salt_copy = self._salt.copy
+        m_size = self._m_size
+        fmt_unpack = self._fmt_unpack
+
+        for tup in iterator:
+            assert isinstance(tup, tuple)
+            assert len(tup) > 0
+            assert isinstance(tup[0], str)
+            h = salt_copy()
+            h.update(tup[0])
+
+            for pos in fmt_unpack(h.digest()):
+                pos %= m_size
+                if not filter_[pos >> 3] & (1 << (pos & 7)):
+                    yield tup
+                    break
+
+    @property
+    def bytes(self):
+        return self._filter_to_bytes(self._filter, self._m_size)
+
+class DigestBloomFilter(BytearrayBloomFilter):
+    """
+    A bloom filter containing packet digests instead of packets.
+
+    The sync table stores the sha1 digest of every packet.  Hence the k positions can be derived
+    from the prefix salt and this fixed size digest, allowing a sync bloom filter to be filled, and
+    checked, without retrieving the packets from the database.  Only the packets that are missing
+    need to be retrieved.
+
+    Note that DigestBloomFilter and BytearrayBloomFilter are not interchangeable: the keys of a
+    DigestBloomFilter must be obtained using DigestBloomFilter.digest.
+    """
+    @staticmethod
+    def digest(packet):
+        """
+        Returns the key for PACKET, this is the value stored in the digest column of the sync table.
+        """
+        assert isinstance(packet, str)
+        return sha1(packet).digest()
+
+class InvertibleBloomLookupTable(object):
+    """
+    An invertible bloom lookup table (IBLT) containing packet digests.
+
+    Each key is added to FUNCTIONS cells, one in each of FUNCTIONS equally sized partitions.  A
+    cell contains the number of keys, the xor of the first eight bytes of their digests, and the
+    xor of a salted checksum of those eight bytes.  Subtracting the table of one peer from the
+    table of another peer, with the same size, functions, and prefix, removes all keys that both
+    peers have.  The remaining keys can be listed by repeatedly removing keys from cells that
+    contain exactly one key.  This succeeds with high probability when the number of remaining
+    keys is below CELLS / 1.5, regardless of the number of keys in either table.
+
+    Hence, unlike a bloom filter, the size of the table depends on the number of packets that the
+    peers are expected to differ, not on the number of packets in the sync range, and there are no
+    false positives.
+    """
+    _struct_Q = Struct(">Q")
+    _struct_hQL = Struct(">hQL")
+    _struct_LLLL = Struct(">LLLL")
+
+    # the number of bytes that each cell uses on the wire
+    cell_size = _struct_hQL.size
+
+    def __init__(self, cells_or_bytes, functions=3, prefix=""):
+        assert isinstance(cells_or_bytes, (int, str))
+        assert isinstance(functions, int)
+        assert 0 < functions <= 4
+        assert isinstance(prefix, str)
+        assert 0 <= len(prefix) < 256
+        if isinstance(cells_or_bytes, int):
+            cells = cells_or_bytes
+            self._counts = [0] * cells
+            self._key_sums = [0] * cells
+            self._hash_sums = [0] * cells
+
+        else:
+            assert len(cells_or_bytes) % self.cell_size == 0
+            cells = len(cells_or_bytes) / self.cell_size
+            unpack_from = self._struct_hQL.unpack_from
+            columns = zip(*[unpack_from(cells_or_bytes, offset) for offset in xrange(0, len(cells_or_bytes), self.cell_size)]) if cells else ((), (), ())
+            self._counts, self._key_sums, self._hash_sums = [list(column) for column in columns]
+
+        assert cells % functions == 0, "the cells must be divisible into FUNCTIONS partitions"
+        self._functions = functions
+        self._prefix = prefix
+        self._salt = sha1(prefix)
+        # _decoded is set by not_filter
+        self._decoded = None
+
+    @property
+    def cells(self):
+        return len(self._counts)
+
+    @property
+    def capacity(self):
+        """
+        The number of differences that can be decoded with high probability.
+        """
+        return int(self.cells / 1.5)
+
+    @property
+    def decoded(self):
+        """
+        True when not_filter found all differences, False when it did not, and None when not_filter
+        was not used.
+        """
+        return self._decoded
+
+    @property
+    def functions(self):
+        return self._functions
+
+    @property
+    def prefix(self):
+        return self._prefix
+
+    @property
+    def bytes(self):
+        pack = self._struct_hQL.pack
+        return "".join(pack(count, key_sum, hash_sum) for count, key_sum, hash_sum in zip(self._counts, self._key_sums, self._hash_sums))
+
+    def _hashes(self, key):
+        """
+        Returns the (key, checksum, indexes) for KEY, where key is the eight byte integer that is
+        stored in the key sum.
+        """
+        assert isinstance(key, (int, long))
+        h = self._salt.copy()
+        h.update(self._struct_Q.pack(key))
+        hashes = self._struct_LLLL.unpack_from(h.digest())
+        partition = len(self._counts) / self._functions
+        return hashes[0], [index * partition + hashes[index + 1] % partition for index in xrange(self._functions)]
+
+    def _update(self, key, delta):
+        checksum, indexes = self._hashes(key)
+        counts, key_sums, hash_sums = self._counts, self._key_sums, self._hash_sums
+        for index in indexes:
+            counts[index] += delta
+            key_sums[index] ^= key
+            hash_sums[index] ^= checksum
+
+    @staticmethod
+    def key(digest):
+        """
+        Returns the integer that represents DIGEST in the table.
+        """
+        assert isinstance(digest, str)
+        assert len(digest) >= 8
+        return InvertibleBloomLookupTable._struct_Q.unpack_from(digest)[0]
+
+    def add(self, digest):
+        self._update(self.key(digest), 1)
+
+    def add_keys(self, digests):
+        for digest in digests:
+            self._update(self.key(digest), 1)
+
+    def subtract(self, other):
+        """
+        Returns a new table containing the keys in SELF that are not in OTHER (count 1) and the
+        keys in OTHER that are not in SELF (count -1).
+        """
+        assert isinstance(other, InvertibleBloomLookupTable)
+        assert self.cells == other.cells and self._functions == other._functions and self._prefix == other._prefix
+        table = InvertibleBloomLookupTable(self.cells, self._functions, self._prefix)
+        table._counts = [a - b for a, b in zip(self._counts, other._counts)]
+        table._key_sums = [a ^ b for a, b in zip(self._key_sums, other._key_sums)]
+        table._hash_sums = [a ^ b for a, b in zip(self._hash_sums, other._hash_sums)]
+        return table
+
+    def decode(self):
+        """
+        Returns a (positive, negative, complete) tuple, where POSITIVE and NEGATIVE are sets with
+        the keys that have count 1 and -1, respectively, and COMPLETE is True when all keys were
+        found.  This empties the table.
+        """
+        counts, key_sums, hash_sums = self._counts, self._key_sums, self._hash_sums
+        positive = set()
+        negative = set()
+        pure = [index for index, count in enumerate(counts) if count in (1, -1)]
+        while pure:
+            index = pure.pop()
+            count = counts[index]
+            if not count in (1, -1):
+                continue
+            key = key_sums[index]
+            checksum, indexes = self._hashes(key)
+            if checksum != hash_sums[index]:
+                continue
+
+            (positive if count == 1 else negative).add(key)
+            for index in indexes:
+                counts[index] -= count
+                key_sums[index] ^= key
+                hash_sums[index] ^= checksum
+                if counts[index] in (1, -1):
+                    pure.append(index)
+
+        complete = not any(counts) and not any(key_sums)
+        return positive, negative, complete
+
+    def not_filter(self, iterator):
+        """
+        Yields all tuples in ITERATOR where the first element in the tuple, a digest, is NOT in
+        the table.
+
+        The table of the tuples in ITERATOR is built and SELF is subtracted from it.  When not all
+        differences can be decoded only those that were decoded are yielded, these are always
+        correct.  The tuples are yielded in the order of ITERATOR.
+        """
+        tuples = list(iterator)
+        table = InvertibleBloomLookupTable(self.cells, self._functions, self._prefix)
+        table.add_keys(tup[0] for tup in tuples)
+        missing, _, complete = table.subtract(self).decode()
+        self._decoded = complete
+        if __debug__:
+            if not complete:
+                dprint("unable to decode all differences, found ", len(missing), " missing keys", level="warning")
+
+        key = self.key
+        for tup in tuples:
+            assert isinstance(tup, tuple)
+            assert len(tup) > 0
+            assert isinstance(tup[0], str)
+            if key(tup[0]) in missing:
+                yield tup
 
 if __debug__:
     def _test_behavior():
@@ -699,6 +1022,95 @@ if __debug__:
         for i in testdata:
             test = i in b
 
+    def _test_bytearray_performance():
+        """
+        Compare BloomFilter and BytearrayBloomFilter on add_keys, not_filter, and construction from
+        bytes.  Both must produce identical bytes.
+        """
+        BITS = 10240
+        ERROR_RATE = 0.01
+        ROUNDS = 100
+        keys = ["".join(chr(int(random() * 256)) for _ in xrange(200)) for _ in xrange(BloomFilter(BITS, ERROR_RATE).get_capacity(ERROR_RATE))]
+        others = [(key[::-1],) for key in keys]
+
+        results = []
+        for constructor in (BloomFilter, BytearrayBloomFilter):
+            b = constructor(BITS, ERROR_RATE, prefix="x")
+            begin = time()
+            for _ in xrange(ROUNDS):
+                b.clear()
+                b.add_keys(keys)
+            add_keys = time() - begin
+
+            begin = time()
+            for _ in xrange(ROUNDS):
+                missing = list(b.not_filter(others))
+            not_filter = time() - begin
+
+            bytes_ = b.bytes
+            begin = time()
+            for _ in xrange(ROUNDS):
+                c = constructor(bytes_, b.functions, prefix="x")
+            from_bytes = time() - begin
+            assert c.bytes == bytes_
+
+            print "%-20s add_keys %.3fs  not_filter %.3fs  from_bytes %.3fs  (%d keys, %d bits, %d rounds)" % (constructor.__name__, add_keys, not_filter, from_bytes, len(keys), BITS, ROUNDS)
+            results.append((bytes_, len(missing)))
+
+        assert results[0] == results[1], "BloomFilter and BytearrayBloomFilter must be wire compatible"
+
+    def _test_bytes_round_trip():
+        """
+        The bytes of both engines must equal the original BloomFilter.bytes, also when the size is
+        not a multiple of eight.
+        """
+        for m_size in (1, 4, 7, 8, 9, 12, 15, 16, 100, 1003, 1004, 10240):
+            for filter_ in (0L, 1L, (1L << m_size) - 1, 1L << (m_size - 1), long(getrandbits(m_size))):
+                # the conversion used before the hex conversion
+                expected = "".join(chr((filter_ & (0xff << c)) >> c) for c in xrange(0, m_size, 8))
+                assert BloomFilter._filter_to_bytes(filter_, m_size) == expected, (m_size, filter_)
+                assert BloomFilter._filter_from_bytes(expected) == filter_, (m_size, filter_)
+
+                array = BytearrayBloomFilter._filter_from_bytes(expected)
+                assert BytearrayBloomFilter._check_filter(array, m_size), m_size
+                assert BytearrayBloomFilter._filter_to_bytes(array, m_size) == expected, (m_size, filter_)
+            assert len(BytearrayBloomFilter._empty_filter(m_size)) == len(expected)
+
+        for m_size in (64, 1000, 10240):
+            keys = [str(i) for i in xrange(m_size / 10)]
+            a = BloomFilter(m_size, 0.01, prefix="a")
+            a.add_keys(keys)
+            b = BytearrayBloomFilter(m_size, 0.01, prefix="a")
+            b.add_keys(keys)
+            assert a.bytes == b.bytes
+            assert BytearrayBloomFilter(a.bytes, a.functions, prefix="a").bytes == a.bytes
+            assert BloomFilter(b.bytes, b.functions, prefix="a").bytes == a.bytes
+
+    def _test_invertible_bloom_lookup_table():
+        shared = [sha1(str(i)).digest() for i in xrange(10000)]
+        ours = [sha1("ours-%d" % i).digest() for i in xrange(10)]
+        theirs = [sha1("theirs-%d" % i).digest() for i in xrange(10)]
+
+        remote = InvertibleBloomLookupTable(72, 3, prefix="a")
+        remote.add_keys(shared + theirs)
+        remote = InvertibleBloomLookupTable(remote.bytes, 3, prefix="a")
+        assert len(remote.bytes) == 72 * InvertibleBloomLookupTable.cell_size
+
+        missing = [digest for digest, in remote.not_filter((digest,) for digest in shared + ours)]
+        assert missing == ours, "72 cells should be sufficient to decode 20 differences"
+        assert remote.decoded is True and remote.capacity == 48
+
+        many = [sha1("many-%d" % i).digest() for i in xrange(200)]
+        list(remote.not_filter((digest,) for digest in shared + many))
+        assert remote.decoded is False, "72 cells can not decode 210 differences"
+
+        local = InvertibleBloomLookupTable(72, 3, prefix="a")
+        local.add_keys(shared + ours)
+        positive, negative, complete = local.subtract(remote).decode()
+        assert complete
+        assert positive == set(InvertibleBloomLookupTable.key(digest) for digest in ours)
+        assert negative == set(InvertibleBloomLookupTable.key(digest) for digest in theirs)
+
     def p(b, postfix=""):
         # print "capacity:", b.capacity, "error-rate:", b.error_rate, "num-slices:", b.num_slices, "bits-per-slice:", b.bits_per_slice, "bits:", b.size, "bytes:", b.size / 8, "packet-bytes:", b.size / 8 + 51 + 60 + 16 + 8, postfix
         print "error-rate", b.error_rate, "bits:", b.size, "bytes:", b.size / 8, "packet-bytes:", b.size / 8 + 51 + 60 + 16 + 8, postfix
@@ -716,7 +1128,10 @@ if __debug__:
         # _test_prefix_false_positives(FasterBloomFilter)
         # _test_behavior(FasterBloomFilter)
         # _test_size()
-        _test_performance()
+        # _test_performance()
+        _test_bytes_round_trip()
+        _test_invertible_bloom_lookup_table()
+        _test_bytearray_performance()
 
         # MTU = 1500 # typical MTU
         # # MTU = 576 # ADSL
@@ -1,3 +1,8 @@
+from bisect import bisect_right
+from random import choice, random
+
+from bloomfilter import BytearrayBloomFilter, InvertibleBloomLookupTable
+
 class CacheDict(object):
     """
     A poke based cache dictionary.
@@ -114,6 +119,690 @@ class CacheDict(object):
     def __str__(self):
         return "\n".join("%d -> %s" % (cache.__poke_count, key) for key, cache in self._dict.iteritems())
 
+class LinkedDict(object):
+    """
+    A dictionary that remembers the order in which its keys were set.
+
+    Setting a key, also an existing one, makes it the most recent key.  Iteration, keys, and
+    popitem(last=False) start at the least recent key, allowing least recently used caches to
+    evict in O(1) without requiring collections.OrderedDict (Python 2.7).
+
+    Each entry is stored as a [previous, next, key, value] link in a circular doubly linked list.
+    """
+    def __init__(self):
+        self._root = root = []
+        root[:] = [root, root, None, None]
+        self._links = {}
+
+    def __len__(self):
+        return len(self._links)
+
+    def __contains__(self, key):
+        return key in self._links
+
+    def __getitem__(self, key):
+        return self._links[key][3]
+
+    def get(self, key, value=None):
+        link = self._links.get(key)
+        return value if link is None else link[3]
+
+    def __setitem__(self, key, value):
+        link = self._links.pop(key, None)
+        if link:
+            link[0][1] = link[1]
+            link[1][0] = link[0]
+        root = self._root
+        last = root[0]
+        last[1] = root[0] = self._links[key] = [last, root, key, value]
+
+    def __delitem__(self, key):
+        link = self._links.pop(key)
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+
+    def pop(self, key, *default):
+        link = self._links.get(key)
+        if link is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        self.__delitem__(key)
+        return link[3]
+
+    def popitem(self, last=True):
+        if not self._links:
+            raise KeyError("dictionary is empty")
+        link = self._root[0] if last else self._root[1]
+        self.__delitem__(link[2])
+        return link[2], link[3]
+
+    def clear(self):
+        root = self._root
+        root[:] = [root, root, None, None]
+        self._links.clear()
+
+    def __iter__(self):
+        root = self._root
+        link = root[1]
+        while not link is root:
+            yield link[2]
+            link = link[1]
+
+    def keys(self):
+        return list(self)
+
+    def iteritems(self):
+        return ((key, self._links[key][3]) for key in self)
+
+class SignatureCache(object):
+    """
+    A bounded set of recently verified signatures.
+
+    Each key identifies a packet and the member that signed it (see Conversion), it is only added
+    after the signature has been verified successfully.  Hence, finding a key in the cache means
+    that the expensive EC verification can be skipped.
+
+    The cache consists of two generations.  New and retrieved keys are stored in the current
+    generation.  Once the current generation contains MAX_SIZE / 2 keys it replaces the previous
+    generation, removing all keys that were not used since.  This approximates least recently used
+    eviction while every operation remains O(1).
+    """
+    def __init__(self, max_size=4096):
+        assert isinstance(max_size, int)
+        assert max_size >= 2
+        self._generation_size = max_size / 2
+        self._current = set()
+        self._previous = set()
+        self._hits = 0
+        self._misses = 0
+
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+
+    def __contains__(self, key):
+        if key in self._current:
+            self._hits += 1
+            return True
+
+        if key in self._previous:
+            self._hits += 1
+            self._previous.remove(key)
+            self.add(key)
+            return True
+
+        self._misses += 1
+        return False
+
+    def add(self, key):
+        if len(self._current) >= self._generation_size:
+            self._previous = self._current
+            self._current = set()
+        self._current.add(key)
+
+    def info(self):
+        """
+        Returns the cache statistics.
+        """
+        lookups = self._hits + self._misses
+        return {"size":len(self),
+                "max_size":self._generation_size * 2,
+                "hits":self._hits,
+                "misses":self._misses,
+                "hit_rate":float(self._hits) / lookups if lookups else 0.0}
+
+    def reset(self):
+        """
+        Returns, and subsequently removes, the cache statistics.  The cached keys are kept.
+        """
+        try:
+            return self.info()
+
+        finally:
+            self._hits = 0
+            self._misses = 0
+
+class SyncKeyCache(object):
+    """
+    A bounded mapping from recently stored (member database id, global time) keys to the digests
+    of their packets.
+
+    Only packets that are in the database and are not undone may be present.  Hence, a message
+    whose key and digest are found is a binary identical duplicate that can be dropped without
+    consulting the database.
+
+    Like the SignatureCache, the cache consists of two generations of at most MAX_SIZE / 2 keys.
+    """
+    def __init__(self, max_size=4096):
+        assert isinstance(max_size, int)
+        assert max_size >= 2
+        self._generation_size = max_size / 2
+        self._current = {}
+        self._previous = {}
+        self._hits = 0
+        self._misses = 0
+
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+
+    def get(self, key):
+        """
+        Returns the digest for KEY or None.
+        """
+        if key in self._current:
+            self._hits += 1
+            return self._current[key]
+
+        if key in self._previous:
+            self._hits += 1
+            digest = self._previous.pop(key)
+            self.set(key, digest)
+            return digest
+
+        self._misses += 1
+        return None
+
+    def set(self, key, digest):
+        if len(self._current) >= self._generation_size:
+            self._previous = self._current
+            self._current = {}
+        self._current[key] = digest
+
+    def discard(self, key):
+        self._current.pop(key, None)
+        self._previous.pop(key, None)
+
+    def clear(self):
+        self._current = {}
+        self._previous = {}
+
+    def info(self):
+        """
+        Returns the cache statistics.
+        """
+        lookups = self._hits + self._misses
+        return {"size":len(self),
+                "max_size":self._generation_size * 2,
+                "hits":self._hits,
+                "misses":self._misses,
+                "hit_rate":float(self._hits) / lookups if lookups else 0.0}
+
+class SyncResponseCache(object):
+    """
+    A bounded mapping from recently requested sync ranges to the rows that the sync response query
+    returned for them.  Each key starts with (time_low, time_high, modulo, offset), any further
+    elements distinguish between different queries for the same range.
+
+    Many peers request overlapping, or identical, ranges.  With a cached entry only the bloom
+    filter of the requester must be applied to the rows, the database is not queried.  Each row
+    is a tuple starting with the bloom filter key, i.e. the digest or the packet itself.
+
+    Storing, removing, undoing, or redoing a packet invalidates the entries whose range contains
+    the global time of that packet, see invalidate.  Since rows may be selected on another thread
+    the cache has a VERSION that changes on every invalidation, rows selected before the most
+    recent invalidation are not added.  The other thread only sees committed packets, hence the
+    invalidation is repeated once the packets are committed, see committed.
+
+    At most MAX_SIZE entries, containing at most MAX_BYTES key bytes in total, are kept.  The least
+    recently used entries are removed first.
+    """
+    def __init__(self, max_size=32, max_bytes=2**22):
+        assert isinstance(max_size, int)
+        assert max_size > 0
+        assert isinstance(max_bytes, int)
+        assert max_bytes > 0
+        self._max_size = max_size
+        self._max_bytes = max_bytes
+        # _entries contains (time_low, time_high, modulo, offset, ...) keys and (rows, bytes) values
+        self._entries = LinkedDict()
+        self._bytes = 0
+        self._version = 0
+        # _uncommitted contains the global times invalidated since the previous commit, or None
+        # when the cache was cleared since the previous commit
+        self._uncommitted = []
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def version(self):
+        return self._version
+
+    def get(self, key):
+        """
+        Returns the rows for KEY or None.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self._misses += 1
+            return None
+
+        self._hits += 1
+        self._entries[key] = entry
+        return entry[0]
+
+    def set(self, key, rows, version):
+        """
+        Add ROWS for KEY when they were selected at VERSION and there was no invalidation since.
+        """
+        assert isinstance(key, tuple) and len(key) >= 4, key
+        assert isinstance(rows, list)
+        if version != self._version:
+            return
+
+        self.discard(key)
+        size = sum(len(row[0]) for row in rows)
+        if size > self._max_bytes:
+            return
+
+        self._entries[key] = (rows, size)
+        self._bytes += size
+        while len(self._entries) > self._max_size or self._bytes > self._max_bytes:
+            _, (_, size) = self._entries.popitem(last=False)
+            self._bytes -= size
+
+    def discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._bytes -= entry[1]
+
+    def invalidate(self, global_times):
+        """
+        Remove the entries whose range contains any of GLOBAL_TIMES.
+        """
+        self._version += 1
+        if self._uncommitted is not None:
+            self._uncommitted.extend(global_times)
+        for key in self._entries.keys():
+            time_low, time_high, modulo, offset = key[:4]
+            if any(time_low <= global_time <= time_high and (global_time + offset) % modulo == 0 for global_time in global_times):
+                self._invalidations += 1
+                self.discard(key)
+
+    def clear(self):
+        self._version += 1
+        self._uncommitted = None
+        self._entries.clear()
+        self._bytes = 0
+
+    def committed(self):
+        """
+        Notify that the invalidated packets were committed.
+
+        Rows selected on another thread between an invalidation and the commit do not contain the
+        invalidated packets, while they were selected at the current version.  Hence the
+        invalidation is repeated.
+        """
+        uncommitted, self._uncommitted = self._uncommitted, []
+        if uncommitted is None:
+            self.clear()
+            self._uncommitted = []
+        elif uncommitted:
+            self.invalidate(uncommitted)
+            self._uncommitted = []
+
+    def info(self):
+        """
+        Returns the cache statistics.
+        """
+        lookups = self._hits + self._misses
+        return {"size":len(self),
+                "bytes":self._bytes,
+                "hits":self._hits,
+                "misses":self._misses,
+                "invalidations":self._invalidations,
+                "hit_rate":float(self._hits) / lookups if lookups else 0.0}
+
+class SyncFingerprintCache(object):
+    """
+    Maintains (count, xor) fingerprints over global-time buckets of the syncable packets of a
+    single community.
+
+    The fingerprint of a set of packets is the number of packets and the xor of the first eight
+    bytes of their digests.  Two peers holding the same packets in a range have the same
+    fingerprint, hence a sync request for that range can be answered without a database scan.
+
+    Each bucket covers BUCKET_SIZE consecutive global times.  The fingerprint of a range is the xor
+    of the buckets that it covers completely, while the partially covered buckets at either end are
+    read using KEY_LOADER.  Storing a packet updates its bucket in place.  Removing, undoing, or
+    replacing a packet marks its bucket dirty, dirty buckets are read again when they are used.
+
+    KEY_LOADER(time_low, time_high) must return (global_time, digest) tuples for all syncable
+    packets in the given range.
+    """
+    # the time_high used for a range without an upper bound
+    max_global_time = 2 ** 63 - 1
+
+    def __init__(self, key_loader, bucket_size=64):
+        assert hasattr(key_loader, "__call__")
+        assert isinstance(bucket_size, int)
+        assert bucket_size > 0
+        self._key_loader = key_loader
+        self._bucket_size = bucket_size
+        # _buckets contains bucket / [count, xor] pairs, it is loaded on the first fingerprint
+        self._buckets = None
+        self._dirty = set()
+        self._matches = 0
+        self._mismatches = 0
+
+    def _load(self, time_low, time_high):
+        count = xor = 0
+        key = InvertibleBloomLookupTable.key
+        for _, digest in self._key_loader(time_low, time_high):
+            count += 1
+            xor ^= key(digest)
+        return count, xor
+
+    def _get_bucket(self, bucket):
+        if bucket in self._dirty:
+            self._dirty.remove(bucket)
+            count, xor = self._load(bucket * self._bucket_size, min((bucket + 1) * self._bucket_size - 1, self.max_global_time))
+            if count:
+                self._buckets[bucket] = [count, xor]
+            else:
+                self._buckets.pop(bucket, None)
+        return self._buckets.get(bucket)
+
+    def add(self, global_time, digest):
+        """
+        Add the DIGEST of a newly stored packet with GLOBAL_TIME to its bucket.
+        """
+        assert isinstance(global_time, (int, long))
+        assert isinstance(digest, str)
+        if self._buckets is None:
+            return
+
+        bucket = global_time // self._bucket_size
+        if not bucket in self._dirty:
+            entry = self._buckets.setdefault(bucket, [0, 0])
+            entry[0] += 1
+            entry[1] ^= InvertibleBloomLookupTable.key(digest)
+
+    def invalidate(self, global_times):
+        """
+        Mark the buckets containing GLOBAL_TIMES as dirty.
+        """
+        if self._buckets is None:
+            return
+        self._dirty.update(global_time // self._bucket_size for global_time in global_times)
+
+    def clear(self):
+        """
+        Remove all buckets.  They will be loaded again on the next fingerprint.
+        """
+        self._buckets = None
+        self._dirty.clear()
+
+    def fingerprint(self, time_low, time_high):
+        """
+        Returns the (count, xor) fingerprint of the packets in [TIME_LOW, TIME_HIGH].  TIME_HIGH is
+        zero when the range has no upper bound.
+        """
+        assert isinstance(time_low, (int, long))
+        assert isinstance(time_high, (int, long))
+        if time_high == 0 or time_high > self.max_global_time:
+            time_high = self.max_global_time
+
+        if self._buckets is None:
+            self._buckets = {}
+            key = InvertibleBloomLookupTable.key
+            for global_time, digest in self._key_loader(1, self.max_global_time):
+                entry = self._buckets.setdefault(global_time // self._bucket_size, [0, 0])
+                entry[0] += 1
+                entry[1] ^= key(digest)
+
+        low = time_low // self._bucket_size
+        high = time_high // self._bucket_size
+        if low == high:
+            return self._load(time_low, time_high)
+
+        count = xor = 0
+        if time_low % self._bucket_size:
+            # partially covered first bucket
+            count, xor = self._load(time_low, (low + 1) * self._bucket_size - 1)
+            low += 1
+
+        if (time_high + 1) % self._bucket_size:
+            # partially covered last bucket
+            edge_count, edge_xor = self._load(high * self._bucket_size, time_high)
+            count += edge_count
+            xor ^= edge_xor
+            high -= 1
+
+        for bucket in [bucket for bucket in self._dirty if low <= bucket <= high]:
+            self._get_bucket(bucket)
+
+        if high - low < len(self._buckets):
+            entries = [self._buckets.get(bucket) for bucket in xrange(low, high + 1)]
+        else:
+            entries = [entry for bucket, entry in self._buckets.iteritems() if low <= bucket <= high]
+        for entry in entries:
+            if entry:
+                count += entry[0]
+                xor ^= entry[1]
+
+        return count, xor
+
+    def match(self, time_low, time_high, fingerprint):
+        """
+        Returns True when FINGERPRINT equals the fingerprint of [TIME_LOW, TIME_HIGH].
+        """
+        if self.fingerprint(time_low, time_high) == fingerprint:
+            self._matches += 1
+            return True
+        self._mismatches += 1
+        return False
+
+    def info(self):
+        """
+        Returns the cache statistics.
+        """
+        return {"buckets":len(self._buckets) if self._buckets else 0,
+                "dirty":len(self._dirty),
+                "matches":self._matches,
+                "mismatches":self._mismatches}
+
+class SyncRange(object):
+    """
+    A range of global times, starting at TIME_LOW, that contains at most CAPACITY syncable packets.
+
+    FILTERS contains prefix / BytearrayBloomFilter pairs for all bloom filters that have been
+    claimed for this range.  A range is DIRTY when packets were removed, undone, or replaced, in
+    which case COUNT and FILTERS must be rebuilt from the database.
+    """
+    __slots__ = ["time_low", "count", "dirty", "filters"]
+
+    def __init__(self, time_low, count):
+        self.time_low = time_low
+        self.count = count
+        self.dirty = False
+        self.filters = {}
+
+class SyncRangeCache(object):
+    """
+    Maintains the sync bloom filters for a single community.
+
+    All syncable packets are partitioned, by global time, into SyncRange instances containing at
+    most CAPACITY packets each.  Every range keeps the bloom filters that were claimed for it, one
+    for each of at most PREFIX_COUNT prefixes.  These filters are updated in place when new packets
+    are stored.  Claiming a filter for a range that did not change is therefore a copy of the filter
+    rather than a database query followed by hashing every packet in the range.
+
+    Removing, undoing, or replacing a packet can not be applied to a bloom filter.  Instead, the
+    range containing that packet is marked dirty and will be recounted and refilled from the
+    database the next time it is claimed.
+
+    COUNT_LOADER(time_low, time_high) must return (global_time, count) tuples, ordered by global
+    time, for all syncable packets in the given range.  KEY_LOADER(time_low, time_high) must return
+    the bloom filter keys, i.e. the binary packets or their digests depending on BLOOM_CLASS, for
+    all syncable packets in the given range.
+    """
+    # the time_high used for the last range, i.e. the range without an upper bound
+    max_global_time = 2 ** 63 - 1
+
+    def __init__(self, m_size, f_error_rate, capacity, count_loader, key_loader, prefix_count=8, bloom_class=BytearrayBloomFilter):
+        assert isinstance(m_size, int)
+        assert m_size > 0
+        assert isinstance(f_error_rate, float)
+        assert 0 < f_error_rate < 1
+        assert isinstance(capacity, int)
+        assert capacity > 0
+        assert hasattr(count_loader, "__call__")
+        assert hasattr(key_loader, "__call__")
+        assert isinstance(prefix_count, int)
+        assert 0 < prefix_count <= 256
+        assert issubclass(bloom_class, BytearrayBloomFilter)
+        self._m_size = m_size
+        self._f_error_rate = f_error_rate
+        self._capacity = capacity
+        self._count_loader = count_loader
+        self._key_loader = key_loader
+        self._prefix_count = prefix_count
+        self._bloom_class = bloom_class
+        # _ranges and _time_lows are loaded on the first claim
+        self._ranges = None
+        self._time_lows = None
+        self._hits = 0
+        self._misses = 0
+        self._recounts = 0
+
+    @property
+    def ranges(self):
+        return self._ranges or []
+
+    def _partition(self, time_low, counts):
+        """
+        Returns SyncRange instances, starting at TIME_LOW, for the (global_time, count) tuples in
+        COUNTS.  Packets with the same global time always end up in the same range.
+        """
+        ranges = [SyncRange(time_low, 0)]
+        for global_time, count in counts:
+            if ranges[-1].count and ranges[-1].count + count > self._capacity:
+                ranges.append(SyncRange(global_time, 0))
+            ranges[-1].count += count
+        return ranges
+
+    def _get_index(self, global_time):
+        return max(0, bisect_right(self._time_lows, global_time) - 1)
+
+    def _get_time_high(self, index):
+        if index + 1 < len(self._ranges):
+            return self._ranges[index + 1].time_low - 1
+        return self.max_global_time
+
+    def _replace(self, index, count, ranges):
+        self._ranges[index:index + count] = ranges
+        self._time_lows[index:index + count] = [range_.time_low for range_ in ranges]
+
+    def _recount(self, index):
+        """
+        Rebuild the dirty range at INDEX, splitting it when it contains too many packets and merging
+        it with the next range when both contain few packets.
+        """
+        self._recounts += 1
+        range_ = self._ranges[index]
+        ranges = self._partition(range_.time_low, self._count_loader(range_.time_low, self._get_time_high(index)))
+        count = 1
+        if len(ranges) == 1 and index + 1 < len(self._ranges):
+            next_range = self._ranges[index + 1]
+            if not next_range.dirty and ranges[0].count + next_range.count <= self._capacity / 2:
+                ranges[0].count += next_range.count
+                count = 2
+        self._replace(index, count, ranges)
+
+    def add(self, global_time, key):
+        """
+        Add the KEY of a newly stored packet with GLOBAL_TIME to the filters of its range.
+        """
+        assert isinstance(global_time, (int, long))
+        assert isinstance(key, str)
+        if self._ranges is None:
+            return
+
+        range_ = self._ranges[self._get_index(global_time)]
+        if not range_.dirty:
+            range_.count += 1
+            if range_.count > self._capacity:
+                # the range will be split the next time it is claimed
+                range_.dirty = True
+                range_.filters.clear()
+            else:
+                for bloom in range_.filters.itervalues():
+                    bloom.add(key)
+
+    def invalidate(self, global_times):
+        """
+        Mark the ranges containing GLOBAL_TIMES as dirty.
+        """
+        if self._ranges is None:
+            return
+
+        for global_time in global_times:
+            range_ = self._ranges[self._get_index(global_time)]
+            range_.dirty = True
+            range_.filters.clear()
+
+    def clear(self):
+        """
+        Remove all ranges.  They will be loaded again on the next claim.
+        """
+        self._ranges = None
+        self._time_lows = None
+
+    def claim(self, global_time, bloom_filter=True):
+        """
+        Returns a (time_low, time_high, bloom_filter) tuple for the range containing GLOBAL_TIME.
+
+        TIME_HIGH is None when the range has no upper bound.  The returned bloom filter is a copy
+        and may be modified by the caller.  When BLOOM_FILTER is False no bloom filter is claimed
+        and None is returned instead.
+        """
+        assert isinstance(global_time, (int, long))
+        assert isinstance(bloom_filter, bool)
+        if self._ranges is None:
+            self._ranges = self._partition(1, self._count_loader(1, self.max_global_time))
+            self._time_lows = [range_.time_low for range_ in self._ranges]
+
+        index = self._get_index(global_time)
+        if self._ranges[index].dirty:
+            self._recount(index)
+            index = self._get_index(global_time)
+
+        range_ = self._ranges[index]
+        time_high = self._get_time_high(index)
+        if not bloom_filter:
+            return (range_.time_low, None if time_high == self.max_global_time else time_high, None)
+
+        if len(range_.filters) < self._prefix_count:
+            self._misses += 1
+            prefix = chr(int(random() * 256))
+            while prefix in range_.filters:
+                prefix = chr(int(random() * 256))
+            bloom = self._bloom_class(self._m_size, self._f_error_rate, prefix=prefix)
+            bloom.add_keys(self._key_loader(range_.time_low, time_high))
+            range_.filters[prefix] = bloom
+
+        else:
+            self._hits += 1
+            bloom = choice(range_.filters.values())
+
+        return (range_.time_low,
+                None if time_high == self.max_global_time else time_high,
+                self._bloom_class(bloom.bytes, bloom.functions, prefix=bloom.prefix))
+
+    def info(self):
+        """
+        Returns the cache statistics.
+        """
+        return {"ranges":[{"time_low":range_.time_low, "count":range_.count, "dirty":range_.dirty, "filters":len(range_.filters)} for range_ in self.ranges],
+                "capacity":self._capacity,
+                "hits":self._hits,
+                "misses":self._misses,
+                "recounts":self._recounts}
+
 if __debug__:
     if __name__ == "__main__":
         class Cache(object):
@@ -132,3 +821,84 @@ if __debug__:
         assert l == [("bar", bar)], l
         print
         print c
+
+        d = LinkedDict()
+        d["foo"] = 1
+        d["bar"] = 2
+        d["moo"] = 3
+        d["foo"] = 4
+        assert d.keys() == ["bar", "moo", "foo"], d.keys()
+        assert d.popitem(last=False) == ("bar", 2) and d.popitem() == ("foo", 4)
+        assert d.pop("milk", None) is None and d.pop("moo") == 3 and len(d) == 0
+
+        s = SignatureCache(4)
+        s.add("foo")
+        s.add("bar")
+        s.add("moo")
+        assert "foo" in s and "bar" in s and "moo" in s
+        s.add("milk")
+        s.add("egg")
+        assert not "foo" in s, "foo was not used since the last generation"
+        assert s.info()["hits"] == 3 and s.info()["misses"] == 1, s.info()
+
+        k = SyncKeyCache(4)
+        k.set((1, 10), "digest-10")
+        k.set((1, 11), "digest-11")
+        k.set((1, 12), "digest-12")
+        assert k.get((1, 10)) == "digest-10"
+        k.discard((1, 11))
+        assert k.get((1, 11)) is None and len(k) == 2, len(k)
+
+        packets = dict((global_time, "packet-%d" % global_time) for global_time in xrange(1, 101))
+        def count_loader(time_low, time_high):
+            return [(global_time, 1) for global_time in sorted(packets) if time_low <= global_time <= time_high]
+        def packet_loader(time_low, time_high):
+            return [packet for global_time, packet in packets.iteritems() if time_low <= global_time <= time_high]
+        r = SyncRangeCache(1024, 0.01, 40, count_loader, packet_loader, prefix_count=1)
+        assert r.claim(1)[:2] == (1, 40), r.claim(1)[:2]
+        assert r.claim(90)[:2] == (81, None)
+        assert len(r.ranges) == 3 and r.info()["misses"] == 2
+        packets[101] = "packet-101"
+        r.add(101, packets[101])
+        _, _, bloom = r.claim(101)
+        assert "packet-101" in bloom and "packet-81" in bloom and r.info()["hits"] == 1
+        del packets[50]
+        r.invalidate([50])
+        assert r.claim(50)[:2] == (41, 80)
+        assert r.ranges[1].count == 39 and r.info()["recounts"] == 1, r.info()
+        assert r.claim(50, bloom_filter=False) == (41, 80, None)
+
+        s = SyncResponseCache(max_size=2)
+        s.set((1, 100, 2, 0), [("digest-2", 2), ("digest-4", 4)], s.version)
+        s.set((1, 100, 2, 1), [("digest-1", 1)], s.version)
+        assert s.get((1, 100, 2, 0)) == [("digest-2", 2), ("digest-4", 4)]
+        version = s.version
+        s.invalidate([3])
+        assert s.get((1, 100, 2, 1)) is None and len(s) == 1, "global time 3 is in the (%2 + 1) range"
+        s.set((1, 100, 2, 1), [("digest-1", 1)], version)
+        assert len(s) == 1, "rows selected before the invalidation must not be added"
+        s.set((1, 100, 2, 1), [], s.version)
+        s.committed()
+        assert s.get((1, 100, 2, 1)) is None and len(s) == 1, "rows selected before the commit must be removed"
+        version = s.version
+        s.committed()
+        assert s.version == version and len(s) == 1, "nothing was invalidated since the previous commit"
+
+        from hashlib import sha1
+        digests = dict((global_time, sha1(str(global_time)).digest()) for global_time in xrange(1, 1001))
+        def key_loader(time_low, time_high):
+            return [(global_time, digest) for global_time, digest in sorted(digests.iteritems()) if time_low <= global_time <= time_high]
+        def fingerprint(time_low, time_high):
+            xor = 0
+            for global_time, digest in key_loader(time_low, time_high):
+                xor ^= InvertibleBloomLookupTable.key(digest)
+            return len(key_loader(time_low, time_high)), xor
+        f = SyncFingerprintCache(key_loader, bucket_size=64)
+        assert f.fingerprint(10, 900) == fingerprint(10, 900)
+        assert f.fingerprint(1, 0) == fingerprint(1, 1000)
+        digests[1001] = sha1("1001").digest()
+        f.add(1001, digests[1001])
+        del digests[500]
+        f.invalidate([500])
+        assert f.fingerprint(10, 0) == fingerprint(10, 1001)
+        assert f.match(128, 255, fingerprint(128, 255)) and f.info()["matches"] == 1
@@ -109,6 +109,8 @@ class WalkCandidate(Candidate):
         self._associations = set()
         self._timestamps = dict()
         self._global_times = dict()
+        self._reconciliation = False
+        self._reconciliation_failed = False
 
         if __debug__:
             if not (self.sock_addr == self._lan_address or self.sock_addr == self._wan_address):
@@ -127,6 +129,34 @@ class WalkCandidate(Candidate):
     def connection_type(self):
         return self._connection_type
 
+    # @property
+    def __get_reconciliation(self):
+        """
+        True when the candidate announced that it accepts an InvertibleBloomLookupTable instead of
+        a sync bloom filter.
+        """
+        return self._reconciliation
+    # @reconciliation.setter
+    def __set_reconciliation(self, reconciliation):
+        assert isinstance(reconciliation, bool)
+        self._reconciliation = reconciliation
+    # .setter was introduced in Python 2.6
+    reconciliation = property(__get_reconciliation, __set_reconciliation)
+
+    # @property
+    def __get_reconciliation_failed(self):
+        """
+        True when an InvertibleBloomLookupTable from the candidate could not be decoded and the
+        candidate has not yet been told to send a bloom filter instead.
+        """
+        return self._reconciliation_failed
+    # @reconciliation_failed.setter
+    def __set_reconciliation_failed(self, reconciliation_failed):
+        assert isinstance(reconciliation_failed, bool)
+        self._reconciliation_failed = reconciliation_failed
+    # .setter was introduced in Python 2.6
+    reconciliation_failed = property(__get_reconciliation_failed, __set_reconciliation_failed)
+
     def get_destination_address(self, wan_address):
         assert is_address(wan_address), wan_address
         return self._lan_address if wan_address[0] == self._wan_address[0] else self._wan_address
@@ -134,6 +164,8 @@ class WalkCandidate(Candidate):
     def merge(self, other):
         assert isinstance(other, WalkCandidate), other
         self._associations.update(other._associations)
+        self._reconciliation = self._reconciliation or other._reconciliation
+        self._reconciliation_failed = self._reconciliation_failed or other._reconciliation_failed
         for cid, timestamps in other._timestamps.iteritems():
             if cid in self._timestamps:
                 self._timestamps[cid].merge(timestamps)
@@ -13,8 +13,8 @@ from itertools import islice
 from random import random, Random, randint
 from time import time
 
-from bloomfilter import BloomFilter
-from cache import CacheDict
+from bloomfilter import BloomFilter, BytearrayBloomFilter, DigestBloomFilter
+from cache import CacheDict, SyncFingerprintCache, SyncKeyCache, SyncRangeCache, SyncResponseCache
 from candidate import LoopbackCandidate
 from conversion import BinaryConversion, DefaultConversion
 from crypto import ec_generate_key, ec_to_public_bin, ec_to_private_bin
@@ -25,6 +25,7 @@ from distribution import SyncDistribution
 from math import ceil
 from member import DummyMember, Member
 from resolution import PublicResolution, LinearResolution, DynamicResolution
+from syncplanner import SyncPlanner
 from timeline import Timeline
 
 if __debug__:
@@ -267,6 +268,12 @@ class Community(object):
         if not self._master_member.public_key and self.dispersy_enable_candidate_walker and self.dispersy_auto_download_master_member:
             self._pending_callbacks.append(self._dispersy.callback.register(self._download_master_member_identity))
 
+        # the database containing the sync table of this community
+        if self.dispersy_community_database or self._dispersy.database.has_community_database(self._database_id):
+            self._sync_database = self._dispersy.database.open_community_database(self._database_id)
+        else:
+            self._sync_database = self._dispersy.database
+
         # pre-fetch some values from the database, this allows us to only query the database once
         self.meta_message_cache = {}
         for database_id, name, cluster, priority, direction in self._dispersy.database.execute(u"SELECT id, name, cluster, priority, direction FROM meta_message WHERE community = ?", (self._database_id,)):
@@ -286,7 +293,7 @@ class Community(object):
 
         # the global time.  zero indicates no messages are available, messages must have global
         # times that are higher than zero.
-        self._global_time, = self._dispersy.database.execute(u"SELECT MAX(global_time) FROM sync WHERE community = ?", (self._database_id,)).next()
+        self._global_time, = self._sync_database.execute(u"SELECT MAX(global_time) FROM sync WHERE community = ?", (self._database_id,)).next()
         if self._global_time is None:
             self._global_time = 0
         assert isinstance(self._global_time, (int, long))
@@ -317,6 +324,23 @@ class Community(object):
         self._random = Random(self._cid)
         self._nrsyncpackets = 0
 
+        # the sync ranges and their bloom filters.  created on the first claim
+        self._sync_range_cache = None
+
+        # the rows selected for recently requested sync ranges.  rows selected on the SyncResponder
+        # thread only contain committed packets, hence the cache is invalidated again on commit
+        self._sync_response_cache = SyncResponseCache()
+        self._dispersy.database.attach_commit_callback(self._sync_response_cache.committed)
+
+        # the fingerprints of the syncable packets.  created on the first fingerprint
+        self._sync_fingerprint_cache = None
+
+        # the keys of recently stored packets, used to detect duplicates
+        self._recent_sync_keys = SyncKeyCache()
+
+        # the number of new packets that claimed sync ranges produced
+        self._sync_planner = SyncPlanner(self._random)
+
     def _download_master_member_identity(self):
         assert not self._master_member.public_key
         if __debug__: dprint("using dummy master member")
@@ -391,8 +415,8 @@ class Community(object):
                 candidate = LoopbackCandidate()
 
                 # load all subjective sets by self.my_member
-                for packet, in self._dispersy.database.execute(u"SELECT packet FROM sync WHERE community = ? AND member = ? AND meta_message = ?",
-                                                               (self._database_id, self._my_member.database_id, meta.database_id)):
+                for packet, in self._sync_database.execute(u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? AND member = ? AND meta_message = ?",
+                                                           (self._database_id, self._my_member.database_id, meta.database_id)):
                     packet = str(packet)
 
                     # check that this is the packet we are looking for, i.e. has the right cluster
@@ -440,8 +464,8 @@ class Community(object):
         else:
             mapping = {authorize.database_id:authorize.handle_callback, revoke.database_id:revoke.handle_callback, dynamic_settings.database_id:dynamic_settings.handle_callback}
 
-            for packet, in list(self._dispersy.database.execute(u"SELECT packet FROM sync WHERE meta_message IN (?, ?, ?) ORDER BY global_time, packet",
-                                                                (authorize.database_id, revoke.database_id, dynamic_settings.database_id))):
+            for packet, in list(self._sync_database.execute(u"SELECT IFNULL(packet, segment_packet(location)) AS data FROM sync WHERE meta_message IN (?, ?, ?) ORDER BY global_time, data",
+                                                            (authorize.database_id, revoke.database_id, dynamic_settings.database_id))):
                 message = self._dispersy.convert_packet_to_message(str(packet), self, verify=False)
                 if message:
                     if __debug__: dprint("processing ", message.name)
@@ -538,6 +562,57 @@ class Community(object):
     #     """
     #     return 3
 
+    @property
+    def dispersy_sync_bloom_filter_digest(self):
+        """
+        True when the sync bloom filter contains packet digests instead of packets.
+
+        Filling a DigestBloomFilter only requires the digests stored in the database, not the
+        packets themselves.  However, peers running an older Dispersy version do not recognize the
+        digest flag in the dispersy-introduction-request message.  They will find all their packets
+        missing and respond with up to dispersy_sync_response_limit bytes every time.
+
+        Peers always respond correctly to both kinds of bloom filters.
+
+        @rtype: bool
+        """
+        return False
+
+    @property
+    def dispersy_sync_reconciliation(self):
+        """
+        True when we accept, and send, an InvertibleBloomLookupTable instead of a sync bloom filter.
+
+        Support is announced in every dispersy-introduction-request and
+        dispersy-introduction-response message.  A lookup table is only sent to candidates that
+        announced support, to all other candidates the sync bloom filter is sent.  The lookup table
+        uses the same number of bytes as the bloom filter and covers the same range, however, all
+        differences are found as long as they fit in the table, i.e. there are no false positives.
+
+        The bloom filter is sent instead when the range recently produced more new packets than the
+        table can decode, or when the candidate could not decode the previous lookup table.
+
+        @rtype: bool
+        """
+        return False
+
+    @property
+    def dispersy_community_database(self):
+        """
+        True when the messages of this community are stored in their own database file.
+
+        The community database contains the sync and reference_member_sync tables of this
+        community, see CommunityDatabase.  It is opened when the community is loaded and closed
+        when it is unloaded.  Messages that were stored in the Dispersy database before this was
+        enabled are moved into the community database when it is first opened.
+
+        Once the community database exists it remains in use, even when this property returns
+        False.
+
+        @rtype: bool
+        """
+        return False
+
     @property
     def dispersy_sync_bloom_filter_bits(self):
         """
@@ -569,18 +644,247 @@ class Community(object):
         """
         return (1500 - 60 - 8 - 51 - self._my_member.signature_length - 21 - 30) * 8
 
-    def dispersy_claim_sync_bloom_filter(self, identifier):
+    @property
+    def dispersy_sync_strategy(self):
+        """
+        The strategy used to claim sync ranges.
+
+        Each strategy is implemented by a dispersy_claim_sync_bloom_filter_<strategy> method, i.e.
+        u"adaptive", u"cached", u"simple", u"right", u"50_50", u"largest", or u"modulo".  The
+        SyncPlanner keeps the bytes per new packet for each strategy, allowing strategies to be
+        compared.
+        @rtype: unicode
+        """
+        return u"adaptive"
+
+    def dispersy_claim_sync_bloom_filter(self, identifier, bloom_filter=True):
         """
         Returns a (time_low, time_high, modulo, offset, bloom_filter) tuple or None.
+
+        When BLOOM_FILTER is False the caller intends to send an InvertibleBloomLookupTable.  The
+        adaptive and cached strategies then claim only the range and return None instead of a
+        bloom filter, see get_sync_bloom_filter.  BLOOM_FILTER is only given when
+        dispersy_sync_reconciliation is enabled, hence an override that accepts only IDENTIFIER
+        must be extended before enabling reconciliation.
+        """
+        strategy = self.dispersy_sync_strategy
+        if bloom_filter or not strategy in (u"adaptive", u"cached"):
+            sync = getattr(self, "dispersy_claim_sync_bloom_filter_" + strategy)()
+        else:
+            sync = getattr(self, "dispersy_claim_sync_bloom_filter_" + strategy)(bloom_filter=False)
+        self._sync_planner.claim(strategy, sync)
+        return sync
+
+    def get_sync_bloom_filter(self, sync):
+        """
+        Returns SYNC, as returned by dispersy_claim_sync_bloom_filter, with a bloom filter.
+        """
+        time_low, time_high, modulo, offset, bloom_filter = sync
+        if bloom_filter is None:
+            if self._sync_range_cache:
+                _, _, bloom_filter = self._sync_range_cache.claim(time_low)
+            else:
+                bloom_filter = BloomFilter(8, 0.1, prefix='\x00')
+        return time_low, time_high, modulo, offset, bloom_filter
+
+    @property
+    def sync_planner(self):
+        """
+        The SyncPlanner recording the number of new packets that claimed sync ranges produced.
+        @rtype: SyncPlanner
+        """
+        return self._sync_planner
+
+    @property
+    def recent_sync_keys(self):
+        """
+        The SyncKeyCache containing the (member database id, global time) keys of recently stored
+        packets that are not undone.
+        """
+        return self._recent_sync_keys
+
+    @property
+    def sync_range_cache(self):
+        """
+        The SyncRangeCache maintaining the sync bloom filters, or None when no filter was claimed.
+        """
+        return self._sync_range_cache
+
+    @property
+    def sync_response_cache(self):
+        """
+        The SyncResponseCache containing the rows selected for recently requested sync ranges.
+        @rtype: SyncResponseCache
         """
-        # return self.dispersy_claim_sync_bloom_filter_right()
-        # return self.dispersy_claim_sync_bloom_filter_50_50()
-        return self.dispersy_claim_sync_bloom_filter_largest()
-        # return self.dispersy_claim_sync_bloom_filter_simple()
+        return self._sync_response_cache
+
+    @property
+    def sync_fingerprint_cache(self):
+        """
+        The SyncFingerprintCache maintaining the range fingerprints, or None when no fingerprint
+        was requested.
+        """
+        return self._sync_fingerprint_cache
+
+    def get_sync_fingerprint(self, time_low, time_high):
+        """
+        Returns the (count, xor) fingerprint of the syncable packets in [TIME_LOW, TIME_HIGH], or
+        None when there are no syncable messages.  TIME_HIGH is zero when the range has no upper
+        bound.
+        """
+        if self._sync_fingerprint_cache is None:
+            self._sync_fingerprint_cache = self._create_sync_fingerprint_cache()
+        if self._sync_fingerprint_cache:
+            return self._sync_fingerprint_cache.fingerprint(time_low, time_high)
+        return None
+
+    def match_sync_fingerprint(self, time_low, time_high, fingerprint):
+        """
+        Returns True when FINGERPRINT equals the fingerprint of the syncable packets in
+        [TIME_LOW, TIME_HIGH].
+        """
+        if self._sync_fingerprint_cache is None:
+            self._sync_fingerprint_cache = self._create_sync_fingerprint_cache()
+        if self._sync_fingerprint_cache:
+            return self._sync_fingerprint_cache.match(time_low, time_high, fingerprint)
+        return False
+
+    def _create_sync_fingerprint_cache(self):
+        syncable_messages = u", ".join(unicode(meta.database_id) for meta in self._meta_messages.itervalues() if self._is_sync_range_meta(meta))
+        if not syncable_messages:
+            return None
+
+        execute = self._sync_database.execute
+        community_id = self._database_id
+
+        def key_loader(time_low, time_high):
+            return [(global_time, str(digest)) for global_time, digest in execute(u"SELECT global_time, digest FROM sync WHERE community = ? AND undone = 0 AND global_time BETWEEN ? AND ? AND meta_message IN (%s)" % syncable_messages,
+                                                                                  (community_id, time_low, time_high))]
+
+        return SyncFingerprintCache(key_loader)
+
+    def _is_sync_range_meta(self, meta):
+        return isinstance(meta.distribution, SyncDistribution) and meta.distribution.priority > 32
+
+    def _create_sync_range_cache(self):
+        syncable_messages = u", ".join(unicode(meta.database_id) for meta in self._meta_messages.itervalues() if self._is_sync_range_meta(meta))
+        if not syncable_messages:
+            return None
+
+        execute = self._sync_database.execute
+        community_id = self._database_id
+
+        def count_loader(time_low, time_high):
+            return list(execute(u"SELECT global_time, COUNT(*) FROM sync WHERE community = ? AND undone = 0 AND global_time BETWEEN ? AND ? AND meta_message IN (%s) GROUP BY global_time ORDER BY global_time" % syncable_messages,
+                                (community_id, time_low, time_high)))
+
+        if self.dispersy_sync_bloom_filter_digest:
+            bloom_class = DigestBloomFilter
+            key_column = u"digest"
+        else:
+            bloom_class = BytearrayBloomFilter
+            key_column = u"IFNULL(packet, segment_packet(location))"
+
+        def key_loader(time_low, time_high):
+            return (str(key) for key, in execute(u"SELECT %s FROM sync WHERE community = ? AND undone = 0 AND global_time BETWEEN ? AND ? AND meta_message IN (%s)" % (key_column, syncable_messages),
+                                                 (community_id, time_low, time_high)))
+
+        bits = self.dispersy_sync_bloom_filter_bits
+        error_rate = self.dispersy_sync_bloom_filter_error_rate
+        capacity = BloomFilter(bits, error_rate).get_capacity(error_rate)
+        return SyncRangeCache(bits, error_rate, capacity, count_loader, key_loader, bloom_class=bloom_class)
+
+    def update_sync_range(self, meta, global_times):
+        """
+        Notify that the packets of META at GLOBAL_TIMES were removed, undone, redone, or replaced.
+
+        The sync ranges containing these global times will be rebuilt from the database when they
+        are claimed.
+        """
+        if self._is_sync_range_meta(meta):
+            self._sync_response_cache.invalidate(global_times)
+            if self._sync_fingerprint_cache:
+                self._sync_fingerprint_cache.invalidate(global_times)
+            if self._sync_range_cache:
+                self._sync_range_cache.invalidate(global_times)
+
+    def extend_sync_range(self, meta, packets):
+        """
+        Notify that the (global_time, packet) tuples in PACKETS, all of META, were stored.
+        """
+        if self._is_sync_range_meta(meta):
+            self._sync_response_cache.invalidate([global_time for global_time, _ in packets])
+            if self._sync_fingerprint_cache:
+                for global_time, packet in packets:
+                    self._sync_fingerprint_cache.add(global_time, DigestBloomFilter.digest(packet))
+
+        if self._sync_range_cache and self._is_sync_range_meta(meta):
+            if self.dispersy_sync_bloom_filter_digest:
+                for global_time, packet in packets:
+                    self._sync_range_cache.add(global_time, DigestBloomFilter.digest(packet))
+            else:
+                for global_time, packet in packets:
+                    self._sync_range_cache.add(global_time, packet)
+
+    def reset_sync_range(self):
+        """
+        Notify that an unknown number of packets were removed.  All sync ranges will be rebuilt.
+        """
+        self._sync_response_cache.clear()
+        if self._sync_fingerprint_cache:
+            self._sync_fingerprint_cache.clear()
+        if self._sync_range_cache:
+            self._sync_range_cache.clear()
+
+    @runtime_duration_warning(0.5)
+    def dispersy_claim_sync_bloom_filter_adaptive(self, bloom_filter=True):
+        """
+        Claims a bloom filter from the SyncRangeCache, preferring ranges that recently produced new
+        packets.
+
+        The SyncPlanner chooses the pivot either from the ranges that produced new packets,
+        weighted by their yield, or uniformly from all global times.  The latter ensures that every
+        range is eventually synchronized.  Until any range produced new packets the pivot is chosen
+        as in dispersy_claim_sync_bloom_filter_cached.
+        """
+        return self.dispersy_claim_sync_bloom_filter_cached(self._sync_planner.choose_pivot(self.global_time), bloom_filter)
+
+    @runtime_duration_warning(0.5)
+    def dispersy_claim_sync_bloom_filter_cached(self, from_gbtime=None, bloom_filter=True):
+        """
+        Claims a bloom filter from the SyncRangeCache.
+
+        Unless FROM_GBTIME is given, the pivot is chosen as in
+        dispersy_claim_sync_bloom_filter_largest, the range is the cached range containing that
+        pivot.  Only ranges that changed since they were last claimed require database access.
+        When BLOOM_FILTER is False only the range is claimed.
+        """
+        acceptable_global_time = self.acceptable_global_time
+        if self._sync_range_cache is None:
+            self._sync_range_cache = self._create_sync_range_cache()
+
+        if self._sync_range_cache:
+            if from_gbtime is None:
+                desired_mean = self.global_time / 2.0
+                lambd = 1.0 / desired_mean
+                from_gbtime = self.global_time - int(self._random.expovariate(lambd))
+            if from_gbtime < 1:
+                from_gbtime = 1
+
+            time_low, time_high, bloom = self._sync_range_cache.claim(from_gbtime, bloom_filter)
+            if time_high is None:
+                time_high = acceptable_global_time
+
+            if __debug__: dprint(self.cid.encode("HEX"), " syncing %d-%d, pivot = %d"%(time_low, time_high, from_gbtime))
+            return (min(time_low, acceptable_global_time), min(time_high, acceptable_global_time), 1, 0, bloom)
+
+        elif __debug__:
+            dprint(self.cid.encode("HEX"), " NOT syncing no syncable messages")
+        return (1, acceptable_global_time, 1, 0, BloomFilter(8, 0.1, prefix='\x00') if bloom_filter else None)
 
     @runtime_duration_warning(0.5)
     def dispersy_claim_sync_bloom_filter_simple(self):
-        bloom = BloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate, prefix=chr(int(random() * 256)))
+        bloom = BytearrayBloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate, prefix=chr(int(random() * 256)))
         capacity = bloom.get_capacity(self.dispersy_sync_bloom_filter_error_rate)
         global_time = self.global_time
 
@@ -606,7 +910,7 @@ class Community(object):
         else:
             db_high = time_high
 
-        bloom.add_keys(str(packet) for packet, in self._dispersy.database.execute(u"SELECT sync.packet FROM sync JOIN meta_message ON meta_message.id = sync.meta_message WHERE sync.community = ? AND meta_message.priority > 32 AND NOT sync.undone AND global_time BETWEEN ? AND ?", (self._database_id, time_low, db_high)))
+        bloom.add_keys(str(packet) for packet, in self._sync_database.execute(u"SELECT IFNULL(sync.packet, segment_packet(sync.location)) FROM sync WHERE sync.community = ? AND sync.undone = 0 AND sync.priority > 32 AND global_time BETWEEN ? AND ?", (self._database_id, time_low, db_high)))
 
         import sys
         print >> sys.stderr, "Syncing %d-%d, capacity = %d, pivot = %d"%(time_low, time_high, capacity, time_low)
@@ -615,7 +919,7 @@ class Community(object):
     #choose a pivot, add all items capacity to the right. If too small, add items left of pivot
     @runtime_duration_warning(0.5)
     def dispersy_claim_sync_bloom_filter_right(self):
-        bloom = BloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate, prefix=chr(int(random() * 256)))
+        bloom = BytearrayBloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate, prefix=chr(int(random() * 256)))
         capacity = bloom.get_capacity(self.dispersy_sync_bloom_filter_error_rate)
 
         desired_mean = self.global_time / 2.0
@@ -669,7 +973,7 @@ class Community(object):
     #instead of pivot + capacity, divide capacity to have 50/50 divivion around pivot
     @runtime_duration_warning(0.5)
     def dispersy_claim_sync_bloom_filter_50_50(self):
-        bloom = BloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate, prefix=chr(int(random() * 256)))
+        bloom = BytearrayBloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate, prefix=chr(int(random() * 256)))
         capacity = bloom.get_capacity(self.dispersy_sync_bloom_filter_error_rate)
 
         desired_mean = self.global_time / 2.0
@@ -747,7 +1051,7 @@ class Community(object):
                 t2 = time()
 
             acceptable_global_time = self.acceptable_global_time
-            bloom = BloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate, prefix=chr(int(random() * 256)))
+            bloom = BytearrayBloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate, prefix=chr(int(random() * 256)))
             capacity = bloom.get_capacity(self.dispersy_sync_bloom_filter_error_rate)
 
             desired_mean = self.global_time / 2.0
@@ -823,10 +1127,10 @@ class Community(object):
             if __debug__:
                 t2 = time()
 
-            bloom = BloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate, prefix=chr(int(random() * 256)))
+            bloom = BytearrayBloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate, prefix=chr(int(random() * 256)))
             capacity = bloom.get_capacity(self.dispersy_sync_bloom_filter_error_rate)
 
-            self._nrsyncpackets = list(self._dispersy.database.execute(u"SELECT count(*) FROM sync WHERE meta_message IN (%s) AND undone = 0 LIMIT 1" % (syncable_messages)))[0][0]
+            self._nrsyncpackets = list(self._sync_database.execute(u"SELECT count(*) FROM sync WHERE community = ? AND undone = 0 AND meta_message IN (%s) LIMIT 1" % (syncable_messages), (self._database_id,)))[0][0]
             modulo = int(ceil(self._nrsyncpackets / float(capacity)))
             if modulo > 1:
                 offset = randint(0, modulo-1)
@@ -834,7 +1138,7 @@ class Community(object):
                 offset = 0
                 modulo = 1
 
-            bloom.add_keys(str(packet) for packet, in self._dispersy.database.execute(u"SELECT sync.packet FROM sync WHERE meta_message IN (%s) AND sync.undone = 0 AND sync.global_time > 0 AND (sync.global_time + ?) %% ? = 0" % syncable_messages, (offset, modulo)))
+            bloom.add_keys(str(packet) for packet, in self._sync_database.execute(u"SELECT IFNULL(sync.packet, segment_packet(sync.location)) FROM sync WHERE sync.community = ? AND sync.undone = 0 AND sync.meta_message IN (%s) AND sync.global_time > 0 AND (sync.global_time + ?) %% ? = 0" % syncable_messages, (self._database_id, offset, modulo)))
 
             if __debug__:
                 dprint(self.cid.encode("HEX"), " syncing %d-%d, nr_packets = %d, capacity = %d, totalnr = %d"%(modulo, offset, self._nrsyncpackets, capacity, self._nrsyncpackets))
@@ -849,11 +1153,11 @@ class Community(object):
     def _select_and_fix(self, syncable_messages, global_time, to_select, higher = True):
         assert isinstance(syncable_messages, unicode)
         if higher:
-            data = list(self._dispersy.database.execute(u"SELECT global_time, packet FROM sync WHERE meta_message IN (%s) AND undone = 0 AND global_time > ? ORDER BY global_time ASC LIMIT ?" % (syncable_messages),
-                                                    (global_time, to_select + 1)))
+            data = list(self._sync_database.execute(u"SELECT global_time, IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? AND undone = 0 AND global_time > ? AND meta_message IN (%s) ORDER BY global_time ASC LIMIT ?" % (syncable_messages),
+                                                    (self._database_id, global_time, to_select + 1)))
         else:
-            data = list(self._dispersy.database.execute(u"SELECT global_time, packet FROM sync WHERE meta_message IN (%s) AND undone = 0 AND global_time < ? ORDER BY global_time DESC LIMIT ?" % (syncable_messages),
-                                                    (global_time, to_select + 1)))
+            data = list(self._sync_database.execute(u"SELECT global_time, IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? AND undone = 0 AND global_time < ? AND meta_message IN (%s) ORDER BY global_time DESC LIMIT ?" % (syncable_messages),
+                                                    (self._database_id, global_time, to_select + 1)))
 
         fixed = False
         if len(data) > to_select:
@@ -964,7 +1268,7 @@ class Community(object):
 
     #         # get all the data associated to the time bloomfilter_range
     #         counter = 0
-    #         for packet, in self._dispersy.database.execute(u"SELECT sync.packet FROM sync JOIN meta_message ON meta_message.id = sync.meta_message WHERE sync.community = ? AND meta_message.priority > 32 AND sync.global_time BETWEEN ? AND ?",
+    #         for packet, in self._dispersy.database.execute(u"SELECT IFNULL(sync.packet, segment_packet(sync.location)) FROM sync JOIN meta_message ON meta_message.id = sync.meta_message WHERE sync.community = ? AND meta_message.priority > 32 AND sync.global_time BETWEEN ? AND ?",
     #                                                        (self._database_id, time_low, time_high)):
     #             bloom.add(str(packet))
     #             counter += 1
@@ -1078,6 +1382,17 @@ class Community(object):
     def database_version(self):
         return self._database_version
 
+    @property
+    def sync_database(self):
+        """
+        The database containing the sync and reference_member_sync tables of this community.
+
+        This is a CommunityDatabase when the community has its own database, see
+        dispersy_community_database, otherwise it is the DispersyDatabase.
+        @rtype: Database
+        """
+        return self._sync_database
+
     @property
     def master_member(self):
         """
@@ -1173,6 +1488,7 @@ class Community(object):
             self._dispersy.callback.unregister(id_)
         self._pending_callbacks = []
 
+        self._dispersy.database.detach_commit_callback(self._sync_response_cache.committed)
         self._dispersy.detach_community(self)
 
     def claim_global_time(self):
@@ -1263,8 +1579,8 @@ class Community(object):
 
             # cache fail... fetch from database.  note that we will add all clusters in the cache
             # regardless of the requested cluster
-            for packet, in self._dispersy.database.execute(u"SELECT packet FROM sync WHERE community = ? AND member = ? AND meta_message = ?",
-                                                           (self._database_id, member.database_id, subjective_set_message_id)):
+            for packet, in self._sync_database.execute(u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? AND member = ? AND meta_message = ?",
+                                                       (self._database_id, member.database_id, subjective_set_message_id)):
                 packet = str(packet)
 
                 # check that this is the packet we are looking for, i.e. has the right cluster
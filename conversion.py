@@ -5,7 +5,7 @@ from struct import pack, unpack_from, Struct
 from random import choice
 
 from authentication import NoAuthentication, MemberAuthentication, MultiMemberAuthentication
-from bloomfilter import BloomFilter
+from bloomfilter import BloomFilter, BytearrayBloomFilter, DigestBloomFilter, InvertibleBloomLookupTable
 from crypto import ec_check_public_bin
 from destination import MemberDestination, CommunityDestination, CandidateDestination, SubjectiveDestination
 from dispersydatabase import DispersyDatabase
@@ -100,6 +100,13 @@ class Conversion(object):
         assert data[:22] == self._prefix
         raise NotImplementedError("The subclass must implement decode_message")
 
+    def get_signature_triple(self, data):
+        """
+        Returns the (public_key, digest, signature) triple that must be verified before DATA can be
+        decoded, or None when this can not be determined without decoding DATA.
+        """
+        return None
+
     def encode_message(self, message):
         """
         Encode a Message instance into a binary string where the first byte is the on-the-wire
@@ -119,7 +126,7 @@ class BinaryConversion(Conversion):
     All data is encoded in a binary form.
     """
     class Placeholder(object):
-        __slots__ = ["candidate", "meta", "offset", "data", "authentication", "resolution", "first_signature_offset", "destination", "distribution", "payload", "verify", "allow_empty_signature"]
+        __slots__ = ["candidate", "meta", "offset", "data", "authentication", "resolution", "first_signature_offset", "destination", "distribution", "payload", "verify", "allow_empty_signature", "digest"]
 
         def __init__(self, candidate, meta, offset, data, verify, allow_empty_signature):
             self.candidate = candidate
@@ -134,6 +141,8 @@ class BinaryConversion(Conversion):
             self.destination = None
             self.distribution = None
             self.payload = None
+            # sha1 digest over DATA, only calculated when needed for the signature cache
+            self.digest = None
 
     class EncodeFunctions(object):
         __slots__ = ["byte", "authentication", "signature", "resolution", "distribution", "payload"]
@@ -164,6 +173,7 @@ class BinaryConversion(Conversion):
         self._struct_BBH = Struct(">BBH")
         self._struct_BH = Struct(">BH")
         self._struct_H = Struct(">H")
+        self._struct_LQ = Struct(">LQ")
         self._struct_LL = Struct(">LL")
         self._struct_Q = Struct(">Q")
         self._struct_QH = Struct(">QH")
@@ -185,10 +195,25 @@ class BinaryConversion(Conversion):
         # reserve 3rd bit for enable/disable tunnel (02/05/12)
         self._encode_tunnel_map = {True:int("100", 2), False:int("000", 2)}
         self._decode_tunnel_map = dict((value, key) for key, value in self._encode_tunnel_map.iteritems())
-        # 4th, 5th and 6th bits are currently unused
+        # reserve 4th bit for packet/digest sync bloom filter (see DigestBloomFilter)
+        self._encode_digest_map = {True:int("1000", 2), False:int("0000", 2)}
+        self._decode_digest_map = dict((value, key) for key, value in self._encode_digest_map.iteritems())
+        # reserve 5th bit for supporting reconciliation, i.e. accepting an InvertibleBloomLookupTable
+        # instead of a sync bloom filter.  peers that do not support reconciliation ignore this bit
+        self._encode_reconciliation_map = {True:int("10000", 2), False:int("00000", 2)}
+        self._decode_reconciliation_map = dict((value, key) for key, value in self._encode_reconciliation_map.iteritems())
+        # reserve 6th bit for bloom filter/InvertibleBloomLookupTable sync.  this bit may only be
+        # set when the receiver supports reconciliation
+        self._encode_lookup_table_map = {True:int("100000", 2), False:int("000000", 2)}
+        self._decode_lookup_table_map = dict((value, key) for key, value in self._encode_lookup_table_map.iteritems())
         # reserve 7th and 8th bits for connection type
         self._encode_connection_type_map = {u"unknown":int("00000000", 2), u"public":int("10000000", 2), u"symmetric-NAT":int("11000000", 2)}
         self._decode_connection_type_map = dict((value, key) for key, value in self._encode_connection_type_map.iteritems())
+        # all flag bits are in use, hence the sync range fingerprint is indicated in the functions
+        # byte of an InvertibleBloomLookupTable sync, which uses at most three bits.  reserve its
+        # 8th bit for a fingerprint following the lookup table
+        self._encode_fingerprint_map = {True:int("10000000", 2), False:int("00000000", 2)}
+        self._decode_fingerprint_map = dict((value, key) for key, value in self._encode_fingerprint_map.iteritems())
 
         def define(value, name, encode, decode):
             try:
@@ -745,11 +770,13 @@ class BinaryConversion(Conversion):
             raise DropPacket("Invalid global time (trying to apply undo to the future)")
 
         try:
-            packet_id, message_name, packet_data = self._dispersy_database.execute(u"SELECT sync.id, meta_message.name, sync.packet FROM sync JOIN meta_message ON meta_message.id = sync.meta_message WHERE sync.community = ? AND sync.member = ? AND sync.global_time = ?",
-                                                                                   (self._community.database_id, member.database_id, global_time)).next()
+            packet_id, meta_message_id, packet_data = self._community.sync_database.execute(u"SELECT id, meta_message, IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? AND member = ? AND global_time = ?",
+                                                                                            (self._community.database_id, member.database_id, global_time)).next()
         except StopIteration:
             raise DelayPacketByMissingMessage(self._community, member, global_time)
 
+        # the sync table may be in a community database, see Community.dispersy_community_database
+        message_name, = self._dispersy_database.execute(u"SELECT name FROM meta_message WHERE id = ?", (meta_message_id,)).next()
         packet = Packet(self._community.get_meta_message(message_name), str(packet_data), packet_id)
 
         return offset, placeholder.meta.payload.Implementation(placeholder.meta.payload, member, global_time, packet)
@@ -787,11 +814,13 @@ class BinaryConversion(Conversion):
             raise DropPacket("Invalid global time (trying to apply undo to the future)")
 
         try:
-            packet_id, message_name, packet_data = self._dispersy_database.execute(u"SELECT sync.id, meta_message.name, sync.packet FROM sync JOIN meta_message ON meta_message.id = sync.meta_message WHERE sync.community = ? AND sync.member = ? AND sync.global_time = ?",
-                                                                                   (self._community.database_id, member.database_id, global_time)).next()
+            packet_id, meta_message_id, packet_data = self._community.sync_database.execute(u"SELECT id, meta_message, IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? AND member = ? AND global_time = ?",
+                                                                                            (self._community.database_id, member.database_id, global_time)).next()
         except StopIteration:
             raise DelayPacketByMissingMessage(self._community, member, global_time)
 
+        # the sync table may be in a community database, see Community.dispersy_community_database
+        message_name, = self._dispersy_database.execute(u"SELECT name FROM meta_message WHERE id = ?", (meta_message_id,)).next()
         packet = Packet(self._community.get_meta_message(message_name), str(packet_data), packet_id)
 
         return offset, placeholder.meta.payload.Implementation(placeholder.meta.payload, member, global_time, packet)
@@ -864,11 +893,21 @@ class BinaryConversion(Conversion):
         data = [inet_aton(payload.destination_address[0]), self._struct_H.pack(payload.destination_address[1]),
                 inet_aton(payload.source_lan_address[0]), self._struct_H.pack(payload.source_lan_address[1]),
                 inet_aton(payload.source_wan_address[0]), self._struct_H.pack(payload.source_wan_address[1]),
-                self._struct_B.pack(self._encode_advice_map[payload.advice] | self._encode_connection_type_map[payload.connection_type] | self._encode_sync_map[payload.sync]),
+                self._struct_B.pack(self._encode_advice_map[payload.advice] | self._encode_connection_type_map[payload.connection_type] | self._encode_sync_map[payload.sync] | self._encode_digest_map[payload.sync and isinstance(payload.bloom_filter, DigestBloomFilter)] | self._encode_reconciliation_map[payload.reconciliation] | self._encode_lookup_table_map[payload.sync and isinstance(payload.bloom_filter, InvertibleBloomLookupTable)]),
                 self._struct_H.pack(payload.identifier)]
 
         # add optional sync
-        if payload.sync:
+        if payload.sync and isinstance(payload.bloom_filter, InvertibleBloomLookupTable):
+            assert 0 < payload.bloom_filter.cells < 2**16
+            assert len(payload.bloom_filter.prefix) == 1, "must have a one character prefix"
+            data.extend((self._struct_QQHHBH.pack(payload.time_low, payload.time_high, payload.modulo, payload.offset, payload.bloom_filter.functions | self._encode_fingerprint_map[payload.fingerprint is not None], payload.bloom_filter.cells),
+                         payload.bloom_filter.prefix, payload.bloom_filter.bytes))
+
+            # add optional fingerprint
+            if payload.fingerprint:
+                data.append(self._struct_LQ.pack(*payload.fingerprint))
+
+        elif payload.sync:
             assert payload.bloom_filter.size % 8 == 0
             assert 0 < payload.bloom_filter.functions < 256, "assuming that we choose BITS to ensure the bloom filter will fit in one MTU, it is unlikely that there will be more than 255 functions.  hence we can encode this in one byte"
             assert len(payload.bloom_filter.prefix) == 1, "must have a one character prefix"
@@ -902,10 +941,51 @@ class BinaryConversion(Conversion):
         if connection_type is None:
             raise DropPacket("Invalid connection type flag")
 
+        reconciliation = self._decode_reconciliation_map[flags & int("10000", 2)]
+        fingerprint = None
+
         sync = self._decode_sync_map.get(flags & int("10", 2))
         if sync is None:
             raise DropPacket("Invalid sync flag")
-        if sync:
+        if sync and self._decode_lookup_table_map[flags & int("100000", 2)]:
+            if len(data) < offset + 24:
+                raise DropPacket("Insufficient packet size")
+
+            time_low, time_high, modulo, modulo_offset, functions, cells = self._struct_QQHHBH.unpack_from(data, offset)
+            offset += 23
+            has_fingerprint = self._decode_fingerprint_map[functions & int("10000000", 2)]
+            functions &= int("01111111", 2)
+
+            prefix = data[offset]
+            offset += 1
+
+            if not time_low > 0:
+                raise DropPacket("Invalid time_low value")
+            if not (time_high == 0 or time_low <= time_high):
+                raise DropPacket("Invalid time_high value")
+            if not 0 < modulo:
+                raise DropPacket("Invalid modulo value")
+            if not 0 <= modulo_offset < modulo:
+                raise DropPacket("Invalid offset value")
+            if not 0 < functions <= 4:
+                raise DropPacket("Invalid functions value")
+            if not (0 < cells and cells % functions == 0):
+                raise DropPacket("Invalid cells value")
+
+            length = cells * InvertibleBloomLookupTable.cell_size
+            if not length + (12 if has_fingerprint else 0) == len(data) - offset:
+                raise DropPacket("Invalid number of bytes available")
+
+            bloom_filter = InvertibleBloomLookupTable(data[offset:offset + length], functions, prefix=prefix)
+            offset += length
+
+            if has_fingerprint:
+                fingerprint = self._struct_LQ.unpack_from(data, offset)
+                offset += 12
+
+            sync = (time_low, time_high, modulo, modulo_offset, bloom_filter)
+
+        elif sync:
             if len(data) < offset + 24:
                 raise DropPacket("Insufficient packet size")
 
@@ -934,7 +1014,10 @@ class BinaryConversion(Conversion):
             if not length == len(data) - offset:
                 raise DropPacket("Invalid number of bytes available")
 
-            bloom_filter = BloomFilter(data[offset:offset + length], functions, prefix=prefix)
+            if self._decode_digest_map[flags & int("1000", 2)]:
+                bloom_filter = DigestBloomFilter(data[offset:offset + length], functions, prefix=prefix)
+            else:
+                bloom_filter = BytearrayBloomFilter(data[offset:offset + length], functions, prefix=prefix)
             offset += length
 
             sync = (time_low, time_high, modulo, modulo_offset, bloom_filter)
@@ -942,7 +1025,10 @@ class BinaryConversion(Conversion):
         else:
             sync = None
 
-        return offset, placeholder.meta.payload.Implementation(placeholder.meta.payload, destination_address, source_lan_address, source_wan_address, advice, connection_type, sync, identifier)
+        if fingerprint and not (sync and sync[2] == 1):
+            raise DropPacket("Invalid fingerprint, requires a sync range with modulo one")
+
+        return offset, placeholder.meta.payload.Implementation(placeholder.meta.payload, destination_address, source_lan_address, source_wan_address, advice, connection_type, sync, identifier, reconciliation, fingerprint)
 
     def _encode_introduction_response(self, message):
         payload = message.payload
@@ -951,7 +1037,7 @@ class BinaryConversion(Conversion):
                 inet_aton(payload.source_wan_address[0]), self._struct_H.pack(payload.source_wan_address[1]),
                 inet_aton(payload.lan_introduction_address[0]), self._struct_H.pack(payload.lan_introduction_address[1]),
                 inet_aton(payload.wan_introduction_address[0]), self._struct_H.pack(payload.wan_introduction_address[1]),
-                self._struct_B.pack(self._encode_connection_type_map[payload.connection_type] | self._encode_tunnel_map[payload.tunnel]),
+                self._struct_B.pack(self._encode_connection_type_map[payload.connection_type] | self._encode_tunnel_map[payload.tunnel] | self._encode_reconciliation_map[payload.reconciliation]),
                 self._struct_H.pack(payload.identifier))
 
     def _decode_introduction_response(self, placeholder, offset, data):
@@ -984,7 +1070,9 @@ class BinaryConversion(Conversion):
         if tunnel is None:
             raise DropPacket("Invalid tunnel flag")
 
-        return offset, placeholder.meta.payload.Implementation(placeholder.meta.payload, destination_address, source_lan_address, source_wan_address, lan_introduction_address, wan_introduction_address, connection_type, tunnel, identifier)
+        reconciliation = self._decode_reconciliation_map[flags & int("10000", 2)]
+
+        return offset, placeholder.meta.payload.Implementation(placeholder.meta.payload, destination_address, source_lan_address, source_wan_address, lan_introduction_address, wan_introduction_address, connection_type, tunnel, identifier, reconciliation)
 
     def _encode_puncture_request(self, message):
         payload = message.payload
@@ -1203,6 +1291,28 @@ class BinaryConversion(Conversion):
 
         placeholder.resolution = DynamicResolution.Implementation(placeholder.meta.resolution, policy)
 
+    def _verify_signature(self, placeholder, member, signature_offset, length):
+        """
+        Returns True when the signature at SIGNATURE_OFFSET, made by MEMBER over the first LENGTH
+        bytes of the packet, is valid.
+
+        Signatures that were recently verified are found in the Dispersy signature cache and are
+        not verified again.
+        """
+        data = placeholder.data
+        signature_cache = self._community.dispersy.signature_cache
+        if placeholder.digest is None:
+            placeholder.digest = sha1(data).digest()
+        key = (member.mid, placeholder.digest, signature_offset)
+        if key in signature_cache:
+            return True
+
+        if member.verify(data, data[signature_offset:signature_offset+member.signature_length], length=length):
+            signature_cache.add(key)
+            return True
+
+        return False
+
     def _decode_no_authentication(self, placeholder):
         placeholder.first_signature_offset = len(placeholder.data)
         placeholder.authentication = NoAuthentication.Implementation(placeholder.meta.authentication)
@@ -1226,7 +1336,7 @@ class BinaryConversion(Conversion):
             # identifier
             for member in members:
                 first_signature_offset = len(data) - member.signature_length
-                if (not placeholder.verify and len(members) == 1) or member.verify(data, data[first_signature_offset:], length=first_signature_offset):
+                if (not placeholder.verify and len(members) == 1) or self._verify_signature(placeholder, member, first_signature_offset, first_signature_offset):
                     placeholder.offset = offset
                     placeholder.first_signature_offset = first_signature_offset
                     placeholder.authentication = MemberAuthentication.Implementation(authentication, member, is_signed=True)
@@ -1254,7 +1364,7 @@ class BinaryConversion(Conversion):
 
             # signatures are enabled, verify that the signature matches the member sha1
             # identifier
-            if not placeholder.verify or member.verify(data, data[first_signature_offset:], length=first_signature_offset):
+            if not placeholder.verify or self._verify_signature(placeholder, member, first_signature_offset, first_signature_offset):
                 placeholder.offset = offset
                 placeholder.first_signature_offset = first_signature_offset
                 placeholder.authentication = MemberAuthentication.Implementation(authentication, member, is_signed=True)
@@ -1307,7 +1417,7 @@ class BinaryConversion(Conversion):
                 if placeholder.allow_empty_signature and signature == "\x00" * member.signature_length:
                     signatures[index] = signature
 
-                elif (not placeholder.verify and len(members) == 1) or member.verify(data, data[signature_offset:signature_offset+member.signature_length], length=first_signature_offset):
+                elif (not placeholder.verify and len(members) == 1) or self._verify_signature(placeholder, member, signature_offset, first_signature_offset):
                     signatures[index] = signature
 
                 else:
@@ -1426,6 +1536,54 @@ class BinaryConversion(Conversion):
         assert isinstance(verify, bool)
         return self._decode_message(candidate, data, verify, False)
 
+    def get_signature_triple(self, data):
+        """
+        Returns the (public_key, digest, signature) triple that must be verified before DATA can be
+        decoded, or None when this can not be determined without decoding DATA.
+
+        Only messages that use MemberAuthentication are supported.  When the sha1 encoding is used
+        the member must be unambiguous, i.e. only one member with this sha1 has an identity in the
+        community.  Once the triple is verified DATA can be decoded using verify=False, this results
+        in the same member being used as when the signature is verified during decoding.
+        """
+        assert isinstance(data, str), data
+        assert data[:22] == self._prefix, (data[:22].encode("HEX"), self._prefix.encode("HEX"))
+
+        if len(data) < 23:
+            return None
+        decode_functions = self._decode_message_map.get(data[22])
+        if decode_functions is None:
+            return None
+
+        authentication = decode_functions.meta.authentication
+        if not isinstance(authentication, MemberAuthentication):
+            return None
+
+        if authentication.encoding == "sha1":
+            if len(data) < 43:
+                return None
+            members = [member for member in self._community.dispersy.get_members_from_id(data[23:43]) if member.has_identity(self._community)]
+            if len(members) != 1:
+                return None
+            member = members[0]
+
+        else:
+            assert authentication.encoding == "bin", authentication.encoding
+            if len(data) < 25:
+                return None
+            key_length, = self._struct_H.unpack_from(data, 23)
+            if len(data) < 25 + key_length:
+                return None
+            key = data[25:25+key_length]
+            if not ec_check_public_bin(key):
+                return None
+            member = self._community.dispersy.get_member(key)
+
+        first_signature_offset = len(data) - member.signature_length
+        if first_signature_offset < 23:
+            return None
+        return member.public_key, sha1(data[:first_signature_offset]).digest(), data[first_signature_offset:]
+
 class DefaultConversion(BinaryConversion):
     """
     This conversion class is initially used to encode some Dispersy
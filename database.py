@@ -10,6 +10,9 @@ import thread
 import hashlib
 import sqlite3
 
+from re import compile as re_compile
+from time import time
+
 from singleton import Singleton
 
 if __debug__:
@@ -29,6 +32,147 @@ class IgnoreCommits(Exception):
     def __init__(self):
         super(IgnoreCommits, self).__init__("Ignore all commits made within __enter__ and __exit__")
 
+class StatementStatistics(object):
+    """
+    Call count, duration, and returned rows for one normalized SQL statement.
+
+    The most recent SAMPLE_SIZE durations are kept to estimate the latency percentiles.
+    """
+    sample_size = 256
+
+    def __init__(self):
+        self.count = 0
+        self.rows = 0
+        self.duration = 0.0
+        self.max_duration = 0.0
+        self._samples = []
+        self._index = 0
+
+    def add(self, duration, rows):
+        self.count += 1
+        self.rows += rows
+        self.duration += duration
+        if duration > self.max_duration:
+            self.max_duration = duration
+        if len(self._samples) < self.sample_size:
+            self._samples.append(duration)
+        else:
+            self._samples[self._index] = duration
+            self._index = (self._index + 1) % self.sample_size
+
+    def info(self):
+        samples = sorted(self._samples)
+        def percentile(fraction):
+            return samples[min(len(samples) - 1, int(len(samples) * fraction))] if samples else 0.0
+        return {"count":self.count,
+                "rows":self.rows,
+                "duration":self.duration,
+                "max":self.max_duration,
+                "p50":percentile(0.5),
+                "p90":percentile(0.9),
+                "p99":percentile(0.99)}
+
+class StatementCursor(object):
+    """
+    Wraps the sqlite3 cursor returned by Database.execute to count the rows and the time spent
+    retrieving them.
+
+    The statement is accounted for when the Database executes the next statement, at that point
+    the shared cursor can no longer be used to retrieve rows.  All other attributes are taken from
+    the wrapped cursor.
+    """
+    __slots__ = ("_cursor", "statistics", "duration", "rows")
+
+    def __init__(self, cursor, statistics, duration, rows):
+        self._cursor = cursor
+        self.statistics = statistics
+        self.duration = duration
+        self.rows = rows
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        start = time()
+        row = self._cursor.next()
+        self.duration += time() - start
+        self.rows += 1
+        return row
+
+    def fetchone(self):
+        try:
+            return self.next()
+        except StopIteration:
+            return None
+
+    def fetchall(self):
+        return list(self)
+
+class DatabaseReader(object):
+    """
+    A read-only connection to the file of a Database.
+
+    The Database and its cursor may only be used from the thread that created them.  A
+    DatabaseReader has its own connection, allowing another thread to run SELECT queries while the
+    Database is used to write.  This requires the Database to use write-ahead logging, see
+    Database.enable_write_ahead_log, otherwise the reader and the writer will block each other.
+
+    A DatabaseReader must be created, used, and closed on one and the same thread.
+    """
+    def __init__(self, file_path):
+        """
+        Initialize a new DatabaseReader instance.
+
+        @param file_path: the path to the database file.
+        @type file_path: unicode
+        """
+        if __debug__:
+            assert isinstance(file_path, unicode)
+            dprint(file_path)
+            self._debug_thread_ident = thread.get_ident()
+        self._file_path = file_path
+        self._connection = sqlite3.Connection(file_path)
+        self._cursor = self._connection.cursor()
+        self._cursor.execute(u"PRAGMA query_only = 1")
+
+    def execute(self, statement, bindings=()):
+        """
+        Execute one SQL query.
+
+        See Database.execute for the restrictions on STATEMENT and BINDINGS.  Only statements that
+        do not modify the database are allowed.
+        """
+        assert self._debug_thread_ident == thread.get_ident(), "Calling DatabaseReader.execute on the wrong thread"
+        assert isinstance(statement, unicode), "The SQL statement must be given in unicode"
+        assert isinstance(bindings, (tuple, list, dict)), "The bindings must be a tuple, list, or dictionary"
+
+        try:
+            if __debug__: dprint(statement, " <-- ", bindings)
+            return self._cursor.execute(statement, bindings)
+
+        except sqlite3.Error:
+            if __debug__:
+                dprint(exception=True, level="warning")
+                dprint("Filename: ", self._file_path, level="warning")
+                dprint(statement, level="warning")
+                dprint(bindings, level="warning")
+            raise
+
+    def create_function(self, name, num_params, func):
+        """
+        Make FUNC available as the SQL function NAME, see Database.create_function.
+        """
+        assert self._debug_thread_ident == thread.get_ident(), "Calling DatabaseReader.create_function on the wrong thread"
+        self._connection.create_function(name, num_params, func)
+
+    def close(self):
+        assert self._debug_thread_ident == thread.get_ident(), "Calling DatabaseReader.close on the wrong thread"
+        self._cursor.close()
+        self._connection.close()
+
 class Database(Singleton):
     def __init__(self, file_path):
         """
@@ -42,6 +186,7 @@ class Database(Singleton):
             dprint(file_path)
             self._debug_thread_ident = thread.get_ident()
         self._file_path = file_path
+        self._closed = False
 
         self._connection = sqlite3.Connection(file_path)
         # self._connection.setrollbackhook(self._on_rollback)
@@ -49,11 +194,33 @@ class Database(Singleton):
 
         # _commit_callbacks contains a list with functions that are called on each database commit
         self._commit_callbacks = []
+        # _before_commit_callbacks contains a list with functions that are called before each
+        # database commit
+        self._before_commit_callbacks = []
 
         # Database.commit() is enabled when _pending_commits == 0.  Database.commit() is disabled
         # when _pending_commits > 0.  A commit is required when _pending_commits > 1.
         self._pending_commits = 0
 
+        # group commit: when _group_commit_latency is None the changes are only committed when a
+        # caller requires them to be durable.  Otherwise they are committed once
+        # _group_commit_max_pending_rows rows are pending or, see Database.group_commit_pending,
+        # once _group_commit_latency seconds have passed
+        self._group_commit_latency = None
+        self._group_commit_max_pending_rows = 0
+        self._group_commit_pending_rows = 0
+        # _durability_callbacks contains (func, args) tuples that are called once, after the next
+        # database commit
+        self._durability_callbacks = []
+
+        # _statement_statistics contains a StatementStatistics instance for each normalized
+        # statement, _statement_cursor is the most recent StatementCursor, it is accounted for when
+        # the next statement is executed
+        self._statement_statistics = {}
+        self._statement_cursor = None
+        self._normalize_cache = {}
+        self._statement_statistics_start = time()
+
         #
         # PRAGMA synchronous = 0 | OFF | 1 | NORMAL | 2 | FULL;
         #
@@ -102,6 +269,62 @@ class Database(Singleton):
     def database_version(self):
         return self._database_version
 
+    # matches a sequence of placeholders, i.e. 'IN (?, ?, ?)', and integer literals
+    _normalize_placeholders = re_compile(r"\?(?:\s*,\s*\?)+")
+    _normalize_integers = re_compile(r"\b\d+\b")
+
+    def _get_statement_statistics(self, statement):
+        """
+        Returns the StatementStatistics for the normalized STATEMENT.
+
+        Statements are normalized by collapsing whitespace, placeholder lists, and integer literals,
+        such that 'IN (?, ?)' and 'IN (?, ?, ?)' are counted as the same statement.
+        """
+        try:
+            key = self._normalize_cache[statement]
+        except KeyError:
+            key = self._normalize_integers.sub(u"?", self._normalize_placeholders.sub(u"?, ...", u" ".join(statement.split())))
+            if len(self._normalize_cache) >= 1024:
+                self._normalize_cache.clear()
+            self._normalize_cache[statement] = key
+
+        try:
+            return self._statement_statistics[key]
+        except KeyError:
+            statistics = self._statement_statistics[key] = StatementStatistics()
+            return statistics
+
+    def _finish_statement(self):
+        """
+        Account for the most recent Database.execute statement.
+        """
+        cursor = self._statement_cursor
+        if cursor:
+            self._statement_cursor = None
+            cursor.statistics.add(cursor.duration, cursor.rows)
+
+    def statement_info(self):
+        """
+        Returns the statistics for each normalized statement executed since the last reset.
+
+        Commits are reported as the 'COMMIT' statement.
+        """
+        self._finish_statement()
+        return {"start":self._statement_statistics_start,
+                "runtime":time() - self._statement_statistics_start,
+                "statements":dict((key, statistics.info()) for key, statistics in self._statement_statistics.iteritems())}
+
+    def reset_statement_statistics(self):
+        """
+        Returns, and subsequently removes, the statistics for each normalized statement.
+        """
+        try:
+            return self.statement_info()
+
+        finally:
+            self._statement_statistics = {}
+            self._statement_statistics_start = time()
+
     def file_path(self):
         """
         The database filename including path.
@@ -140,7 +363,7 @@ class Database(Singleton):
             return True
         else:
             if __debug__: dprint("ROLLBACK", level="error")
-            self._connection.rollback()
+            self.rollback()
             return False
 
     @property
@@ -192,9 +415,12 @@ class Database(Singleton):
         assert isinstance(bindings, (tuple, list, dict)), "The bindings must be a tuple, list, or dictionary"
         assert all(lambda x: isinstance(x, str) for x in bindings), "The bindings may not contain a string. \nProvide unicode for TEXT and buffer(...) for BLOB. \nGiven types: %s" % str([type(binding) for binding in bindings])
 
+        self._finish_statement()
+        statistics = self._get_statement_statistics(statement)
         try:
             if __debug__: dprint(statement, " <-- ", bindings)
-            return self._cursor.execute(statement, bindings)
+            start = time()
+            cursor = self._cursor.execute(statement, bindings)
 
         except sqlite3.Error:
             if __debug__:
@@ -204,13 +430,22 @@ class Database(Singleton):
                 dprint(bindings, level="warning")
             raise
 
+        # rowcount is -1 for SELECT statements, their rows are counted while they are retrieved
+        self._statement_cursor = StatementCursor(cursor, statistics, time() - start, max(0, cursor.rowcount))
+        return self._statement_cursor
+
     def executescript(self, statements):
         assert self._debug_thread_ident == thread.get_ident(), "Calling Database.execute on the wrong thread"
         assert isinstance(statements, unicode), "The SQL statement must be given in unicode"
 
+        self._finish_statement()
+        statistics = self._get_statement_statistics(statements)
         try:
             if __debug__: dprint(statements)
-            return self._cursor.executescript(statements)
+            start = time()
+            result = self._cursor.executescript(statements)
+            statistics.add(time() - start, 0)
+            return result
 
         except sqlite3.Error:
             if __debug__:
@@ -256,9 +491,14 @@ class Database(Singleton):
         assert all(isinstance(x, (tuple, list, dict)) for x in list(sequenceofbindings)), "The sequenceofbindings must be a list with tuples, lists, or dictionaries"
         assert not filter(lambda x: filter(lambda y: isinstance(y, str), x), list(sequenceofbindings)), "The bindings may not contain a string. \nProvide unicode for TEXT and buffer(...) for BLOB."
 
+        self._finish_statement()
+        statistics = self._get_statement_statistics(statement)
         try:
             if __debug__: dprint(statement)
-            return self._cursor.executemany(statement, sequenceofbindings)
+            start = time()
+            result = self._cursor.executemany(statement, sequenceofbindings)
+            statistics.add(time() - start, max(0, self._cursor.rowcount))
+            return result
 
         except sqlite3.Error:
             if __debug__:
@@ -277,14 +517,165 @@ class Database(Singleton):
 
         else:
             if __debug__: dprint("COMMIT")
+            for callback in self._before_commit_callbacks:
+                callback()
+            self._finish_statement()
+            start = time()
             result = self._connection.commit()
+            self._get_statement_statistics(u"COMMIT").add(time() - start, self._group_commit_pending_rows)
             for callback in self._commit_callbacks:
                 try:
                     callback()
                 except Exception:
                     if __debug__: dprint(exception=True, stack=True)
+
+            self._group_commit_pending_rows = 0
+            if self._durability_callbacks:
+                durability_callbacks, self._durability_callbacks = self._durability_callbacks, []
+                for func, args in durability_callbacks:
+                    try:
+                        func(*args)
+                    except Exception:
+                        if __debug__: dprint(exception=True, stack=True)
             return result
 
+    def rollback(self):
+        """
+        Undo all changes made since the previous commit.
+        """
+        assert self._debug_thread_ident == thread.get_ident(), "Calling Database.rollback on the wrong thread"
+        self._finish_statement()
+        self._connection.rollback()
+        # the changes that the durability callbacks were waiting for no longer exist
+        self._group_commit_pending_rows = 0
+        self._durability_callbacks = []
+
+    def set_group_commit(self, max_latency, max_pending_rows):
+        """
+        Enable or disable group commits.
+
+        When MAX_LATENCY is None, group commits are disabled and Database.group_commit will commit
+        immediately when durability is required.  Otherwise changes are committed once
+        MAX_PENDING_ROWS rows are pending, or MAX_LATENCY seconds after they were made.  The latter
+        requires the caller to call Database.flush_group_commit, see Database.group_commit_pending.
+
+        @param max_latency: the maximum number of seconds that a change remains uncommitted, or None.
+        @type max_latency: float or None
+
+        @param max_pending_rows: the maximum number of uncommitted rows.
+        @type max_pending_rows: int
+        """
+        assert max_latency is None or isinstance(max_latency, float), type(max_latency)
+        assert max_latency is None or max_latency > 0.0, max_latency
+        assert isinstance(max_pending_rows, int), type(max_pending_rows)
+        assert max_pending_rows > 0, max_pending_rows
+        self._group_commit_latency = max_latency
+        self._group_commit_max_pending_rows = max_pending_rows
+
+    @property
+    def group_commit_latency(self):
+        """
+        The maximum number of seconds that a change remains uncommitted, or None when group commits
+        are disabled.
+        @rtype: float or None
+        """
+        return self._group_commit_latency
+
+    @property
+    def group_commit_pending(self):
+        """
+        True when there are rows or durability callbacks waiting for a commit.
+        @rtype: bool
+        """
+        return bool(self._group_commit_pending_rows or self._durability_callbacks)
+
+    def group_commit(self, rows, durable=False, func=None, args=()):
+        """
+        Register ROWS changed rows that must be committed as part of a group commit.
+
+        When DURABLE is True, or when FUNC is given, the caller requires the changes to be durable.
+        FUNC(*ARGS) is called once the changes are committed.  Without group commits this results
+        in an immediate commit, otherwise the commit occurs once enough rows are pending or, using
+        Database.flush_group_commit, once the maximum latency has passed.
+
+        Returns True when the changes were committed during this call.
+        @rtype: bool
+        """
+        assert self._debug_thread_ident == thread.get_ident(), "Calling Database.group_commit on the wrong thread"
+        assert isinstance(rows, (int, long)), type(rows)
+        assert isinstance(durable, bool), type(durable)
+        assert func is None or callable(func), func
+        assert isinstance(args, tuple), type(args)
+        self._group_commit_pending_rows += rows
+        if func:
+            self._durability_callbacks.append((func, args))
+            durable = True
+
+        if self._group_commit_latency is None:
+            if durable:
+                return self.commit() is not False
+            return False
+
+        if self._group_commit_pending_rows >= self._group_commit_max_pending_rows:
+            if __debug__: dprint("group commit for ", self._group_commit_pending_rows, " pending rows")
+            return self.commit() is not False
+        return False
+
+    def flush_group_commit(self):
+        """
+        Commit when rows or durability callbacks are waiting for a commit.
+        """
+        assert self._debug_thread_ident == thread.get_ident(), "Calling Database.flush_group_commit on the wrong thread"
+        if self.group_commit_pending:
+            if __debug__: dprint("group commit for ", self._group_commit_pending_rows, " pending rows")
+            self.commit()
+
+    def close(self):
+        """
+        Close the database connection.  The Database can not be used afterwards.
+        """
+        assert self._debug_thread_ident == thread.get_ident(), "Calling Database.close on the wrong thread"
+        self._finish_statement()
+        self._cursor.close()
+        self._connection.close()
+        self._closed = True
+
+    @property
+    def closed(self):
+        """
+        True once Database.close has been called.
+        @rtype: bool
+        """
+        return self._closed
+
+    def enable_write_ahead_log(self):
+        """
+        Switch the database to write-ahead logging.
+
+        In WAL mode readers do not block the writer and the writer does not block readers, allowing
+        a DatabaseReader on another thread to query the database while this thread continues to
+        store messages.  A reader will only see the changes that have been committed.  The journal
+        mode is stored in the database file, i.e. it remains in effect for future connections.
+
+        Returns True when the database is in WAL mode.
+        @rtype: bool
+        """
+        assert self._debug_thread_ident == thread.get_ident(), "Calling Database.enable_write_ahead_log on the wrong thread"
+        assert self._pending_commits == 0, "The journal mode can not be changed within a transaction"
+        self._connection.commit()
+        mode, = self._cursor.execute(u"PRAGMA journal_mode = WAL").next()
+        if __debug__: dprint("PRAGMA journal_mode = ", mode)
+        return mode.lower() == u"wal"
+
+    def create_reader(self):
+        """
+        Returns a new DatabaseReader for this database file.
+
+        The DatabaseReader must be used on the thread that calls this method.
+        @rtype: DatabaseReader
+        """
+        return DatabaseReader(self._file_path)
+
     # def _on_rollback(self):
     #     if __debug__: dprint("ROLLBACK", level="warning")
     #     raise DatabaseRollbackException(1)
@@ -314,3 +705,26 @@ class Database(Singleton):
     def detach_commit_callback(self, func):
         assert func in self._commit_callbacks
         self._commit_callbacks.remove(func)
+
+    def attach_before_commit_callback(self, func):
+        """
+        Call FUNC before each database commit.
+
+        Unlike the commit callbacks, an exception raised by FUNC prevents the commit.
+        """
+        assert not func in self._before_commit_callbacks
+        self._before_commit_callbacks.append(func)
+
+    def detach_before_commit_callback(self, func):
+        assert func in self._before_commit_callbacks
+        self._before_commit_callbacks.remove(func)
+
+    def create_function(self, name, num_params, func):
+        """
+        Make FUNC available as the SQL function NAME taking NUM_PARAMS parameters.
+        """
+        assert self._debug_thread_ident == thread.get_ident(), "Calling Database.create_function on the wrong thread"
+        assert isinstance(name, str)
+        assert isinstance(num_params, int)
+        assert callable(func)
+        self._connection.create_function(name, num_params, func)
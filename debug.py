@@ -1,15 +1,15 @@
 import socket
 
-from bloomfilter import BloomFilter
+from bloomfilter import BloomFilter, DigestBloomFilter, InvertibleBloomLookupTable
 from candidate import Candidate
 from crypto import ec_generate_key, ec_to_public_bin, ec_to_private_bin, ec_from_private_bin
 from dprint import dprint
-from member import Member
+from member import Member, MemberCache
 from message import Message
 from time import time, sleep
 
 class DebugOnlyMember(Member):
-    _cache = []
+    _cache = MemberCache(512)
 
     def __init__(self, public_key, private_key=""):
         super(DebugOnlyMember, self).__init__(public_key)
@@ -336,10 +336,18 @@ class Node(object):
         meta = self._community.get_meta_message(u"dispersy-missing-proof")
         return meta.impl(distribution=(global_time,), payload=(member, global_time))
 
-    def create_dispersy_introduction_request_message(self, destination, source_lan, source_wan, advice, connection_type, sync, identifier, global_time):
+    def create_dispersy_introduction_request_message(self, destination, source_lan, source_wan, advice, connection_type, sync, identifier, global_time, reconciliation=False, fingerprint=None):
         # TODO assert other arguments
         assert isinstance(destination, Candidate), destination
-        if sync:
+        assert isinstance(reconciliation, bool)
+        if sync and reconciliation:
+            assert isinstance(sync, tuple)
+            assert len(sync) == 5
+            time_low, time_high, modulo, offset, bloom_packets = sync
+            table = InvertibleBloomLookupTable(72, 3, prefix="x")
+            table.add_keys(DigestBloomFilter.digest(packet) for packet in bloom_packets)
+            sync = (time_low, time_high, modulo, offset, table)
+        elif sync:
             assert isinstance(sync, tuple)
             assert len(sync) == 5
             time_low, time_high, modulo, offset, bloom_packets = sync
@@ -357,5 +365,5 @@ class Node(object):
         return meta.impl(authentication=(self._my_member,),
                          destination=(destination,),
                          distribution=(global_time,),
-                         payload=(destination.sock_addr, source_lan, source_wan, advice, connection_type, sync, identifier))
+                         payload=(destination.sock_addr, source_lan, source_wan, advice, connection_type, sync, identifier, reconciliation, fingerprint))
 
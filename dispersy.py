@@ -40,6 +40,8 @@ of, the name it uses as an internal identifier, and the class that will contain
 import os
 import sys
 
+from bisect import insort
+from collections import deque
 from hashlib import sha1
 from itertools import groupby, islice, count
 from random import random, shuffle
@@ -47,8 +49,9 @@ from socket import inet_aton, error as socket_error
 from time import time
 
 from authentication import NoAuthentication, MemberAuthentication, MultiMemberAuthentication
-from bloomfilter import BloomFilter
+from bloomfilter import BloomFilter, DigestBloomFilter, InvertibleBloomLookupTable
 from bootstrap import get_bootstrap_candidates
+from cache import LinkedDict, SignatureCache
 from callback import Callback
 from candidate import BootstrapCandidate, LoopbackCandidate, WalkCandidate, Candidate
 from destination import CommunityDestination, CandidateDestination, MemberDestination, SubjectiveDestination
@@ -71,6 +74,7 @@ from payload import SignatureRequestPayload, SignatureResponsePayload
 from payload import SubjectiveSetPayload, MissingSubjectiveSetPayload
 from requestcache import Cache, RequestCache
 from resolution import PublicResolution, LinearResolution
+from segmentstore import segment_location_range
 from singleton import Singleton
 
 from guessip import get_my_wan_ip
@@ -348,7 +352,7 @@ class Dispersy(Singleton):
     The Dispersy class provides the interface to all Dispersy related commands, managing the in- and
     outgoing data for, possibly, multiple communities.
     """
-    def __init__(self, callback, working_directory):
+    def __init__(self, callback, working_directory, signature_cache_size=4096, member_cache_size=512):
         """
         Initialize the Dispersy singleton instance.
 
@@ -361,9 +365,17 @@ class Dispersy(Singleton):
 
         @param working_directory: The directory where all files should be stored.
         @type working_directory: unicode
+
+        @param signature_cache_size: The maximum number of recently verified signatures to remember.
+        @type signature_cache_size: int
+
+        @param member_cache_size: The maximum number of Member instances to keep in memory.
+        @type member_cache_size: int
         """
         assert isinstance(callback, Callback)
         assert isinstance(working_directory, unicode)
+        assert isinstance(signature_cache_size, int)
+        assert isinstance(member_cache_size, int)
 
         super(Dispersy, self).__init__()
 
@@ -431,6 +443,41 @@ class Dispersy(Singleton):
         # statistics...
         self._statistics = Statistics()
 
+        # optional parallel signature verification of incoming batches
+        self._signature_verifier = None
+
+        # optional worker thread selecting the packets for sync responses
+        self._sync_responder = None
+
+        # when larger than zero, sync responses are sent at most _sync_response_rate bytes per
+        # second to each candidate.  _sync_response_queues contains the packets that are waiting
+        # to be sent, indexed by candidate sock_addr
+        self._sync_response_rate = 0
+        self._sync_response_queues = {}
+
+        # when True new packets are stored in segment files, see PacketSegmentStore
+        self._packet_segments = False
+        self._callback.register(self._compact_packet_segments)
+
+        # recently verified signatures, duplicate packets are not verified again
+        self._signature_cache = SignatureCache(signature_cache_size)
+
+        # recently used members, indexed by public key and mid
+        Member.get_cache().max_size = member_cache_size
+
+        # mids that are not in the database, mid:expiration-timestamp.  this prevents a database
+        # query for every packet from a member whose dispersy-identity we are still waiting for
+        self._unknown_mids = {}
+        self._unknown_mid_timeout = 10.0
+        self._unknown_mid_max_size = 4096
+
+        # the highest stored sequence number, (member-database-id, meta-message-database-id):number
+        self._highest_sequence_numbers = {}
+
+        # the stored LastSyncDistribution messages, (meta-message-database-id, member-database-ids):history
+        self._last_sync_histories = LinkedDict()
+        self._last_sync_histories_max_size = 1024
+
         if __debug__:
             self._callback.register(self._stats_candidates)
             self._callback.register(self._stats_detailed_candidates)
@@ -509,6 +556,103 @@ class Dispersy(Singleton):
     # .setter was introduced in Python 2.6
     endpoint = property(__get_endpoint, __set_endpoint)
 
+    # @property
+    def __get_signature_verifier(self):
+        """
+        The SignatureVerifier used to verify the signatures of incoming batches, or None.
+        @rtype: SignatureVerifier or None
+        """
+        return self._signature_verifier
+    # @signature_verifier.setter
+    def __set_signature_verifier(self, signature_verifier):
+        """
+        Set the SignatureVerifier used to verify the signatures of incoming batches.
+
+        When None, signatures are verified one by one while decoding each packet.
+        @type signature_verifier: SignatureVerifier or None
+        """
+        if __debug__:
+            from verifier import SignatureVerifier
+            assert signature_verifier is None or isinstance(signature_verifier, SignatureVerifier), signature_verifier
+        self._signature_verifier = signature_verifier
+    # .setter was introduced in Python 2.6
+    signature_verifier = property(__get_signature_verifier, __set_signature_verifier)
+
+    # @property
+    def __get_sync_responder(self):
+        """
+        The SyncResponder used to select the packets for sync responses, or None.
+        @rtype: SyncResponder or None
+        """
+        return self._sync_responder
+    # @sync_responder.setter
+    def __set_sync_responder(self, sync_responder):
+        """
+        Set the SyncResponder used to select the packets for sync responses.
+
+        When None, the packets are selected on the callback thread.  The SyncResponder is stopped
+        when Dispersy shuts down.
+        @type sync_responder: SyncResponder or None
+        """
+        if __debug__:
+            from syncresponder import SyncResponder
+            assert sync_responder is None or isinstance(sync_responder, SyncResponder), sync_responder
+        self._sync_responder = sync_responder
+    # .setter was introduced in Python 2.6
+    sync_responder = property(__get_sync_responder, __set_sync_responder)
+
+    # @property
+    def __get_sync_response_rate(self):
+        """
+        The maximum number of bytes per second that are sent to a single candidate in response to
+        sync requests, or zero when sync responses are sent immediately.
+        @rtype: int
+        """
+        return self._sync_response_rate
+    # @sync_response_rate.setter
+    def __set_sync_response_rate(self, sync_response_rate):
+        """
+        Set the maximum number of bytes per second that are sent to a single candidate in
+        response to sync requests.
+
+        When zero, all packets of a sync response are given to the endpoint at once.
+        @type sync_response_rate: int
+        """
+        assert isinstance(sync_response_rate, (int, long)), type(sync_response_rate)
+        assert sync_response_rate >= 0, sync_response_rate
+        self._sync_response_rate = sync_response_rate
+    # .setter was introduced in Python 2.6
+    sync_response_rate = property(__get_sync_response_rate, __set_sync_response_rate)
+
+    # @property
+    def __get_packet_segments(self):
+        """
+        True when new packets are stored in segment files instead of the sync table.
+        @rtype: bool
+        """
+        return self._packet_segments
+    # @packet_segments.setter
+    def __set_packet_segments(self, packet_segments):
+        """
+        Store new packets in segment files, see PacketSegmentStore, or in the sync table.
+
+        Packets that are already stored remain where they are, either way all packets remain
+        readable.
+        @type packet_segments: bool
+        """
+        assert isinstance(packet_segments, bool)
+        self._packet_segments = packet_segments
+    # .setter was introduced in Python 2.6
+    packet_segments = property(__get_packet_segments, __set_packet_segments)
+
+    @property
+    def signature_cache(self):
+        """
+        The SignatureCache containing recently verified signatures.
+        @rtype: SignatureCache
+        """
+        return self._signature_cache
+
     @property
     def lan_address(self):
         """
@@ -711,7 +855,10 @@ class Dispersy(Singleton):
         """
         assert isinstance(public_key, str)
         assert isinstance(private_key, str)
-        return Member(public_key, private_key)
+        member = Member(public_key, private_key)
+        # the public key is now in the database
+        self._unknown_mids.pop(member.mid, None)
+        return member
 
     def get_members_from_id(self, mid, cache=True):
         """
@@ -746,14 +893,31 @@ class Dispersy(Singleton):
             except LookupError:
                 pass
 
+            # we recently found that this mid is not in the database
+            if self._unknown_mids.get(mid, 0.0) > time():
+                return []
+
         # note that this allows a security attack where someone might obtain a crypographic key that
         # has the same sha1 as the master member, however unlikely.  the only way to prevent this,
         # as far as we know, is to increase the size of the community identifier, for instance by
         # using sha256 instead of sha1.
-        return [MemberWithoutCheck(str(public_key))
-                for public_key,
-                in list(self._database.execute(u"SELECT public_key FROM member WHERE mid = ?", (buffer(mid),)))
-                if public_key]
+        members = [MemberWithoutCheck(str(public_key))
+                   for public_key,
+                   in list(self._database.execute(u"SELECT public_key FROM member WHERE mid = ?", (buffer(mid),)))
+                   if public_key]
+
+        if members:
+            self._unknown_mids.pop(mid, None)
+
+        else:
+            now = time()
+            if len(self._unknown_mids) >= self._unknown_mid_max_size:
+                self._unknown_mids = dict((key, timestamp) for key, timestamp in self._unknown_mids.iteritems() if timestamp > now)
+                if len(self._unknown_mids) >= self._unknown_mid_max_size:
+                    self._unknown_mids.clear()
+            self._unknown_mids[mid] = now + self._unknown_mid_timeout
+
+        return members
 
     def attach_community(self, community):
         """
@@ -815,6 +979,9 @@ class Dispersy(Singleton):
         assert self._communities[community.cid] == community
         assert not community.dispersy_enable_candidate_walker or community in self._walker_commmunities, [community.dispersy_enable_candidate_walker, community in self._walker_commmunities]
         del self._communities[community.cid]
+        if not community.sync_database is self._database:
+            # the SyncResponder closes its reader once the database is closed
+            self._database.close_community_database(community.database_id)
 
         if community.dispersy_enable_candidate_walker:
             self._walker_commmunities.remove(community)
@@ -961,8 +1128,8 @@ class Dispersy(Singleton):
         assert isinstance(member, Member)
         assert isinstance(global_time, (int, long))
         try:
-            packet, = self._database.execute(u"SELECT packet FROM sync WHERE community = ? AND member = ? AND global_time = ?",
-                                             (community.database_id, member.database_id, global_time)).next()
+            packet, = community.sync_database.execute(u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? AND member = ? AND global_time = ?",
+                                                      (community.database_id, member.database_id, global_time)).next()
         except StopIteration:
             return None
         else:
@@ -976,8 +1143,8 @@ class Dispersy(Singleton):
         assert isinstance(member, Member)
         assert isinstance(meta, Message)
         try:
-            packet, = self._database.execute(u"SELECT packet FROM sync WHERE member = ? AND meta_message = ? ORDER BY global_time DESC LIMIT 1",
-                                             (member.database_id, meta.database_id)).next()
+            packet, = community.sync_database.execute(u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE member = ? AND meta_message = ? ORDER BY global_time DESC LIMIT 1",
+                                                      (member.database_id, meta.database_id)).next()
         except StopIteration:
             return None
         else:
@@ -1068,10 +1235,114 @@ class Dispersy(Singleton):
         if self._connection_type == u"unknown" and self._lan_address == self._wan_address:
             self._connection_type = u"public"
 
-    def _is_duplicate_sync_message(self, message):
+    def _get_highest_sequence_number(self, member, meta):
+        """
+        Returns the highest sequence number of the META messages created by MEMBER that we have
+        stored, or zero when we have none.
+
+        The value is obtained from the database only once and maintained by _store afterwards.
+        """
+        assert isinstance(meta.distribution, FullSyncDistribution)
+        assert meta.distribution.enable_sequence_number
+        key = (member.database_id, meta.database_id)
+        try:
+            return self._highest_sequence_numbers[key]
+        except KeyError:
+            sequence_number, = meta.community.sync_database.execute(u"SELECT MAX(sequence_number) FROM sync WHERE member = ? AND meta_message = ?", key).next()
+            self._highest_sequence_numbers[key] = sequence_number = sequence_number or 0
+            return sequence_number
+
+    def _get_last_sync_history(self, meta, members):
+        """
+        Returns the stored META messages signed by MEMBERS, a sorted tuple with member database
+        ids, as a list of (global_time, digest, packet_id, creator_database_id) tuples.
+
+        The list is ordered by global time and packet digest, hence the first entries are removed
+        once it contains more than history_size entries.  It is obtained from the database only once
+        and must be kept up to date by the caller.
+        """
+        assert isinstance(meta.distribution, LastSyncDistribution)
+        assert isinstance(members, tuple)
+        key = (meta.database_id, members)
+        try:
+            history = self._last_sync_histories.pop(key)
+
+        except KeyError:
+            if isinstance(meta.authentication, MemberAuthentication):
+                assert len(members) == 1
+                rows = meta.community.sync_database.execute(u"SELECT global_time, digest, id, member FROM sync WHERE community = ? AND meta_message = ? AND member = ?",
+                                                            (meta.community.database_id, meta.database_id, members[0]))
+            else:
+                # the IN clause and COUNT(*) ensure that the message was signed by exactly MEMBERS,
+                # regardless of the signing order
+                assert len(members) == meta.authentication.count
+                rows = meta.community.sync_database.execute(u"""
+                        SELECT sync.global_time, sync.digest, sync.id, sync.member
+                        FROM sync
+                        JOIN reference_member_sync ON reference_member_sync.sync = sync.id
+                        WHERE sync.community = ? AND sync.meta_message = ? AND reference_member_sync.member IN (%s)
+                        GROUP BY sync.id
+                        HAVING COUNT(*) = ?""" % ", ".join("?" * len(members)),
+                                                            (meta.community.database_id, meta.database_id) + members + (meta.authentication.count,))
+            history = sorted((global_time, str(digest), packet_id, creator_database_id) for global_time, digest, packet_id, creator_database_id in rows)
+
+        # most recently used histories are at the end
+        self._last_sync_histories[key] = history
+        if len(self._last_sync_histories) > self._last_sync_histories_max_size:
+            self._last_sync_histories.popitem(last=False)
+        return history
+
+    def _find_duplicate_sync_messages(self, messages):
+        """
+        Returns a dictionary with (member database id, global time) / (packet, undone) pairs for all
+        MESSAGES that are already in the database.
+
+        Messages that were recently stored, and not undone since, are found using the
+        recent_sync_keys of the community.  All other messages are resolved using one query for
+        every (at most) 450 messages.
+
+        @param messages: The messages, from a single community, that are to be checked.
+        @type messages: [Message.Implementation]
+
+        @rtype: dict
+        """
+        assert isinstance(messages, list)
+        assert all(message.community == messages[0].community for message in messages)
+        if not messages:
+            return {}
+
+        community = messages[0].community
+        recent_sync_keys = community.recent_sync_keys
+        duplicates = {}
+        unknown = []
+
+        for message in messages:
+            key = (message.authentication.member.database_id, message.distribution.global_time)
+            if recent_sync_keys.get(key) == DigestBloomFilter.digest(message.packet):
+                # identical to a recently stored message that is not undone
+                duplicates[key] = (message.packet, 0)
+            else:
+                unknown.append(key)
+
+        # sqlite allows at most 999 variables per statement
+        for index in xrange(0, len(unknown), 450):
+            keys = set(unknown[index:index + 450])
+            members = list(set(member_database_id for member_database_id, _ in keys))
+            global_times = list(set(global_time for _, global_time in keys))
+            for member_database_id, global_time, packet, undone in community.sync_database.execute(u"SELECT member, global_time, IFNULL(packet, segment_packet(location)), undone FROM sync WHERE community = ? AND member IN (%s) AND global_time IN (%s)" % (", ".join("?" * len(members)), ", ".join("?" * len(global_times))),
+                                                                                                   [community.database_id] + members + global_times):
+                if (member_database_id, global_time) in keys:
+                    duplicates[(member_database_id, global_time)] = (str(packet), undone)
+
+        return duplicates
+
+    def _is_duplicate_sync_message(self, message, duplicates=None):
         """
         Returns True when this message is a duplicate, otherwise the message must be processed.
 
+        When DUPLICATES is given, it must be the result of _find_duplicate_sync_messages for a batch
+        containing MESSAGE, and the database will not be consulted.
+
         === Problem: duplicate message ===
 
         The simplest reason to reject an incoming message is when we already have it.  No further
@@ -1111,11 +1382,18 @@ class Dispersy(Singleton):
         until the bloom filter is synced with the database again.
         """
         community = message.community
-        # fetch the duplicate binary packet from the database
-        try:
-            packet, undone = self._database.execute(u"SELECT packet, undone FROM sync WHERE community = ? AND member = ? AND global_time = ?",
-                                                    (community.database_id, message.authentication.member.database_id, message.distribution.global_time)).next()
-        except StopIteration:
+        if duplicates is None:
+            # fetch the duplicate binary packet from the database
+            try:
+                packet, undone = community.sync_database.execute(u"SELECT IFNULL(packet, segment_packet(location)), undone FROM sync WHERE community = ? AND member = ? AND global_time = ?",
+                                                                 (community.database_id, message.authentication.member.database_id, message.distribution.global_time)).next()
+            except StopIteration:
+                packet = None
+
+        else:
+            packet, undone = duplicates.get((message.authentication.member.database_id, message.distribution.global_time), (None, 0))
+
+        if packet is None:
             # this message is not a duplicate
             return False
 
@@ -1127,7 +1405,7 @@ class Dispersy(Singleton):
 
                 if undone:
                     try:
-                        proof, = self._database.execute(u"SELECT packet FROM sync WHERE id = ?", (undone,)).next()
+                        proof, = community.sync_database.execute(u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE id = ?", (undone,)).next()
                     except StopIteration:
                         pass
                     else:
@@ -1143,11 +1421,20 @@ class Dispersy(Singleton):
 
                     if packet < message.packet:
                         # replace our current message with the other one
-                        self._database.execute(u"UPDATE sync SET packet = ? WHERE community = ? AND member = ? AND global_time = ?",
-                                               (buffer(message.packet), community.database_id, message.authentication.member.database_id, message.distribution.global_time))
+                        community.sync_database.execute(u"UPDATE sync SET packet = ?, location = ?, digest = ? WHERE community = ? AND member = ? AND global_time = ?",
+                                                        self._packets_to_columns(community, [message.packet])[0] + (buffer(DigestBloomFilter.digest(message.packet)), community.database_id, message.authentication.member.database_id, message.distribution.global_time))
 
                         # notify that global times have changed
-                        # community.update_sync_range(message.meta, [message.distribution.global_time])
+                        community.update_sync_range(message.meta, [message.distribution.global_time])
+                        community.recent_sync_keys.discard((message.authentication.member.database_id, message.distribution.global_time))
+
+                        # the history is ordered by digest, it is loaded again when needed
+                        if isinstance(message.distribution, LastSyncDistribution.Implementation):
+                            if isinstance(message.authentication, MultiMemberAuthentication.Implementation):
+                                members = tuple(sorted(member.database_id for member in message.authentication.members))
+                            else:
+                                members = (message.authentication.member.database_id,)
+                            self._last_sync_histories.pop((message.meta.database_id, members), None)
 
                 else:
                     if __debug__: dprint("received message with duplicate community/member/global-time triplet.  possibly malicious behavior", level="warning")
@@ -1179,7 +1466,6 @@ class Dispersy(Singleton):
         # a message is considered unique when (creator, global-time), i.r. (authentication.member,
         # distribution.global_time), is unique.
         unique = set()
-        execute = self._database.execute
         enable_sequence_number = messages[0].meta.distribution.enable_sequence_number
 
         # sort the messages by their (1) global_time and (2) binary packet
@@ -1188,14 +1474,15 @@ class Dispersy(Singleton):
         # refuse messages where the global time is unreasonably high
         acceptable_global_time = messages[0].community.acceptable_global_time
 
+        # obtain the messages that we already have
+        duplicates = self._find_duplicate_sync_messages(messages)
+
         if enable_sequence_number:
-            # obtain the highest sequence_number from the database
+            # obtain the highest stored sequence_number
             highest = {}
             for message in messages:
                 if not message.authentication.member in highest:
-                    seq, = execute(u"SELECT COUNT(1) FROM sync WHERE member = ? AND sync.meta_message = ?",
-                                   (message.authentication.member.database_id, message.database_id)).next()
-                    highest[message.authentication.member] = seq
+                    highest[message.authentication.member] = self._get_highest_sequence_number(message.authentication.member, message.meta)
 
             # all messages must follow the sequence_number order
             for message in messages:
@@ -1224,7 +1511,7 @@ class Dispersy(Singleton):
 
                 # we have the previous message, check for duplicates based on community,
                 # member, and global_time
-                if self._is_duplicate_sync_message(message):
+                if self._is_duplicate_sync_message(message, duplicates):
                     # we have the previous message (drop)
                     yield DropMessage(message, "duplicate message by global_time (1)")
                     continue
@@ -1247,7 +1534,7 @@ class Dispersy(Singleton):
                 unique.add(key)
 
                 # check for duplicates based on community, member, and global_time
-                if self._is_duplicate_sync_message(message):
+                if self._is_duplicate_sync_message(message, duplicates):
                     # we have the previous message (drop)
                     yield DropMessage(message, "duplicate message by global_time (2)")
                     continue
@@ -1308,12 +1595,11 @@ class Dispersy(Singleton):
                 unique.add(key)
 
                 if not message.authentication.member in times:
-                    times[message.authentication.member] = [global_time for global_time, in self._database.execute(u"SELECT global_time FROM sync WHERE community = ? AND member = ? AND meta_message = ?",
-                                                                                                                   (message.community.database_id, message.authentication.member.database_id, message.database_id))]
+                    times[message.authentication.member] = [global_time for global_time, _, _, _ in self._get_last_sync_history(message.meta, (message.authentication.member.database_id,))]
                     assert len(times[message.authentication.member]) <= message.distribution.history_size, [message.packet_id, message.distribution.history_size, times[message.authentication.member]]
                 tim = times[message.authentication.member]
 
-                if message.distribution.global_time in tim and self._is_duplicate_sync_message(message):
+                if message.distribution.global_time in tim and self._is_duplicate_sync_message(message, duplicates):
                     return DropMessage(message, "duplicate message by member^global_time (3)")
 
                 elif len(tim) >= message.distribution.history_size and min(tim) > message.distribution.global_time:
@@ -1323,8 +1609,8 @@ class Dispersy(Singleton):
                     # apparently the sender does not have this message yet
                     if message.distribution.history_size == 1:
                         try:
-                            packet, = self._database.execute(u"SELECT packet FROM sync WHERE community = ? AND member = ? ORDER BY global_time DESC LIMIT 1",
-                                                             (message.community.database_id, message.authentication.member.database_id)).next()
+                            packet, = message.community.sync_database.execute(u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? AND member = ? ORDER BY global_time DESC LIMIT 1",
+                                                                              (message.community.database_id, message.authentication.member.database_id)).next()
                         except StopIteration:
                             # TODO can still fail when packet is in one of the received messages
                             # from this batch.
@@ -1367,7 +1653,7 @@ class Dispersy(Singleton):
                 else:
                     unique.add(key)
 
-                    if self._is_duplicate_sync_message(message):
+                    if self._is_duplicate_sync_message(message, duplicates):
                         # we have the previous message (drop)
                         return DropMessage(message, "duplicate message by member^global_time (4)")
 
@@ -1383,25 +1669,14 @@ class Dispersy(Singleton):
                     #         return DropMessage(message, "duplicate message by member^global_time (4)")
 
                     if not members in times:
-                        # the next query obtains a list with all global times that we have in the
-                        # database for all message.meta messages that were signed by
-                        # message.authentication.members where the order of signing is not taken
-                        # into account.
-                        times[members] = [global_time
-                                          for count_, global_time
-                                          in self._database.execute(u"""
-                                                SELECT COUNT(*), sync.global_time
-                                                FROM sync
-                                                JOIN reference_member_sync ON reference_member_sync.sync = sync.id
-                                                WHERE sync.community = ? AND sync.meta_message = ? AND reference_member_sync.member IN (%s)
-                                                GROUP BY sync.id
-                                                """ % ", ".join("?" for _ in xrange(len(members))),
-                                                                    (message.community.database_id, message.database_id) + members)
-                                          if count_ == message.authentication.count]
+                        # all global times that we have in the database for all message.meta
+                        # messages that were signed by message.authentication.members where the
+                        # order of signing is not taken into account.
+                        times[members] = [global_time for global_time, _, _, _ in self._get_last_sync_history(message.meta, members)]
                         assert len(times[members]) <= message.distribution.history_size
                     tim = times[members]
 
-                    if message.distribution.global_time in tim and self._is_duplicate_sync_message(message):
+                    if message.distribution.global_time in tim and self._is_duplicate_sync_message(message, duplicates):
                         # we have the previous message (drop)
                         return DropMessage(message, "duplicate message by members^global_time")
 
@@ -1414,8 +1689,8 @@ class Dispersy(Singleton):
                             assert len(tim) == 1
                             packets = [packet
                                        for count_, packet
-                                       in self._database.execute(u"""
-                                       SELECT COUNT(*), sync.packet
+                                       in message.community.sync_database.execute(u"""
+                                       SELECT COUNT(*), IFNULL(sync.packet, segment_packet(sync.location))
                                        FROM sync
                                        JOIN reference_member_sync ON reference_member_sync.sync = sync.id
                                        WHERE sync.community = ? AND sync.global_time = ? AND sync.meta_message = ? AND reference_member_sync.member IN (%s)
@@ -1452,6 +1727,10 @@ class Dispersy(Singleton):
         acceptable_global_time = meta.community.acceptable_global_time
         messages = [message if message.distribution.global_time <= acceptable_global_time else DropMessage(message, "global time is not within acceptable range") for message in messages]
 
+        # obtain the messages that we already have, used by check_member_and_global_time and
+        # check_multi_member_and_global_time
+        duplicates = self._find_duplicate_sync_messages([message for message in messages if not isinstance(message, DropMessage)])
+
         if isinstance(meta.authentication, MemberAuthentication):
             # a message is considered unique when (creator, global-time), i.r. (authentication.member,
             # distribution.global_time), is unique.  UNIQUE is used in the check_member_and_global_time
@@ -1594,8 +1873,8 @@ class Dispersy(Singleton):
         this message or it can not be decoded.
         """
         try:
-            packet_id, packet = self._database.execute(u"SELECT id, packet FROM sync WHERE community = ? AND member = ? AND global_time = ? LIMIT 1",
-                                                       (community.database_id, member.database_id, global_time)).next()
+            packet_id, packet = community.sync_database.execute(u"SELECT id, IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? AND member = ? AND global_time = ? LIMIT 1",
+                                                                (community.database_id, member.database_id, global_time)).next()
         except StopIteration:
             return None
 
@@ -1968,15 +2247,23 @@ class Dispersy(Singleton):
         assert all(isinstance(packet[0], Candidate) for packet in packets)
         assert all(isinstance(packet[1], str) for packet in packets)
 
+        # packets usually arrive grouped by community (see ReusePortEndpoint), hence we only lookup
+        # each community once
+        communities = {}
+
         for candidate, packet in packets:
             # find associated community
+            cid = packet[2:22]
             try:
-                community = self.get_community(packet[2:22])
+                community = communities[cid]
             except KeyError:
-                if __debug__:
-                    dprint("drop a ", len(packet), " byte packet (received packet for unknown community) from ", candidate, level="warning")
-                    self._statistics.drop("_convert_packets_into_batch:unknown community", len(packet))
-                continue
+                try:
+                    community = communities[cid] = self.get_community(cid)
+                except KeyError:
+                    if __debug__:
+                        dprint("drop a ", len(packet), " byte packet (received packet for unknown community) from ", candidate, level="warning")
+                        self._statistics.drop("_convert_packets_into_batch:unknown community", len(packet))
+                    continue
 
             # find associated conversion
             try:
@@ -2005,14 +2292,19 @@ class Dispersy(Singleton):
         assert all(isinstance(x, tuple) for x in batch)
         assert all(len(x) == 3 for x in batch)
 
-        for candidate, packet, conversion in batch:
+        # packets whose signature has already been verified, these are decoded without verifying
+        # the signature again.  packets that fail this verification are decoded normally, ensuring
+        # that they are dropped or delayed exactly as before
+        verified = self._verify_batch(batch) if self._signature_verifier else ()
+
+        for index, (candidate, packet, conversion) in enumerate(batch):
             assert isinstance(candidate, Candidate)
             assert isinstance(packet, str)
             assert isinstance(conversion, Conversion)
 
             try:
                 # convert binary data to internal Message
-                yield conversion.decode_message(candidate, packet)
+                yield conversion.decode_message(candidate, packet, not index in verified)
 
             except DropPacket, exception:
                 if __debug__:
@@ -2025,6 +2317,54 @@ class Dispersy(Singleton):
                     self._statistics.delay("_convert_batch_into_messages:%s" % delay, len(packet))
                 delay.create_request(candidate, packet)
 
+    def _verify_batch(self, batch):
+        """
+        Verify the signatures in BATCH using the signature verifier.
+
+        Signatures that are found in the signature cache are not verified again, new valid
+        signatures are added to the cache.
+
+        Returns a set with the indexes, into BATCH, of the packets that have a valid signature.
+        """
+        verified = set()
+        indexes = []
+        keys = []
+        triples = []
+        for index, (_, packet, conversion) in enumerate(batch):
+            triple = conversion.get_signature_triple(packet)
+            if triple:
+                public_key, _, signature = triple
+                # see BinaryConversion._verify_signature
+                key = (sha1(public_key).digest(), sha1(packet).digest(), len(packet) - len(signature))
+                if key in self._signature_cache:
+                    verified.add(index)
+                else:
+                    indexes.append(index)
+                    keys.append(key)
+                    triples.append(triple)
+
+        if triples:
+            for index, key, valid in zip(indexes, keys, self._signature_verifier.verify(triples)):
+                if valid:
+                    verified.add(index)
+                    self._signature_cache.add(key)
+
+        return verified
+
+    def _packets_to_columns(self, community, packets):
+        """
+        Returns a list with the (packet, location) values for storing PACKETS in the sync table.
+
+        When packet segments are enabled the packets are appended to a segment file and only their
+        locations are stored, otherwise the packets themselves are stored.  A community with its
+        own database, see Community.dispersy_community_database, always stores the packets
+        themselves.
+        """
+        if self._packet_segments and community.sync_database is self._database:
+            return [(None, self._database.packet_store.append(packet)) for packet in packets]
+        else:
+            return [(buffer(packet), None) for packet in packets]
+
     def _store(self, messages):
         """
         Store a message in the database.
@@ -2057,7 +2397,7 @@ class Dispersy(Singleton):
         is_multi_member_authentication = isinstance(meta.authentication, MultiMemberAuthentication)
         highest_global_time = 0
 
-        # update_sync_range = set()
+        store = []
         for message in messages:
             # the signature must be set
             assert isinstance(message.authentication, (MemberAuthentication.Implementation, MultiMemberAuthentication.Implementation)), message.authentication
@@ -2073,87 +2413,126 @@ class Dispersy(Singleton):
                     if __debug__: dprint("not storing message")
                     continue
 
-            # add packet to database
-            self._database.execute(u"INSERT INTO sync (community, member, global_time, meta_message, packet) VALUES (?, ?, ?, ?, ?)",
-                    (message.community.database_id,
-                     message.authentication.member.database_id,
-                     message.distribution.global_time,
-                     message.database_id,
-                     buffer(message.packet)))
-            assert self._database.changes == 1
-            # update_sync_range.add(message.distribution.global_time)
-
-            # ensure that we can reference this packet
-            message.packet_id = self._database.last_insert_rowid
-            if __debug__: dprint("insert_rowid: ", message.packet_id, " for ", message.name)
-
-            # link multiple members is needed
-            if is_multi_member_authentication:
-                self._database.executemany(u"INSERT INTO reference_member_sync (member, sync) VALUES (?, ?)",
-                                           [(member.database_id, message.packet_id) for member in message.authentication.members])
-                assert self._database.changes == message.authentication.count
+            store.append(message)
 
             # update global time
             highest_global_time = max(highest_global_time, message.distribution.global_time)
 
-        if isinstance(meta.distribution, LastSyncDistribution):
-            # delete packets that have become obsolete
-            items = set()
+        is_last_sync_distribution = isinstance(meta.distribution, LastSyncDistribution)
+        if is_last_sync_distribution:
+            # the history must be loaded before the new packets are added to the database
             if is_multi_member_authentication:
-                for member_database_ids in set(tuple(sorted(member.database_id for member in message.authentication.members)) for message in messages):
-                    OR = u" OR ".join(u"reference_member_sync.member = ?" for _ in xrange(meta.authentication.count))
-                    iterator = self._database.execute(u"""
-                            SELECT sync.id, sync.member, sync.global_time, reference_member_sync.member
-                            FROM sync
-                            JOIN reference_member_sync ON reference_member_sync.sync = sync.id
-                            WHERE sync.community = ? AND sync.meta_message = ? AND (%s)
-                            ORDER BY sync.global_time, sync.packet""" % OR,
-                                       (meta.community.database_id, meta.database_id) + member_database_ids)
-                    all_items = []
-                    # TODO: weird.  group by using row[0], that is sync.id, and that is unique, so
-                    # groupby makes no sence.  Furthermore, groupby requires row[0] to be sorted,
-                    # and that is not the case either.
-                    for id_, group in groupby(iterator, key=lambda row: row[0]):
-                        group = list(group)
-                        if len(group) == meta.authentication.count and member_database_ids == tuple(sorted(check_member_id for _, _, _, check_member_id in group)):
-                            _, creator_database_id, global_time, _ = group[0]
-                            all_items.append((id_, creator_database_id, global_time))
-
-                    if len(all_items) > meta.distribution.history_size:
-                        items.update(all_items[:len(all_items) - meta.distribution.history_size])
-
+                get_members = lambda message: tuple(sorted(member.database_id for member in message.authentication.members))
             else:
-                for member_database_id in set(message.authentication.member.database_id for message in messages):
-                    all_items = list(self._database.execute(u"SELECT id, member, global_time FROM sync WHERE community = ? AND meta_message = ? AND member = ? ORDER BY global_time, packet",
-                                             (meta.community.database_id, meta.database_id, member_database_id)))
-                    if len(all_items) > meta.distribution.history_size:
-                        items.update(all_items[:len(all_items) - meta.distribution.history_size])
+                get_members = lambda message: (message.authentication.member.database_id,)
 
-            if items:
-                self._database.executemany(u"DELETE FROM sync WHERE id = ?", [(id_,) for id_, _, _ in items])
-                assert len(items) == self._database.changes
-                if __debug__: dprint("deleted ", self._database.changes, " messages ", [id_ for id_, _, _ in items])
+            histories = {}
+            for message in store:
+                members = get_members(message)
+                if not members in histories:
+                    histories[members] = self._get_last_sync_history(meta, members)
 
-                if is_multi_member_authentication:
-                    self._database.executemany(u"DELETE FROM reference_member_sync WHERE sync = ?", [(id_,) for id_, _, _ in items])
-                    assert len(items) * meta.authentication.count == self._database.changes
+        if store:
+            # all rows inserted below will have an id larger than the current maximum (we are the
+            # only thread writing to the database)
+            sync_database = meta.community.sync_database
+            last_packet_id, = sync_database.execute(u"SELECT MAX(id) FROM sync").next()
+            digests = [DigestBloomFilter.digest(message.packet) for message in store]
+
+            # add packets to database
+            if isinstance(meta.distribution, FullSyncDistribution):
+                sequence_numbers = [message.distribution.sequence_number for message in store]
+            else:
+                sequence_numbers = [0] * len(store)
+            sync_database.executemany(u"INSERT INTO sync (community, member, global_time, meta_message, packet, location, digest, sequence_number, priority, direction) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                      [(message.community.database_id,
+                                        message.authentication.member.database_id,
+                                        message.distribution.global_time,
+                                        message.database_id) +
+                                       columns +
+                                       (buffer(digest),
+                                        sequence_number,
+                                        meta.distribution.priority,
+                                        meta.distribution.synchronization_direction_value)
+                                       for message, columns, digest, sequence_number in zip(store, self._packets_to_columns(meta.community, [message.packet for message in store]), digests, sequence_numbers)])
+            assert sync_database.changes == len(store)
+
+            # update the highest sequence numbers
+            if isinstance(meta.distribution, FullSyncDistribution) and meta.distribution.enable_sequence_number:
+                for message in store:
+                    key = (message.authentication.member.database_id, meta.database_id)
+                    if key in self._highest_sequence_numbers:
+                        self._highest_sequence_numbers[key] = max(self._highest_sequence_numbers[key], message.distribution.sequence_number)
+
+            # ensure that we can reference these packets
+            packet_ids = dict(((member_database_id, global_time), packet_id)
+                              for packet_id, member_database_id, global_time
+                              in sync_database.execute(u"SELECT id, member, global_time FROM sync WHERE id > ?", (last_packet_id or 0,)))
+            assert len(packet_ids) == len(store)
+            for message in store:
+                message.packet_id = packet_ids[(message.authentication.member.database_id, message.distribution.global_time)]
+                if __debug__: dprint("insert_rowid: ", message.packet_id, " for ", message.name)
 
-                # update_sync_range.update(global_time for _, _, global_time in items)
+            # link multiple members is needed
+            if is_multi_member_authentication:
+                sync_database.executemany(u"INSERT INTO reference_member_sync (member, sync) VALUES (?, ?)",
+                                          [(member.database_id, message.packet_id) for message in store for member in message.authentication.members])
+                assert sync_database.changes == len(store) * meta.authentication.count
+
+            # remember the keys to detect duplicates
+            recent_sync_keys = meta.community.recent_sync_keys
+            for message, digest in zip(store, digests):
+                recent_sync_keys.set((message.authentication.member.database_id, message.distribution.global_time), digest)
+
+        # notify that packets have been added
+        meta.community.extend_sync_range(meta, [(message.distribution.global_time, message.packet) for message in store])
+
+        # attribute the new packets to the sync range that was claimed from their sender, the
+        # planner ignores packets created after the request was sent
+        if meta.distribution.priority > 32:
+            sync_planner = meta.community.sync_planner
+            for message in store:
+                if message.candidate:
+                    sync_planner.received(message.candidate.sock_addr, message.distribution.global_time, len(message.packet))
+
+        if is_last_sync_distribution:
+            # delete packets that have become obsolete
+            history_size = meta.distribution.history_size
+            items = []
+            for message, digest in zip(store, digests):
+                history = histories[get_members(message)]
+                insort(history, (message.distribution.global_time, digest, message.packet_id, message.authentication.member.database_id))
+                if len(history) > history_size:
+                    items.extend((packet_id, creator_database_id, global_time) for global_time, _, packet_id, creator_database_id in history[:len(history) - history_size])
+                    del history[:len(history) - history_size]
+
+            if items:
+                sync_database = meta.community.sync_database
+                # sqlite allows at most 999 variables per statement
+                for index in xrange(0, len(items), 900):
+                    packet_ids = [id_ for id_, _, _ in items[index:index + 900]]
+                    sync_database.execute(u"DELETE FROM sync WHERE id IN (%s)" % ", ".join("?" * len(packet_ids)), packet_ids)
+                    assert len(packet_ids) == sync_database.changes
+                    if is_multi_member_authentication:
+                        sync_database.execute(u"DELETE FROM reference_member_sync WHERE sync IN (%s)" % ", ".join("?" * len(packet_ids)), packet_ids)
+                        assert len(packet_ids) * meta.authentication.count == sync_database.changes
+                if __debug__: dprint("deleted ", len(items), " messages ", [id_ for id_, _, _ in items])
+
+                # notify that global times have changed
+                meta.community.update_sync_range(meta, [global_time for _, _, global_time in items])
+                for _, member_database_id, global_time in items:
+                    meta.community.recent_sync_keys.discard((member_database_id, global_time))
 
             # 12/10/11 Boudewijn: verify that we do not have to many packets in the database
             if __debug__:
                 if not is_multi_member_authentication:
                     for message in messages:
-                        history_size, = self._database.execute(u"SELECT COUNT(1) FROM sync WHERE meta_message = ? AND member = ?", (message.database_id, message.authentication.member.database_id)).next()
+                        history_size, = meta.community.sync_database.execute(u"SELECT COUNT(1) FROM sync WHERE meta_message = ? AND member = ?", (message.database_id, message.authentication.member.database_id)).next()
                         assert history_size <= message.distribution.history_size, [count, message.distribution.history_size, message.authentication.member.database_id]
 
         # update the global time
         meta.community.update_global_time(highest_global_time)
 
-        # if update_sync_range:
-        #     # notify that global times have changed
-        #     meta.community.update_sync_range(meta, update_sync_range)
-
     @property
     def candidates(self):
         return self._candidates.itervalues()
@@ -2398,6 +2777,7 @@ class Dispersy(Singleton):
         advice = True
 
         # obtain sync range
+        fingerprint = None
         if isinstance(destination, BootstrapCandidate):
             # do not request a sync when we connecting to a bootstrap candidate
             sync = None
@@ -2411,7 +2791,24 @@ class Dispersy(Singleton):
                 self._callback.unregister(task_identifier)
                 self._on_batch_cache_timeout(meta, timestamp, batch)
 
-            sync = community.dispersy_claim_sync_bloom_filter(identifier)
+            # a lookup table is only sent to candidates that accept it, the bloom filter is not
+            # claimed in that case.  BLOOM_FILTER is only given when needed, allowing overrides that
+            # accept only IDENTIFIER to keep working while reconciliation is disabled
+            reconciliation = community.dispersy_sync_reconciliation and destination.reconciliation
+            if reconciliation:
+                sync = community.dispersy_claim_sync_bloom_filter(identifier, bloom_filter=False)
+            else:
+                sync = community.dispersy_claim_sync_bloom_filter(identifier)
+            if sync and reconciliation:
+                table = self._create_sync_lookup_table(community, sync)
+                if table:
+                    if sync[2] == 1:
+                        # allow DESTINATION to skip the range when it has the same packets
+                        fingerprint = community.get_sync_fingerprint(sync[0], sync[1])
+                    sync = table
+                else:
+                    sync = community.get_sync_bloom_filter(sync)
+
             if __debug__:
                 assert sync is None or isinstance(sync, tuple), sync
                 if not sync is None:
@@ -2421,14 +2818,15 @@ class Dispersy(Singleton):
                     assert isinstance(time_high, (int, long)), time_high
                     assert isinstance(modulo, int), modulo
                     assert isinstance(offset, int), offset
-                    assert isinstance(bloom_filter, BloomFilter), bloom_filter
+                    assert isinstance(bloom_filter, (BloomFilter, InvertibleBloomLookupTable)), bloom_filter
 
+                if sync and isinstance(sync[4], BloomFilter):
                     # verify that the bloom filter is correct
                     binary = bloom_filter.bytes
                     bloom_filter.clear()
                     try:
-                        packets = [str(packet) for packet, in self._database.execute(u"SELECT sync.packet FROM sync JOIN meta_message ON meta_message.id = sync.meta_message WHERE sync.community = ? AND meta_message.priority > 32 AND sync.undone == 0 AND global_time BETWEEN ? AND ? AND (sync.global_time + ?) % ? = 0",
-                                                                                     (community.database_id, time_low, community.global_time if time_high == 0 else time_high, offset, modulo))]
+                        packets = [str(packet) for packet, in community.sync_database.execute(u"SELECT IFNULL(sync.packet, segment_packet(sync.location)) FROM sync WHERE sync.community = ? AND sync.undone = 0 AND sync.priority > 32 AND global_time BETWEEN ? AND ? AND (sync.global_time + ?) % ? = 0",
+                                                                                              (community.database_id, time_low, community.global_time if time_high == 0 else time_high, offset, modulo))]
                     except OverflowError:
                         dprint("time_low:  ", time_low, level="error")
                         dprint("time_high: ", time_high, level="error")
@@ -2439,6 +2837,9 @@ class Dispersy(Singleton):
                     bloom_filter.add_keys(packets)
                     assert binary == bloom_filter.bytes, "The returned bloom filter does not match the given range [%d:%d] packets:%d" % (time_low, time_high, len(packets))
 
+            if sync:
+                community.sync_planner.sent(destination.sock_addr, len(sync[4].bytes), community.global_time)
+
         if __debug__:
             if destination.get_destination_address(self._wan_address) != destination.sock_addr:
                 dprint("destination address, ", destination.get_destination_address(self._wan_address), " should (in theory) be the sock_addr ", destination, level="warning")
@@ -2447,7 +2848,7 @@ class Dispersy(Singleton):
         request = meta_request.impl(authentication=(community.my_member,),
                                     distribution=(community.global_time,),
                                     destination=(destination,),
-                                    payload=(destination.get_destination_address(self._wan_address), self._lan_address, self._wan_address, advice, self._connection_type, sync, identifier))
+                                    payload=(destination.get_destination_address(self._wan_address), self._lan_address, self._wan_address, advice, self._connection_type, sync, identifier, self._announce_reconciliation(community, destination), fingerprint))
 
         if __debug__:
             if sync:
@@ -2458,6 +2859,28 @@ class Dispersy(Singleton):
             self._forward([request])
         return request
 
+    def _create_sync_lookup_table(self, community, sync):
+        """
+        Returns SYNC with an InvertibleBloomLookupTable instead of a bloom filter, or None when the
+        table is unlikely to decode.
+
+        The table covers the same range and uses the same number of bytes as the sync bloom filter.
+        It can only decode as many differences as its capacity.  When the range recently produced
+        more new packets than that, see SyncPlanner.get_score, the bloom filter must be used
+        instead.
+        """
+        time_low, time_high, modulo, offset, _ = sync
+        functions = 3
+        cells = community.dispersy_sync_bloom_filter_bits / 8 / InvertibleBloomLookupTable.cell_size / functions * functions
+        table = InvertibleBloomLookupTable(cells, functions, prefix=chr(int(random() * 256)))
+        if modulo == 1 and community.sync_planner.get_score(time_low) > table.capacity:
+            if __debug__: dprint("expecting more than ", table.capacity, " differences in [", time_low, ":", time_high, "], using a bloom filter")
+            return None
+
+        table.add_keys(str(digest) for digest, in community.sync_database.execute(u"SELECT digest FROM sync WHERE community = ? AND undone = 0 AND priority > 32 AND global_time BETWEEN ? AND ? AND (global_time + ?) % ? = 0",
+                                                                               (community.database_id, time_low, min(community.global_time if time_high == 0 else time_high, 2**63-1), offset, modulo)))
+        return time_low, time_high, modulo, offset, table
+
     def check_introduction_request(self, messages):
         """
         We received a dispersy-introduction-request message.
@@ -2556,6 +2979,7 @@ class Dispersy(Singleton):
 
             # update sender candidate
             candidate.update(candidate.tunnel, source_lan_address, source_wan_address, payload.connection_type)
+            candidate.reconciliation = payload.reconciliation
             candidate.stumble(community, now)
             # candidate.active(community, now)
             self._filter_duplicate_candidate(candidate)
@@ -2594,7 +3018,7 @@ class Dispersy(Singleton):
                 if __debug__: dprint("telling ", candidate, " that ", introduced, " exists")
 
                 # create introduction response
-                responses.append(meta_introduction_response.impl(authentication=(community.my_member,), distribution=(community.global_time,), destination=(candidate,), payload=(candidate.get_destination_address(self._wan_address), self._lan_address, self._wan_address, introduced.lan_address, introduced.wan_address, self._connection_type, introduced.tunnel, payload.identifier)))
+                responses.append(meta_introduction_response.impl(authentication=(community.my_member,), distribution=(community.global_time,), destination=(candidate,), payload=(candidate.get_destination_address(self._wan_address), self._lan_address, self._wan_address, introduced.lan_address, introduced.wan_address, self._connection_type, introduced.tunnel, payload.identifier, self._announce_reconciliation(community, candidate))))
 
                 # create puncture request
                 requests.append(meta_puncture_request.impl(distribution=(community.global_time,), destination=(introduced,), payload=(source_lan_address, source_wan_address, payload.identifier)))
@@ -2603,7 +3027,7 @@ class Dispersy(Singleton):
                 if __debug__: dprint("responding to ", candidate, " without an introduction")
 
                 none = ("0.0.0.0", 0)
-                responses.append(meta_introduction_response.impl(authentication=(community.my_member,), distribution=(community.global_time,), destination=(candidate,), payload=(candidate.get_destination_address(self._wan_address), self._lan_address, self._wan_address, none, none, self._connection_type, False, payload.identifier)))
+                responses.append(meta_introduction_response.impl(authentication=(community.my_member,), distribution=(community.global_time,), destination=(candidate,), payload=(candidate.get_destination_address(self._wan_address), self._lan_address, self._wan_address, none, none, self._connection_type, False, payload.identifier, self._announce_reconciliation(community, candidate))))
 
         if responses:
             self._forward(responses)
@@ -2614,23 +3038,20 @@ class Dispersy(Singleton):
         # process the bloom filter part of the request
         #
 
-        # obtain all available messages for this community
-        syncable_messages = u", ".join(unicode(meta.database_id) for meta in community.get_meta_messages() if isinstance(meta.distribution, SyncDistribution) and meta.distribution.priority > 32)
-
         if community.dispersy_subjective_set_enabled:
-            sql = u"""SELECT sync.packet, sync.meta_message, member.public_key
-FROM sync
-JOIN member ON member.id = sync.member
-JOIN meta_message ON meta_message.id = sync.meta_message
-WHERE sync.meta_message IN (%s) AND sync.undone = 0 AND sync.global_time BETWEEN ? AND ? AND (sync.global_time + ?) %% ? = 0
-ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""" % syncable_messages
+            sqls = self._get_sync_response_sql(community, u"IFNULL(sync.packet, segment_packet(sync.location)), sync.meta_message, sync.member")
+            # when the bloom filter contains digests we only retrieve the packets that are missing
+            digest_sqls = self._get_sync_response_sql(community, u"sync.digest, sync.id, sync.meta_message, sync.member")
             meta_messages = dict((meta_message.database_id, meta_message) for meta_message in community.get_meta_messages())
-            if __debug__: dprint(sql)
+            # the member table is not available in a community database, see
+            # Community.dispersy_community_database, hence the public keys are retrieved separately
+            public_keys = {}
+            if __debug__: dprint(sqls)
 
             for message in messages:
                 payload = message.payload
 
-                if payload.sync:
+                if payload.sync and not self._is_identical_sync_range(community, message):
                     # obtain all subjective sets for the sender of the dispersy-sync message
                     assert isinstance(message.authentication, MemberAuthentication.Implementation)
                     subjective_sets = community.get_subjective_sets(message.authentication.member)
@@ -2646,11 +3067,24 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
                     time_low = min(payload.time_low, 2**63-1)
                     time_high = min(time_high, 2**63-1)
 
-                    generator = ((str(packet), meta_message_id, str(packet_public_key)) for packet, meta_message_id, packet_public_key in self._database.execute(sql, (time_low, time_high, payload.offset, payload.modulo)))
-                    for packet, meta_message_id, packet_public_key in payload.bloom_filter.not_filter(generator):
+                    bindings = (community.database_id, time_low, time_high, payload.offset, payload.modulo)
+                    # the rows are retrieved before the loop below queries the member table
+                    if isinstance(payload.bloom_filter, (DigestBloomFilter, InvertibleBloomLookupTable)):
+                        generator = ((str(digest), packet_id, meta_message_id, packet_member_id) for digest_sql in digest_sqls for digest, packet_id, meta_message_id, packet_member_id in community.sync_database.execute(digest_sql, bindings))
+                        iterator = [(packet_id, meta_message_id, packet_member_id) for _, packet_id, meta_message_id, packet_member_id in payload.bloom_filter.not_filter(generator)]
+                    else:
+                        generator = ((str(packet), meta_message_id, packet_member_id) for sql in sqls for packet, meta_message_id, packet_member_id in community.sync_database.execute(sql, bindings))
+                        iterator = list(payload.bloom_filter.not_filter(generator))
+
+                    for packet, meta_message_id, packet_member_id in iterator:
                         packet_meta = meta_messages.get(meta_message_id, None)
                         if not packet_meta:
-                            if __debug__: dprint("not syncing missing unknown message (", len(packet), " bytes, id: ", meta_message_id, ")", level="warning")
+                            if __debug__:
+                                # on the digest path PACKET is still the sync.id of the packet
+                                if isinstance(packet, (int, long)):
+                                    dprint("not syncing missing unknown message (sync id: ", packet, ", id: ", meta_message_id, ")", level="warning")
+                                else:
+                                    dprint("not syncing missing unknown message (", len(packet), " bytes, id: ", meta_message_id, ")", level="warning")
                             continue
 
                         # check if the packet uses the SubjectiveDestination policy
@@ -2662,11 +3096,20 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
                             subjective_set = subjective_sets[packet_cluster]
                             assert subjective_set, "subjective_set must be available (i.e. not None), see check_introduction_request"
 
-                            # is packet_public_key in the subjective set
+                            # is the public key of the packet creator in the subjective set
+                            packet_public_key = public_keys.get(packet_member_id)
+                            if packet_public_key is None:
+                                packet_public_key, = self._database.execute(u"SELECT public_key FROM member WHERE id = ?", (packet_member_id,)).next()
+                                packet_public_key = public_keys[packet_member_id] = str(packet_public_key)
                             if not packet_public_key in subjective_set:
                                 if __debug__: dprint("found missing ", packet_meta.name, " not matching requestors subjective set.  not syncing")
                                 continue
 
+                        if not isinstance(packet, str):
+                            # PACKET is the sync.id of a missing digest
+                            packet, = community.sync_database.execute(u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE id = ?", (packet,)).next()
+                            packet = str(packet)
+
                         if __debug__:dprint("found missing ", packet_meta.name, " (", len(packet), " bytes) ", sha1(packet).digest().encode("HEX"))
 
                         packets.append(packet)
@@ -2676,24 +3119,20 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
                                 dprint("bandwidth throttle")
                             break
 
-                    if packets:
-                        if __debug__:
-                            dprint("syncing ", len(packets), " packets (", sum(len(packet) for packet in packets), " bytes) over [", time_low, ":", time_high, "] selecting (%", payload.modulo, "+", payload.offset, ") to " , message.candidate)
-                            self._statistics.outgoing(u"-sync-", sum(len(packet) for packet in packets), len(packets))
-                        self._endpoint.send([message.candidate], packets)
+                    if __debug__: dprint("syncing over [", time_low, ":", time_high, "] selecting (%", payload.modulo, "+", payload.offset, ") to " , message.candidate)
+                    self._send_sync_packets(message.candidate, packets)
+                    self._check_sync_lookup_table(message.candidate, payload.bloom_filter)
 
         else:
-            sql = u"""SELECT sync.packet
-FROM sync
-JOIN meta_message ON meta_message.id = sync.meta_message
-WHERE sync.meta_message IN (%s) AND sync.undone = 0 AND sync.global_time BETWEEN ? AND ? AND (sync.global_time + ?) %% ? = 0
-ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""" % syncable_messages
-            if __debug__: dprint(sql)
+            sqls = self._get_sync_response_sql(community, u"IFNULL(sync.packet, segment_packet(sync.location))")
+            # when the bloom filter contains digests we only retrieve the packets that are missing
+            digest_sqls = self._get_sync_response_sql(community, u"sync.digest, sync.id")
+            if __debug__: dprint(sqls)
 
             for message in messages:
                 payload = message.payload
 
-                if payload.sync:
+                if payload.sync and not self._is_identical_sync_range(community, message):
                     # we limit the response by byte_limit bytes
                     byte_limit = community.dispersy_sync_response_limit
 
@@ -2704,24 +3143,198 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
                     time_low = min(payload.time_low, 2**63-1)
                     time_high = min(time_high, 2**63-1)
 
-                    packets = []
+                    # overlapping requests often ask for the same range, the rows selected for
+                    # recently requested ranges are cached
+                    digest = isinstance(payload.bloom_filter, (DigestBloomFilter, InvertibleBloomLookupTable))
+                    key = (time_low, time_high, payload.modulo, payload.offset, digest)
+                    rows = community.sync_response_cache.get(key)
+                    version = None if rows is not None else community.sync_response_cache.version
 
-                    generator = ((str(packet),) for packet, in self._database.execute(sql, (time_low, long(time_high), long(payload.offset), long(payload.modulo))))
-                    for packet, in payload.bloom_filter.not_filter(generator):
-                        if __debug__:dprint("found missing (", len(packet), " bytes) ", sha1(packet).digest().encode("HEX"))
+                    args = (digest_sqls if digest else sqls, (community.database_id, time_low, long(time_high), long(payload.offset), long(payload.modulo)), rows, payload.bloom_filter, byte_limit)
+                    if __debug__: dprint("syncing over [", time_low, ":", time_high, "] selecting (%", payload.modulo, "+", payload.offset, ") to " , message.candidate, "" if rows is None else " (cached)")
 
-                        packets.append(packet)
-                        byte_limit -= len(packet)
-                        if byte_limit <= 0:
-                            if __debug__:
-                                dprint("bandwidth throttle")
-                            break
+                    if self._sync_responder:
+                        # the packets are selected on the SyncResponder thread and sent from this
+                        # thread once they are available
+                        self._sync_responder.submit(self._select_missing_packets, args, self._on_missing_packets, (message.candidate, community, key, version, payload.bloom_filter), community.sync_database)
+                    else:
+                        self._on_missing_packets(message.candidate, community, key, version, payload.bloom_filter, self._select_missing_packets(community.sync_database.execute, *args))
 
-                    if packets:
-                        if __debug__:
-                            dprint("syncing ", len(packets), " packets (", sum(len(packet) for packet in packets), " bytes) over [", time_low, ":", time_high, "] selecting (%", message.payload.modulo, "+", message.payload.offset, ") to " , message.candidate)
-                            self._statistics.outgoing(u"-sync-", sum(len(packet) for packet in packets), len(packets))
-                        self._endpoint.send([message.candidate], packets)
+    def _is_identical_sync_range(self, community, message):
+        """
+        Returns True when the introduction-request MESSAGE contains a fingerprint that matches the
+        fingerprint of our packets in the requested range.  In this case we have no packets that
+        the requester is missing, and the database is not scanned.
+        """
+        payload = message.payload
+        if payload.fingerprint and community.match_sync_fingerprint(payload.time_low, payload.time_high, payload.fingerprint):
+            if __debug__: dprint("identical range [", payload.time_low, ":", payload.time_high, "] (", payload.fingerprint[0], " packets), not syncing to ", message.candidate)
+            return True
+        return False
+
+    def _get_sync_response_sql(self, community, columns):
+        """
+        Returns the SQL queries that select COLUMNS for a sync response, in the order in which they
+        must be executed.
+
+        Packets are sent in order of priority.  Within a priority, messages that synchronize in
+        DESC direction are sent before those in ASC direction.  There is one query for each
+        (priority, direction) pair, allowing each query to be answered by an ordered range scan of
+        the sync_community_undone_priority_direction_global_time_index without sorting.  The unary +
+        on sync.meta_message prevents sqlite from choosing the meta_message indexes instead, which it
+        does when a pair contains a single meta message.  See DispersySyncScript.query_plan_test.
+
+        The bindings of each query are: community, time_low, time_high, offset, and modulo.
+        @rtype: [unicode]
+        """
+        groups = {}
+        for meta in community.get_meta_messages():
+            if isinstance(meta.distribution, SyncDistribution) and meta.distribution.priority > 32:
+                groups.setdefault((meta.distribution.priority, meta.distribution.synchronization_direction_value), []).append(meta.database_id)
+
+        return [u"""SELECT %s
+FROM sync
+WHERE sync.community = ? AND sync.undone = 0 AND sync.priority = %d AND sync.direction = %d AND +sync.meta_message IN (%s) AND sync.global_time BETWEEN ? AND ? AND (sync.global_time + ?) %% ? = 0
+ORDER BY sync.global_time %s""" % (columns, priority, direction, u", ".join(unicode(database_id) for database_id in database_ids), u"DESC" if direction == -1 else u"ASC")
+                for (priority, direction), database_ids
+                in sorted(groups.iteritems(), key=lambda ((priority, direction), _): (-priority, direction))]
+
+    def _select_missing_packets(self, execute, sqls, bindings, rows, bloom_filter, byte_limit):
+        """
+        Returns a (rows, packets) tuple containing the rows selected by SQLS and the packets in
+        those rows that are not in BLOOM_FILTER.
+
+        When ROWS is given, i.e. the rows were cached, SQLS are not executed.  For a
+        DigestBloomFilter or InvertibleBloomLookupTable each row is a (digest, sync.id) tuple and
+        the missing packets are retrieved by id, otherwise each row is a (packet,) tuple.
+
+        Packets are returned until BYTE_LIMIT bytes have been selected.  EXECUTE is either
+        Database.execute or DatabaseReader.execute, in the latter case this method is called on
+        the SyncResponder thread and must not use any other Dispersy state.
+
+        @rtype: ([tuple], [str])
+        """
+        if rows is None:
+            rows = [(str(row[0]),) + row[1:] for sql in sqls for row in execute(sql, bindings)]
+
+        if isinstance(bloom_filter, (DigestBloomFilter, InvertibleBloomLookupTable)):
+            packet_ids = [packet_id for _, packet_id in bloom_filter.not_filter(iter(rows))]
+            iterator = ((str(execute(u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE id = ?", (packet_id,)).next()[0]),) for packet_id in packet_ids)
+        else:
+            iterator = bloom_filter.not_filter(iter(rows))
+
+        packets = []
+        for packet, in iterator:
+            if __debug__:dprint("found missing (", len(packet), " bytes) ", sha1(packet).digest().encode("HEX"))
+
+            packets.append(packet)
+            byte_limit -= len(packet)
+            if byte_limit <= 0:
+                if __debug__:
+                    dprint("bandwidth throttle")
+                break
+
+        return rows, packets
+
+    def _on_missing_packets(self, candidate, community, key, version, bloom_filter, result):
+        """
+        Cache the rows selected by _select_missing_packets and send the missing packets.
+
+        VERSION is None when the rows were taken from the cache.
+        """
+        rows, packets = result
+        if version is not None:
+            community.sync_response_cache.set(key, rows, version)
+        self._send_sync_packets(candidate, packets)
+        self._check_sync_lookup_table(candidate, bloom_filter)
+
+    def _check_sync_lookup_table(self, candidate, bloom_filter):
+        """
+        Remember when BLOOM_FILTER, received from CANDIDATE, is an InvertibleBloomLookupTable that
+        could not be decoded.  The next message to CANDIDATE will ask it to send a bloom filter
+        instead, see _announce_reconciliation.
+        """
+        if isinstance(bloom_filter, InvertibleBloomLookupTable) and bloom_filter.decoded is False:
+            walk_candidate = self.get_candidate(candidate.sock_addr, replace=False)
+            if walk_candidate:
+                if __debug__: dprint("unable to decode the lookup table from ", walk_candidate, level="warning")
+                walk_candidate.reconciliation_failed = True
+
+    def _announce_reconciliation(self, community, candidate):
+        """
+        Returns the reconciliation flag for a dispersy-introduction-request or
+        dispersy-introduction-response to CANDIDATE.
+
+        After a lookup table from CANDIDATE could not be decoded, one message announces that no
+        lookup table is accepted.  Hence CANDIDATE falls back to a bloom filter in its next
+        dispersy-introduction-request.
+        """
+        if isinstance(candidate, WalkCandidate) and candidate.reconciliation_failed:
+            candidate.reconciliation_failed = False
+            return False
+        return community.dispersy_sync_reconciliation
+
+    def _send_sync_packets(self, candidate, packets):
+        """
+        Send the PACKETS, selected by _select_missing_packets, to CANDIDATE.
+
+        When a sync_response_rate is set the packets are queued and sent by
+        _paced_sync_response.  A candidate has at most one queued response, PACKETS replace any
+        packets that are still queued for CANDIDATE since they were selected using an older bloom
+        filter.
+        """
+        if packets:
+            if self._sync_response_rate > 0:
+                queue = self._sync_response_queues.get(candidate.sock_addr)
+                if queue is None:
+                    queue = self._sync_response_queues[candidate.sock_addr] = deque(packets)
+                    self._callback.register(self._paced_sync_response, (candidate, queue))
+                else:
+                    if __debug__: dprint("replacing ", len(queue), " queued packets to ", candidate)
+                    queue.clear()
+                    queue.extend(packets)
+
+            else:
+                if __debug__:
+                    dprint("syncing ", len(packets), " packets (", sum(len(packet) for packet in packets), " bytes) to " , candidate)
+                    self._statistics.outgoing(u"-sync-", sum(len(packet) for packet in packets), len(packets))
+                self._endpoint.send([candidate], packets)
+
+    def _paced_sync_response(self, candidate, queue, interval=0.1):
+        """
+        Send the packets in QUEUE to CANDIDATE at no more than sync_response_rate bytes per second.
+
+        Every INTERVAL seconds the packets that fit in the allowance are given to the endpoint at
+        once.  A packet larger than the remaining allowance is still sent, the excess is deducted
+        from the next allowance.
+        """
+        allowance = 0.0
+        try:
+            while queue:
+                if self._sync_response_rate > 0:
+                    allowance += self._sync_response_rate * interval
+                else:
+                    # pacing was disabled, send everything that remains
+                    allowance = float(sum(len(packet) for packet in queue))
+
+                packets = []
+                while queue and allowance > 0.0:
+                    packet = queue.popleft()
+                    packets.append(packet)
+                    allowance -= len(packet)
+
+                if packets:
+                    if __debug__:
+                        dprint("syncing ", len(packets), " packets (", sum(len(packet) for packet in packets), " bytes) to " , candidate, " (", len(queue), " packets queued)")
+                        self._statistics.outgoing(u"-sync-", sum(len(packet) for packet in packets), len(packets))
+                    self._endpoint.send([candidate], packets)
+
+                if queue:
+                    yield interval
+
+        finally:
+            if self._sync_response_queues.get(candidate.sock_addr) is queue:
+                del self._sync_response_queues[candidate.sock_addr]
 
     def check_introduction_response(self, messages):
         for message in messages:
@@ -2777,6 +3390,7 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
                 candidate = self.create_candidate(message.candidate.sock_addr, message.candidate.tunnel, source_lan_address, source_wan_address, payload.connection_type)
             else:
                 candidate.update(candidate.tunnel, source_lan_address, source_wan_address, payload.connection_type)
+            candidate.reconciliation = payload.reconciliation
 
             # until we implement a proper 3-way handshake we are going to assume that the creator of
             # this message is associated to this candidate
@@ -2921,7 +3535,9 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
         database commit not after the (1) store operation but after the (2) update operation.  This
         will ensure that any database changes from handling the message are also synced to disk.  It
         is important to note that the sync will occur before the (3) forward operation to ensure
-        that no remote nodes will obtain data that we have not safely synced ourselves.
+        that no remote nodes will obtain data that we have not safely synced ourselves.  When group
+        commits are enabled, see Database.set_group_commit, the commit and hence the forward may be
+        delayed to combine several commits into one.
 
         For performance reasons messages are processed in batches, where each batch contains only
         messages from the same community and the same meta message instance.  This method, or more
@@ -2975,12 +3591,28 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
                 level = "warning" if (end - begin) > 1.0 else "normal"
                 dprint("handler for ", messages[0].name, " took ", end - begin, " seconds", level=level)
 
-        # 07/10/11 Boudewijn: we will only commit if it the message was create by our self.
-        # Otherwise we can safely skip the commit overhead, since, if a crash occurs, we will be
-        # able to regain the data eventually
-        if store and any(message.authentication.member == message.community.my_member for message in messages):
-            if __debug__: dprint("commit user generated message")
-            self._database.commit()
+        if store:
+            # 07/10/11 Boudewijn: we will only commit if it the message was create by our self.
+            # Otherwise we can safely skip the commit overhead, since, if a crash occurs, we will be
+            # able to regain the data eventually
+            if any(message.authentication.member == message.community.my_member for message in messages):
+                if __debug__: dprint("commit user generated message")
+                if self._database.group_commit_latency is None:
+                    # without group commits we commit immediately and forward below.  the commit
+                    # may be deferred by an IgnoreCommits block, the forward is not
+                    self._database.commit()
+                elif forward:
+                    # the messages are forwarded once they are committed, this may be immediately
+                    # or, when group commits are enabled, after a short delay
+                    self._database.group_commit(len(messages), func=self._forward, args=(messages,))
+                    forward = False
+                else:
+                    self._database.group_commit(len(messages), durable=True)
+            else:
+                self._database.group_commit(len(messages))
+
+            if self._database.group_commit_latency is not None and self._database.group_commit_pending:
+                self._callback.persistent_register(u"dispersy-group-commit", self._database.flush_group_commit, delay=self._database.group_commit_latency)
 
         if forward:
             if not self._forward(messages):
@@ -3107,8 +3739,14 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
                                    ((community.database_id, member.database_id, buffer(packet.packet)) for packet in packets))
 
         # remove all messages created by the malicious member
-        self._database.execute(u"DELETE FROM sync WHERE community = ? AND member = ?",
-                               (community.database_id, member.database_id))
+        community.sync_database.execute(u"DELETE FROM sync WHERE community = ? AND member = ?",
+                                        (community.database_id, member.database_id))
+        community.reset_sync_range()
+        community.recent_sync_keys.clear()
+        for key in [key for key in self._highest_sequence_numbers if key[0] == member.database_id]:
+            del self._highest_sequence_numbers[key]
+        for key in [key for key in self._last_sync_histories if member.database_id in key[1]]:
+            del self._last_sync_histories[key]
 
         # TODO: if we have a address for the malicious member, we can also remove her from the
         # candidate table
@@ -3168,8 +3806,8 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
             member_database_id = message.payload.member.database_id
             for global_time in message.payload.global_times:
                 try:
-                    packet, = self._database.execute(u"SELECT packet FROM sync WHERE community = ? AND member = ? AND global_time = ?",
-                                                     (community_database_id, member_database_id, global_time)).next()
+                    packet, = message.community.sync_database.execute(u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? AND member = ? AND global_time = ?",
+                                                                      (community_database_id, member_database_id, global_time)).next()
                 except StopIteration:
                     pass
                 else:
@@ -3211,8 +3849,8 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
     def on_missing_last_message(self, messages):
         for message in messages:
             payload = message.payload
-            packets = [str(packet) for packet, in list(self._database.execute(u"SELECT packet FROM sync WHERE community = ? AND member = ? AND meta_message = ? ORDER BY global_time DESC LIMIT ?",
-                                                                              (message.community.database_id, payload.member.database_id, payload.message.database_id, payload.count)))]
+            packets = [str(packet) for packet, in list(message.community.sync_database.execute(u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? AND member = ? AND meta_message = ? ORDER BY global_time DESC LIMIT ?",
+                                                                                               (message.community.database_id, payload.member.database_id, payload.message.database_id, payload.count)))]
             self._endpoint.send([message.candidate], packets)
 
     def _is_valid_lan_address(self, address, check_my_lan_address=True):
@@ -3367,6 +4005,9 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
         We received a dispersy-identity message.
         """
         for message in messages:
+            # the public key for this mid is now in the database
+            self._unknown_mids.pop(message.authentication.member.mid, None)
+
             # get cache object linked to this request and stop timeout from occurring
             identifier = MissingMemberCache.message_to_identifier(message)
             cache = self._request_cache.pop(identifier, MissingMemberCache)
@@ -3420,9 +4061,11 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
         """
         meta = messages[0].community.get_meta_message(u"dispersy-identity")
         for message in messages:
-            # we are assuming that no more than 10 members have the same sha1 digest.
-            sql = u"SELECT packet FROM sync JOIN member ON member.id = sync.member WHERE sync.community = ? AND sync.meta_message = ? AND member.mid = ? LIMIT 10"
-            packets = [str(packet) for packet, in self._database.execute(sql, (message.community.database_id, meta.database_id, buffer(message.payload.mid)))]
+            # we are assuming that no more than 10 members have the same sha1 digest.  the member
+            # table is not available in a community database, hence the members are selected first
+            member_ids = [member_id for member_id, in self._database.execute(u"SELECT id FROM member WHERE mid = ? LIMIT 10", (buffer(message.payload.mid),))]
+            sql = u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? AND meta_message = ? AND member IN (%s)" % ", ".join("?" * len(member_ids))
+            packets = [str(packet) for packet, in message.community.sync_database.execute(sql, [message.community.database_id, meta.database_id] + member_ids)] if member_ids else []
             if packets:
                 if __debug__:
                     dprint("responding with ", len(packets), " identity messages")
@@ -3805,8 +4448,8 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
                 packet_limit -= (highest - lowest) + 1
 
                 if __debug__: dprint("fetching member:", member_id, " message:", message_id, ", ", highest - lowest + 1, " packets from database for ", candidate)
-                for packet, in self._database.execute(u"SELECT packet FROM sync WHERE member = ? AND meta_message = ? ORDER BY global_time LIMIT ? OFFSET ?",
-                                                      (member_id, message_id, highest - lowest + 1, lowest - 1)):
+                for packet, in community.sync_database.execute(u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE member = ? AND meta_message = ? AND sequence_number BETWEEN ? AND ? ORDER BY sequence_number",
+                                                               (member_id, message_id, lowest, highest)):
                     packet = str(packet)
                     packets.append(packet)
 
@@ -3856,8 +4499,8 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
         community = messages[0].community
         for message in messages:
             try:
-                packet, = self._database.execute(u"SELECT packet FROM sync WHERE community = ? AND member = ? AND global_time = ? LIMIT 1",
-                                                 (community.database_id, message.payload.member.database_id, message.payload.global_time)).next()
+                packet, = community.sync_database.execute(u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? AND member = ? AND global_time = ? LIMIT 1",
+                                                          (community.database_id, message.payload.member.database_id, message.payload.global_time)).next()
 
             except StopIteration:
                 if __debug__: dprint("someone asked for proof for a message that we do not have", level="warning")
@@ -4090,8 +4733,8 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
         # infinate data traffic).  nodes that notice this behavior must blacklist the offending
         # node.  hence we ensure that we did not send an undo before
         try:
-            undone, = self._database.execute(u"SELECT undone FROM sync WHERE community = ? AND member = ? AND global_time = ?",
-                                             (community.database_id, message.authentication.member.database_id, message.distribution.global_time)).next()
+            undone, = community.sync_database.execute(u"SELECT undone FROM sync WHERE community = ? AND member = ? AND global_time = ?",
+                                                      (community.database_id, message.authentication.member.database_id, message.distribution.global_time)).next()
 
         except StopIteration:
             assert False, "The message that we want to undo does not exist.  Programming error"
@@ -4104,8 +4747,8 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
                 # already undone.  refuse to undo again but return the previous undo message
                 undo_own_meta = community.get_meta_message(u"dispersy-undo-own")
                 undo_other_meta = community.get_meta_message(u"dispersy-undo-other")
-                for packet_id, message_id, packet in self._database.execute(u"SELECT id, meta_message, packet FROM sync WHERE community = ? AND member = ? AND meta_message IN (?, ?)",
-                                                                            (community.database_id, message.authentication.member.database_id, undo_own_meta.database_id, undo_other_meta.database_id)):
+                for packet_id, message_id, packet in community.sync_database.execute(u"SELECT id, meta_message, IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? AND member = ? AND meta_message IN (?, ?)",
+                                                                                     (community.database_id, message.authentication.member.database_id, undo_own_meta.database_id, undo_other_meta.database_id)):
                     msg = Packet(undo_own_meta if undo_own_meta.database_id == message_id else undo_other_meta, str(packet), packet_id).load_message()
                     if message.distribution.global_time == msg.payload.global_time:
                         return msg
@@ -4145,7 +4788,7 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
                 continue
 
             try:
-                undone, = self._database.execute(u"SELECT undone FROM sync WHERE id = ?", (message.payload.packet.packet_id,)).next()
+                undone, = message.community.sync_database.execute(u"SELECT undone FROM sync WHERE id = ?", (message.payload.packet.packet_id,)).next()
             except StopIteration:
                 assert False, "The conversion ensures that the packet exists in the DB.  Hence this should never occur"
                 undone = 0
@@ -4166,7 +4809,7 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
                 community = message.community
                 member = message.authentication.member
                 undo_own_meta = community.get_meta_message(u"dispersy-undo-own")
-                for packet_id, packet in self._database.execute(u"SELECT id, packet FROM sync WHERE community = ? AND member = ? AND meta_message = ?",
+                for packet_id, packet in community.sync_database.execute(u"SELECT id, IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? AND member = ? AND meta_message = ?",
                                                                             (community.database_id, member.database_id, undo_own_meta.database_id)):
                     msg = Packet(undo_own_meta, str(packet), packet_id).load_message()
                     if message.payload.global_time == msg.payload.global_time:
@@ -4200,14 +4843,16 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
         """
         assert all(message.name in (u"dispersy-undo-own", u"dispersy-undo-other") for message in messages)
 
-        self._database.executemany(u"UPDATE sync SET undone = ? WHERE community = ? AND member = ? AND global_time = ?",
-                                   ((message.packet_id, message.community.database_id, message.payload.member.database_id, message.payload.global_time) for message in messages))
+        messages[0].community.sync_database.executemany(u"UPDATE sync SET undone = ? WHERE community = ? AND member = ? AND global_time = ?",
+                                                        ((message.packet_id, message.community.database_id, message.payload.member.database_id, message.payload.global_time) for message in messages))
         for meta, iterator in groupby(messages, key=lambda x: x.payload.packet.meta):
             sub_messages = list(iterator)
             meta.undo_callback([(message.payload.member, message.payload.global_time, message.payload.packet) for message in sub_messages])
 
             # notify that global times have changed
-            # meta.community.update_sync_range(meta, [message.payload.global_time for message in sub_messages])
+            meta.community.update_sync_range(meta, [message.payload.global_time for message in sub_messages])
+            for message in sub_messages:
+                meta.community.recent_sync_keys.discard((message.payload.member.database_id, message.payload.global_time))
 
         # this might be a response to a dispersy-missing-sequence
         self.handle_missing_messages(messages, MissingSequenceCache)
@@ -4281,11 +4926,15 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
 
                 # 1. remove all except the dispersy-authorize, dispersy-destroy-community, and
                 # dispersy-identity messages
-                self._database.execute(u"DELETE FROM sync WHERE community = ? AND NOT (meta_message = ? OR meta_message = ? OR meta_message = ?)", (community.database_id, authorize_message_id, destroy_message_id, identity_message_id))
+                community.sync_database.execute(u"DELETE FROM sync WHERE community = ? AND NOT (meta_message = ? OR meta_message = ? OR meta_message = ?)", (community.database_id, authorize_message_id, destroy_message_id, identity_message_id))
+                community.reset_sync_range()
+                community.recent_sync_keys.clear()
+                self._highest_sequence_numbers.clear()
+                self._last_sync_histories.clear()
 
                 # 2. cleanup the reference_member_sync table.  however, we should keep the ones
                 # that are still referenced
-                self._database.execute(u"DELETE FROM reference_member_sync WHERE NOT EXISTS (SELECT * FROM sync WHERE community = ? AND sync.id = reference_member_sync.sync)", (community.database_id,))
+                community.sync_database.execute(u"DELETE FROM reference_member_sync WHERE NOT EXISTS (SELECT * FROM sync WHERE community = ? AND sync.id = reference_member_sync.sync)", (community.database_id,))
 
                 # 3. cleanup the malicious_proof table.  we need nothing here anymore
                 self._database.execute(u"DELETE FROM malicious_proof WHERE community = ?", (community.database_id,))
@@ -4324,14 +4973,14 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
 
         if not initializing:
             if __debug__: dprint("updating ", len(changes), " ranges")
-            execute = self._database.execute
-            executemany = self._database.executemany
+            execute = community.sync_database.execute
+            executemany = community.sync_database.executemany
             for meta, range_ in changes.iteritems():
                 if __debug__: dprint(meta.name, " [", range_[0], ":", "]")
                 undo = []
                 redo = []
 
-                for packet_id, packet, undone in list(execute(u"SELECT id, packet, undone FROM sync WHERE meta_message = ? AND global_time BETWEEN ? AND ?",
+                for packet_id, packet, undone in list(execute(u"SELECT id, IFNULL(packet, segment_packet(location)), undone FROM sync WHERE meta_message = ? AND global_time BETWEEN ? AND ?",
                                                               (meta.database_id, range_[0], range_[1]))):
                     message = self.convert_packet_to_message(str(packet), community)
                     if message:
@@ -4354,7 +5003,9 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
                     meta.undo_callback([(message.authentication.member, message.distribution.global_time, message) for message in undo])
 
                     # notify that global times have changed
-                    # meta.community.update_sync_range(meta, [message.distribution.global_time for message in undo])
+                    meta.community.update_sync_range(meta, [message.distribution.global_time for message in undo])
+                    for message in undo:
+                        meta.community.recent_sync_keys.discard((message.authentication.member.database_id, message.distribution.global_time))
 
                 if redo:
                     executemany(u"UPDATE sync SET undone = 0 WHERE id = ?", ((message.packet_id,) for message in redo))
@@ -4362,7 +5013,7 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
                     meta.handle_callback(redo)
 
                     # notify that global times have changed
-                    # meta.community.update_sync_range(meta, [message.distribution.global_time for message in redo])
+                    meta.community.update_sync_range(meta, [message.distribution.global_time for message in redo])
 
         # this might be a response to a dispersy-missing-proof or dispersy-missing-sequence
         self.handle_missing_messages(messages, MissingProofCache, MissingSequenceCache)
@@ -4385,7 +5036,7 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
             assert isinstance(bindings, tuple)
             limit = 100
             for offset in (i * limit for i in count()):
-                rows = list(self._database.execute(sql, bindings + (limit, offset)))
+                rows = list(community.sync_database.execute(sql, bindings + (limit, offset)))
                 if rows:
                     for row in rows:
                         yield row
@@ -4418,7 +5069,7 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
                 raise ValueError("unable to find the private key for my member")
 
             try:
-                self._database.execute(u"SELECT 1 FROM sync WHERE member = ? AND meta_message = ?", (member_id, meta_identity.database_id)).next()
+                community.sync_database.execute(u"SELECT 1 FROM sync WHERE member = ? AND meta_message = ?", (member_id, meta_identity.database_id)).next()
             except StopIteration:
                 raise ValueError("unable to find the dispersy-identity message for my member")
 
@@ -4428,8 +5079,8 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
             # the dispersy-identity must be in the database for each member that has one or more
             # messages in the database
             #
-            A = set(id_ for id_, in self._database.execute(u"SELECT member FROM sync WHERE community = ? GROUP BY member", (community.database_id,)))
-            B = set(id_ for id_, in self._database.execute(u"SELECT member FROM sync WHERE meta_message = ?", (meta_identity.database_id,)))
+            A = set(id_ for id_, in community.sync_database.execute(u"SELECT member FROM sync WHERE community = ? GROUP BY member", (community.database_id,)))
+            B = set(id_ for id_, in community.sync_database.execute(u"SELECT member FROM sync WHERE meta_message = ?", (meta_identity.database_id,)))
             if not len(A) == len(B):
                 raise ValueError("inconsistent dispersy-identity messages.", A.difference(B))
 
@@ -4444,13 +5095,13 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
             # ensure that we have proof for every dispersy-undo-other message
             #
             # TODO we are not taking into account that undo messages can be undone
-            for undo_packet_id, undo_packet_global_time, undo_packet in select(u"SELECT id, global_time, packet FROM sync WHERE community = ? AND meta_message = ? ORDER BY id LIMIT ? OFFSET ?", (community.database_id, meta_undo_other.database_id)):
+            for undo_packet_id, undo_packet_global_time, undo_packet in select(u"SELECT id, global_time, IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? AND meta_message = ? ORDER BY id LIMIT ? OFFSET ?", (community.database_id, meta_undo_other.database_id)):
                 undo_packet = str(undo_packet)
                 undo_message = self.convert_packet_to_message(undo_packet, community)
 
                 # get the message that undo_message refers to
                 try:
-                    packet, undone = self._database.execute(u"SELECT packet, undone FROM sync WHERE community = ? AND member = ? AND global_time = ?", (community.database_id, undo_message.payload.member.database_id, undo_message.payload.global_time)).next()
+                    packet, undone = community.sync_database.execute(u"SELECT IFNULL(packet, segment_packet(location)), undone FROM sync WHERE community = ? AND member = ? AND global_time = ?", (community.database_id, undo_message.payload.member.database_id, undo_message.payload.global_time)).next()
                 except StopIteration:
                     raise ValueError("found dispersy-undo-other but not the message that it refers to")
                 packet = str(packet)
@@ -4477,7 +5128,7 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
         # ensure all packets in the database are valid and that the binary packets are consistent
         # with the information stored in the database
         #
-        for packet_id, member_id, global_time, meta_message_id, packet in select(u"SELECT id, member, global_time, meta_message, packet FROM sync WHERE community = ? ORDER BY id LIMIT ? OFFSET ?", (community.database_id,)):
+        for packet_id, member_id, global_time, meta_message_id, packet in select(u"SELECT id, member, global_time, meta_message, IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? ORDER BY id LIMIT ? OFFSET ?", (community.database_id,)):
             if meta_message_id in enabled_messages:
                 packet = str(packet)
                 message = self.convert_packet_to_message(packet, community)
@@ -4510,7 +5161,7 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
             if isinstance(meta.distribution, FullSyncDistribution) and meta.distribution.enable_sequence_number:
                 counter = 0
                 counter_member_id = 0
-                for packet_id, member_id, packet in select(u"SELECT id, member, packet FROM sync WHERE meta_message = ? ORDER BY member, global_time LIMIT ? OFFSET ?", (meta.database_id,)):
+                for packet_id, member_id, packet in select(u"SELECT id, member, IFNULL(packet, segment_packet(location)) FROM sync WHERE meta_message = ? ORDER BY member, global_time LIMIT ? OFFSET ?", (meta.database_id,)):
                     message = self.convert_packet_to_message(str(packet), community)
                     assert message
 
@@ -4533,7 +5184,7 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
                 if isinstance(meta.authentication, MemberAuthentication):
                     counter = 0
                     counter_member_id = 0
-                    for packet_id, member_id, packet in select(u"SELECT id, member, packet FROM sync WHERE meta_message = ? ORDER BY member ASC, global_time DESC LIMIT ? OFFSET ?", (meta.database_id,)):
+                    for packet_id, member_id, packet in select(u"SELECT id, member, IFNULL(packet, segment_packet(location)) FROM sync WHERE meta_message = ? ORDER BY member ASC, global_time DESC LIMIT ? OFFSET ?", (meta.database_id,)):
                         message = self.convert_packet_to_message(str(packet), community)
                         assert message
 
@@ -4552,11 +5203,11 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
                 else:
                     assert isinstance(meta.authentication, MultiMemberAuthentication)
                     counters = {}
-                    for packet_id, member_id, packet in select(u"SELECT id, member, packet FROM sync WHERE meta_message = ? ORDER BY member ASC, global_time DESC LIMIT ? OFFSET ?", (meta.database_id,)):
+                    for packet_id, member_id, packet in select(u"SELECT id, member, IFNULL(packet, segment_packet(location)) FROM sync WHERE meta_message = ? ORDER BY member ASC, global_time DESC LIMIT ? OFFSET ?", (meta.database_id,)):
                         message = self.convert_packet_to_message(str(packet), community)
                         assert message
 
-                        members = list(self._database.execute(u"SELECT member FROM reference_member_sync WHERE sync = ? ORDER BY member", (packet_id,)))
+                        members = list(community.sync_database.execute(u"SELECT member FROM reference_member_sync WHERE sync = ? ORDER BY member", (packet_id,)))
                         if members in counters:
                             counters[members] += 1
                         else:
@@ -4604,9 +5255,7 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
         numbers are used.
         """
         assert isinstance(meta.distribution, FullSyncDistribution), "currently only FullSyncDistribution allows sequence numbers"
-        sequence_number, = self._database.execute(u"SELECT COUNT(1) FROM sync WHERE member = ? AND sync.meta_message = ?",
-                                                  (community.master_member.database_id, meta.database_id)).next()
-        return sequence_number + 1
+        return self._get_highest_sequence_number(community.master_member, meta) + 1
 
     def _watchdog(self):
         """
@@ -4624,8 +5273,49 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
                     dprint("shutdown")
                     dprint(self.info(), pprint=True)
                 self._database.commit()
+                if self._sync_responder:
+                    self._sync_responder.stop()
                 break
 
+    def _compact_packet_segments(self):
+        """
+        Periodically remove the packets that are no longer referenced from the segment files.
+
+        Packets remain in their segment file when their sync row is deleted or replaced, for
+        example when a LastSyncDistribution history is pruned or a malicious member is removed.
+        Once less than half of a segment is still referenced, the referenced packets are appended
+        to the active segment and the old segment is removed.
+
+        Communities with their own database, see Community.dispersy_community_database, never
+        store their packets in a segment file.
+        """
+        packet_store = self._database.packet_store
+        while True:
+            yield 60.0
+
+            packet_store.remove_retired()
+
+            # the most recent segment is (or will become) the active segment
+            for segment, size in packet_store.segments()[:-1]:
+                if segment in packet_store.retired_segments:
+                    continue
+
+                low, high = segment_location_range(segment)
+                live_size, = self._database.execute(u"SELECT SUM(location & 65535) FROM sync WHERE location BETWEEN ? AND ?", (low, high)).next()
+                if live_size and live_size * 2 >= size:
+                    continue
+
+                rows = list(self._database.execute(u"SELECT id, location FROM sync WHERE location BETWEEN ? AND ?", (low, high)))
+                if __debug__: dprint("compacting segment ", segment, " (", live_size or 0, " of ", size, " bytes in ", len(rows), " packets)")
+                self._database.executemany(u"UPDATE sync SET location = ? WHERE id = ?",
+                                           [(packet_store.append(packet_store.read(location)), id_) for id_, location in rows])
+                # the commit will fsync the active segment before the new locations are committed
+                self._database.commit()
+                packet_store.retire(segment)
+
+                # compact one segment at a time
+                yield 1.0
+
     def _candidate_walker(self):
         """
         Periodically select a candidate and take a step in the network.
@@ -4811,9 +5501,20 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
         # 3.3: added info["walk_fail"] in __debug__ mode
         # 3.4: added info["walk_reset"]
         # 3.4: added info["attachment"] in __debug__ mode
+        # 3.5: added info["verification"] when a signature verifier is used
+        # 3.6: added info["signature_cache"]
+        # 3.7: added info["member_cache"]
+        # 3.8: added community["sync_ranges"]
+        # 3.9: added info["sync_responder"] when a sync responder is used
+        # 4.0: added info["database_statements"]
+        # 4.1: added info["packet_store"]
+        # 4.2: added info["sync_response_queues"] when sync responses are paced
+        # 4.3: added community["sync_response_cache"]
+        # 4.4: added community["sync_fingerprints"] when fingerprints are used
+        # 4.5: added community["sync_planner"]
 
         now = time()
-        info = {"version":3.4,
+        info = {"version":4.5,
                 "class":"Dispersy",
                 "lan_address":self._lan_address,
                 "wan_address":self._wan_address,
@@ -4825,6 +5526,18 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
 
         if statistics:
             info.update(self._statistics.info())
+            if self._signature_verifier:
+                info["verification"] = self._signature_verifier.info()
+            info["signature_cache"] = self._signature_cache.info()
+            info["member_cache"] = Member.get_cache().info()
+            if self._sync_responder:
+                info["sync_responder"] = self._sync_responder.info()
+            info["database_statements"] = self._database.statement_info()
+            info["packet_store"] = self._database.packet_store.info()
+            if self._sync_response_rate > 0:
+                info["sync_response_queues"] = {"candidates":len(self._sync_response_queues),
+                                                "packets":sum(len(queue) for queue in self._sync_response_queues.itervalues()),
+                                                "bytes":sum(len(packet) for queue in self._sync_response_queues.itervalues() for packet in queue)}
 
         info["communities"] = []
         for community in self._communities.itervalues():
@@ -4847,13 +5560,19 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
                                                         "dispersy_enable_candidate_walker",
                                                         "dispersy_enable_candidate_walker_responses"))
 
-            # if sync_ranges:
-            #     community_info["sync_ranges"] = [{"time_low":range_.time_low, "space_freed":range_.space_freed, "space_remaining":range_.space_remaining, "capacity":range_.capacity}
-            #                                      for range_
-            #                                      in community._sync_ranges]
+            if sync_ranges and community.sync_range_cache:
+                community_info["sync_ranges"] = community.sync_range_cache.info()
+
+            if statistics:
+                community_info["sync_response_cache"] = community.sync_response_cache.info()
+                if community.sync_fingerprint_cache:
+                    community_info["sync_fingerprints"] = community.sync_fingerprint_cache.info()
+                community_info["sync_planner"] = community.sync_planner.info()
 
             if database_sync:
-                community_info["database_sync"] = dict(self._database.execute(u"SELECT meta_message.name, COUNT(sync.id) FROM sync JOIN meta_message ON meta_message.id = sync.meta_message WHERE sync.community = ? GROUP BY sync.meta_message", (community.database_id,)))
+                # the sync table may be in a community database, hence it can not be joined with meta_message
+                names = dict(self._database.execute(u"SELECT id, name FROM meta_message WHERE community = ?", (community.database_id,)))
+                community_info["database_sync"] = dict((names[meta_message_id], count_) for meta_message_id, count_ in community.sync_database.execute(u"SELECT meta_message, COUNT(id) FROM sync WHERE community = ? GROUP BY meta_message", (community.database_id,)))
 
             if candidate:
                 community_info["candidates"] = [(candidate.lan_address, candidate.wan_address, candidate.get_global_time(community)) for candidate in self._candidates.itervalues() if candidate.in_community(community, now) and candidate.is_any_active(now)]
@@ -6,14 +6,17 @@ This module provides an interface to the Dispersy database.
 @contact: dispersy@frayja.com
 """
 
-from os import path
+from hashlib import sha1
+from os import path, makedirs
 
 from database import Database
+from distribution import FullSyncDistribution
+from segmentstore import PacketSegmentStore
 
 if __debug__:
     from dprint import dprint
 
-LATEST_VERSION = 12
+LATEST_VERSION = 16
 
 schema = u"""
 CREATE TABLE member(
@@ -59,9 +62,18 @@ CREATE TABLE sync(
  meta_message INTEGER REFERENCES meta_message(id),
  undone INTEGER DEFAULT 0,
  packet BLOB,
+ digest BLOB,                                           -- sha1 digest of the packet
+ sequence_number INTEGER DEFAULT 0,                     -- 0 when sequence numbers are disabled
+ location INTEGER,                                      -- packet location in a segment file when packet is NULL
+ priority INTEGER DEFAULT 128,                          -- copy of meta_message.priority
+ direction INTEGER DEFAULT 1,                           -- copy of meta_message.direction
  UNIQUE(community, member, global_time));
 CREATE INDEX sync_meta_message_undone_global_time_index ON sync(meta_message, undone, global_time);
 CREATE INDEX sync_meta_message_member ON sync(meta_message, member);
+CREATE INDEX sync_member_meta_message_sequence_number_index ON sync(member, meta_message, sequence_number);
+CREATE INDEX sync_location_index ON sync(location);
+CREATE INDEX sync_community_undone_global_time_index ON sync(community, undone, global_time, meta_message, digest);
+CREATE INDEX sync_community_undone_priority_direction_global_time_index ON sync(community, undone, priority, direction, global_time, meta_message, member, digest);
 
 CREATE TABLE malicious_proof(
  id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -73,6 +85,94 @@ CREATE TABLE option(key TEXT PRIMARY KEY, value BLOB);
 INSERT INTO option(key, value) VALUES('database_version', '""" + str(LATEST_VERSION) + """');
 """
 
+community_schema = u"""
+CREATE TABLE reference_member_sync(
+ member INTEGER,                                        -- member.id in the Dispersy database
+ sync INTEGER REFERENCES sync(id),
+ UNIQUE(member, sync));
+
+CREATE TABLE sync(
+ id INTEGER PRIMARY KEY AUTOINCREMENT,
+ community INTEGER,                                     -- community.id in the Dispersy database
+ member INTEGER,                                        -- member.id in the Dispersy database
+ global_time INTEGER,
+ meta_message INTEGER,                                  -- meta_message.id in the Dispersy database
+ undone INTEGER DEFAULT 0,
+ packet BLOB,
+ digest BLOB,                                           -- sha1 digest of the packet
+ sequence_number INTEGER DEFAULT 0,                     -- 0 when sequence numbers are disabled
+ location INTEGER,                                      -- always NULL, packets are stored in the packet column
+ priority INTEGER DEFAULT 128,                          -- copy of meta_message.priority
+ direction INTEGER DEFAULT 1,                           -- copy of meta_message.direction
+ UNIQUE(community, member, global_time));
+CREATE INDEX sync_meta_message_undone_global_time_index ON sync(meta_message, undone, global_time);
+CREATE INDEX sync_meta_message_member ON sync(meta_message, member);
+CREATE INDEX sync_member_meta_message_sequence_number_index ON sync(member, meta_message, sequence_number);
+CREATE INDEX sync_community_undone_global_time_index ON sync(community, undone, global_time, meta_message, digest);
+CREATE INDEX sync_community_undone_priority_direction_global_time_index ON sync(community, undone, priority, direction, global_time, meta_message, member, digest);
+
+CREATE TABLE option(key TEXT PRIMARY KEY, value BLOB);
+INSERT INTO option(key, value) VALUES('database_version', '1');
+"""
+
+def _segment_packet_function(packet_store):
+    """
+    Returns the segment_packet SQL function that reads packets from PACKET_STORE.
+
+    The packet column is NULL for packets that are stored in a segment file, these packets must be
+    selected using IFNULL(packet, segment_packet(location)).
+    """
+    def segment_packet(location):
+        return None if location is None else buffer(packet_store.read(location))
+    return segment_packet
+
+class CommunityDatabase(Database):
+    """
+    The sync and reference_member_sync tables of one community, see
+    Community.dispersy_community_database.
+
+    The tables have the same columns as those in the DispersyDatabase, allowing the same queries
+    to be used on both.  The packets are always stored in the packet column.
+    """
+    if __debug__:
+        __doc__ = community_schema
+
+    def __init__(self, file_path, packet_store):
+        """
+        Initialize a new CommunityDatabase instance.
+
+        @type file_path: unicode
+        @param file_path: the path to the database file.
+
+        @type packet_store: PacketSegmentStore
+        @param packet_store: the packet store of the DispersyDatabase.
+        """
+        assert isinstance(file_path, unicode)
+        assert isinstance(packet_store, PacketSegmentStore)
+        Database.__init__(self, file_path)
+        # the packets are never stored in a segment file, however, the queries that are shared
+        # with the DispersyDatabase use the segment_packet SQL function
+        self._packet_store = packet_store
+        self.create_function("segment_packet", 1, _segment_packet_function(packet_store))
+
+    def check_database(self, database_version):
+        assert isinstance(database_version, unicode)
+        assert database_version.isdigit()
+        assert int(database_version) >= 0
+        database_version = int(database_version)
+
+        if database_version == 0:
+            # setup new database with current database_version
+            self.executescript(community_schema)
+            self.commit()
+
+        return 1
+
+    def create_reader(self):
+        reader = Database.create_reader(self)
+        reader.create_function("segment_packet", 1, _segment_packet_function(self._packet_store.create_reader()))
+        return reader
+
 class DispersyDatabase(Database):
     if __debug__:
         __doc__ = schema
@@ -87,6 +187,126 @@ class DispersyDatabase(Database):
         assert isinstance(working_directory, unicode)
         Database.__init__(self, path.join(working_directory, u"dispersy.db"))
 
+        # packets are stored in segment files when Dispersy.packet_segments is enabled.  Packets
+        # that were stored in a segment file must remain readable, hence the segment_packet SQL
+        # function is always available
+        self._packet_store = PacketSegmentStore(path.join(working_directory, u"packets"))
+        self.create_function("segment_packet", 1, _segment_packet_function(self._packet_store))
+        self.attach_before_commit_callback(self._packet_store.sync)
+
+        # communities that enable Community.dispersy_community_database have their own
+        # CommunityDatabase in the communities directory.  _community_databases contains the open
+        # ones by community.id
+        self._community_directory = path.join(working_directory, u"communities")
+        self._community_databases = {}
+        self._write_ahead_log = False
+        self.attach_commit_callback(self._commit_community_databases)
+
+    @property
+    def packet_store(self):
+        """
+        The PacketSegmentStore containing the packets whose sync.location is set.
+        @rtype: PacketSegmentStore
+        """
+        return self._packet_store
+
+    def _get_community_database_path(self, community_id):
+        return path.join(self._community_directory, u"community-%d.db" % community_id)
+
+    def has_community_database(self, community_id):
+        """
+        Returns True when COMMUNITY_ID has a CommunityDatabase, regardless of whether it is open.
+        @rtype: bool
+        """
+        return path.isfile(self._get_community_database_path(community_id))
+
+    def open_community_database(self, community_id):
+        """
+        Returns the CommunityDatabase for COMMUNITY_ID, opening it when required.
+
+        The sync and reference_member_sync rows of COMMUNITY_ID that are still in the Dispersy
+        database are moved into the community database.  The community database remains open until
+        close_community_database is called.
+        @rtype: CommunityDatabase
+        """
+        try:
+            return self._community_databases[community_id]
+        except KeyError:
+            if not path.isdir(self._community_directory):
+                makedirs(self._community_directory)
+            if __debug__: dprint("open community database ", community_id)
+            database = CommunityDatabase(self._get_community_database_path(community_id), self._packet_store)
+            if self._write_ahead_log:
+                database.enable_write_ahead_log()
+            self._move_sync_rows(community_id, database)
+            self._community_databases[community_id] = database
+            return database
+
+    def close_community_database(self, community_id):
+        """
+        Commit and close the CommunityDatabase for COMMUNITY_ID, if it is open.
+        """
+        database = self._community_databases.pop(community_id, None)
+        if database:
+            if __debug__: dprint("close community database ", community_id)
+            database.commit()
+            database.close()
+
+    def _move_sync_rows(self, community_id, database):
+        """
+        Move the sync and reference_member_sync rows of COMMUNITY_ID into the community DATABASE.
+
+        The rows are committed to DATABASE before they are removed from the Dispersy database.
+        Hence, when this is interrupted, the rows are moved again the next time that the community
+        database is opened.  Packets that were stored in a segment file are copied into the packet
+        column.
+        """
+        last_id = 0
+        count = 0
+        while True:
+            rows = list(self.execute(u"SELECT id, community, member, global_time, meta_message, undone, IFNULL(packet, segment_packet(location)), digest, sequence_number, priority, direction FROM sync WHERE community = ? AND id > ? ORDER BY id LIMIT 1000",
+                                     (community_id, last_id)))
+            if not rows:
+                break
+            database.executemany(u"INSERT OR IGNORE INTO sync (id, community, member, global_time, meta_message, undone, packet, digest, sequence_number, priority, direction) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            last_id = rows[-1][0]
+            count += len(rows)
+
+        if count:
+            if __debug__: dprint("moving ", count, " messages into community database ", community_id)
+            database.executemany(u"INSERT OR IGNORE INTO reference_member_sync (member, sync) VALUES (?, ?)",
+                                 list(self.execute(u"SELECT reference_member_sync.member, reference_member_sync.sync FROM reference_member_sync JOIN sync ON sync.id = reference_member_sync.sync WHERE sync.community = ?", (community_id,))))
+            database.commit()
+
+            self.execute(u"DELETE FROM reference_member_sync WHERE sync IN (SELECT id FROM sync WHERE community = ?)", (community_id,))
+            self.execute(u"DELETE FROM sync WHERE community = ?", (community_id,))
+            self.commit()
+
+    def _commit_community_databases(self):
+        """
+        Commit the open community databases.  Called after each commit, hence the sync rows are
+        never committed before the members that they refer to.
+        """
+        for database in self._community_databases.itervalues():
+            database.commit()
+
+    def rollback(self):
+        Database.rollback(self)
+        for database in self._community_databases.itervalues():
+            database.rollback()
+
+    def enable_write_ahead_log(self):
+        """
+        Switch the database, and all community databases, to write-ahead logging.
+        """
+        self._write_ahead_log = Database.enable_write_ahead_log(self)
+        return all([self._write_ahead_log] + [database.enable_write_ahead_log() for database in self._community_databases.itervalues()])
+
+    def create_reader(self):
+        reader = Database.create_reader(self)
+        reader.create_function("segment_packet", 1, _segment_packet_function(self._packet_store.create_reader()))
+        return reader
+
     def check_database(self, database_version):
         assert isinstance(database_version, unicode)
         assert database_version.isdigit()
@@ -322,11 +542,74 @@ UPDATE option SET value = '12' WHERE key = 'database_version';
 
             # upgrade from version 12 to version 13
             if database_version < 13:
-                # there is no version 13 yet...
-                # if __debug__: dprint("upgrade database ", database_version, " -> ", 13)
-                # self.executescript(u"""UPDATE option SET value = '13' WHERE key = 'database_version';""")
+                # the digest column allows sync bloom filters to be created and checked without
+                # retrieving the packets themselves
+                if __debug__: dprint("upgrade database ", database_version, " -> ", 13)
+                self.executescript(u"""
+ALTER TABLE sync ADD COLUMN digest BLOB;
+""")
+                last_id = 0
+                while True:
+                    rows = list(self.execute(u"SELECT id, packet FROM sync WHERE id > ? ORDER BY id LIMIT 1000", (last_id,)))
+                    if not rows:
+                        break
+                    self.executemany(u"UPDATE sync SET digest = ? WHERE id = ?", [(buffer(sha1(str(packet)).digest()), id_) for id_, packet in rows])
+                    last_id = rows[-1][0]
+                self.executescript(u"""
+UPDATE option SET value = '13' WHERE key = 'database_version';
+""")
+                self.commit()
+                if __debug__: dprint("upgrade database ", database_version, " -> ", 13, " (done)")
+
+            # upgrade from version 13 to version 14
+            if database_version < 14:
+                # the sequence_number column replaces counting the messages of a member.  the
+                # existing sequence numbers are set per community, see check_community_database
+                if __debug__: dprint("upgrade database ", database_version, " -> ", 14)
+                self.executescript(u"""
+ALTER TABLE sync ADD COLUMN sequence_number INTEGER DEFAULT 0;
+CREATE INDEX sync_member_meta_message_sequence_number_index ON sync(member, meta_message, sequence_number);
+UPDATE option SET value = '14' WHERE key = 'database_version';
+""")
+                self.commit()
+                if __debug__: dprint("upgrade database ", database_version, " -> ", 14, " (done)")
+
+            # upgrade from version 14 to version 15
+            if database_version < 15:
+                # the location column refers to a packet in a segment file, see PacketSegmentStore
+                if __debug__: dprint("upgrade database ", database_version, " -> ", 15)
+                self.executescript(u"""
+ALTER TABLE sync ADD COLUMN location INTEGER;
+CREATE INDEX sync_location_index ON sync(location);
+UPDATE option SET value = '15' WHERE key = 'database_version';
+""")
+                self.commit()
+                if __debug__: dprint("upgrade database ", database_version, " -> ", 15, " (done)")
+
+            # upgrade from version 15 to version 16
+            if database_version < 16:
+                # the priority and direction columns are copied from meta_message, allowing the
+                # sync queries to be answered by ordered index range scans without joining
+                # meta_message or sorting
+                if __debug__: dprint("upgrade database ", database_version, " -> ", 16)
+                self.executescript(u"""
+ALTER TABLE sync ADD COLUMN priority INTEGER DEFAULT 128;
+ALTER TABLE sync ADD COLUMN direction INTEGER DEFAULT 1;
+UPDATE sync SET priority = (SELECT priority FROM meta_message WHERE meta_message.id = sync.meta_message), direction = (SELECT direction FROM meta_message WHERE meta_message.id = sync.meta_message);
+CREATE INDEX sync_community_undone_global_time_index ON sync(community, undone, global_time, meta_message, digest);
+CREATE INDEX sync_community_undone_priority_direction_global_time_index ON sync(community, undone, priority, direction, global_time, meta_message, member, digest);
+UPDATE option SET value = '16' WHERE key = 'database_version';
+""")
+                self.commit()
+                if __debug__: dprint("upgrade database ", database_version, " -> ", 16, " (done)")
+
+            # upgrade from version 16 to version 17
+            if database_version < 17:
+                # there is no version 17 yet...
+                # if __debug__: dprint("upgrade database ", database_version, " -> ", 17)
+                # self.executescript(u"""UPDATE option SET value = '17' WHERE key = 'database_version';""")
                 # self.commit()
-                # if __debug__: dprint("upgrade database ", database_version, " -> ", 13, " (done)")
+                # if __debug__: dprint("upgrade database ", database_version, " -> ", 17, " (done)")
                 pass
 
         return LATEST_VERSION
@@ -335,6 +618,10 @@ UPDATE option SET value = '12' WHERE key = 'database_version';
         assert isinstance(database_version, int)
         assert database_version >= 0
 
+        # the sync table of the community is either in this database or in its own
+        # CommunityDatabase, see Community.dispersy_community_database
+        sync_database = community.sync_database
+
         if database_version < 8:
             if __debug__: dprint("upgrade community ", database_version, " -> ", 8)
 
@@ -356,14 +643,14 @@ UPDATE option SET value = '12' WHERE key = 'database_version';
             undo_other_meta = community.get_meta_message(u"dispersy-undo-other")
 
             progress = 0
-            count, = self.execute(u"SELECT COUNT(1) FROM sync WHERE meta_message = ? OR meta_message = ?", (undo_own_meta.database_id, undo_other_meta.database_id)).next()
+            count, = sync_database.execute(u"SELECT COUNT(1) FROM sync WHERE meta_message = ? OR meta_message = ?", (undo_own_meta.database_id, undo_other_meta.database_id)).next()
             if __debug__: dprint("upgrading ", count, " undo messages")
             if count > 50:
                 progress_handlers = [handler("Upgrading database", "Please wait while we upgrade the database", count) for handler in community.dispersy.get_progress_handlers()]
             else:
                 progress_handlers = []
 
-            for packet_id, packet in list(self.execute(u"SELECT id, packet FROM sync WHERE meta_message = ?", (undo_own_meta.database_id,))):
+            for packet_id, packet in list(sync_database.execute(u"SELECT id, packet FROM sync WHERE meta_message = ?", (undo_own_meta.database_id,))):
                 message = convert_packet_to_message(str(packet), community)
                 if message:
                     updates.append((packet_id, message.payload.packet.packet_id))
@@ -372,7 +659,7 @@ UPDATE option SET value = '12' WHERE key = 'database_version';
                 for handler in progress_handlers:
                     handler.Update(progress)
 
-            for packet_id, packet in list(self.execute(u"SELECT id, packet FROM sync WHERE meta_message = ?", (undo_other_meta.database_id,))):
+            for packet_id, packet in list(sync_database.execute(u"SELECT id, packet FROM sync WHERE meta_message = ?", (undo_other_meta.database_id,))):
                 message = convert_packet_to_message(str(packet), community)
                 if message:
                     allowed, _ = community._timeline.check(message)
@@ -399,9 +686,9 @@ UPDATE option SET value = '12' WHERE key = 'database_version';
 
             # note: UPDATE first, REDOES second, since UPDATES contains undo items that may have
             # been invalid
-            self.executemany(u"UPDATE sync SET undone = ? WHERE id = ?", updates)
-            self.executemany(u"UPDATE sync SET undone = 0 WHERE id = ?", redoes)
-            self.executemany(u"DELETE FROM sync WHERE id = ?", deletes)
+            sync_database.executemany(u"UPDATE sync SET undone = ? WHERE id = ?", updates)
+            sync_database.executemany(u"UPDATE sync SET undone = 0 WHERE id = ?", redoes)
+            sync_database.executemany(u"DELETE FROM sync WHERE id = ?", deletes)
 
             self.execute(u"UPDATE community SET database_version = 8 WHERE id = ?", (community.database_id,))
             self.commit()
@@ -409,4 +696,28 @@ UPDATE option SET value = '12' WHERE key = 'database_version';
             for handler in progress_handlers:
                 handler.Destroy()
 
+        if database_version < 14:
+            if __debug__: dprint("upgrade community ", database_version, " -> ", 14)
+
+            # patch notes:
+            #
+            # - the sync table has a new sequence_number column.  sequence numbers are contiguous,
+            #   hence the sequence number of a message is its position when the messages of its
+            #   member are ordered by global time
+            #
+            for meta in community.get_meta_messages():
+                if isinstance(meta.distribution, FullSyncDistribution) and meta.distribution.enable_sequence_number:
+                    updates = []
+                    counter_member_id = 0
+                    for packet_id, member_id in sync_database.execute(u"SELECT id, member FROM sync WHERE meta_message = ? ORDER BY member, global_time", (meta.database_id,)):
+                        if member_id != counter_member_id:
+                            counter_member_id = member_id
+                            counter = 0
+                        counter += 1
+                        updates.append((counter, packet_id))
+                    sync_database.executemany(u"UPDATE sync SET sequence_number = ? WHERE id = ?", updates)
+
+            self.execute(u"UPDATE community SET database_version = 14 WHERE id = ?", (community.database_id,))
+            self.commit()
+
         return LATEST_VERSION
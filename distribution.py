@@ -116,6 +116,9 @@ class SyncDistribution(Distribution):
             message.community.dispersy.database.execute(u"UPDATE meta_message SET priority = ?, direction = ? WHERE id = ?",
                                                         (self._priority, self.synchronization_direction_value, message.database_id))
             assert message.community.dispersy.database.changes == 1
+            # the sync table contains a copy of the priority and direction
+            message.community.sync_database.execute(u"UPDATE sync SET priority = ?, direction = ? WHERE meta_message = ?",
+                                                    (self._priority, self.synchronization_direction_value, message.database_id))
 
 class FullSyncDistribution(SyncDistribution):
     """
@@ -159,8 +162,8 @@ class FullSyncDistribution(SyncDistribution):
         super(FullSyncDistribution, self).setup(message)
         if self._enable_sequence_number:
             # obtain the most recent sequence number that we have used
-            self._current_sequence_number, = message.community.dispersy.database.execute(u"SELECT COUNT(1) FROM sync WHERE member = ? AND meta_message = ?",
-                                                                                         (message.community.my_member.database_id, message.database_id)).next()
+            self._current_sequence_number, = message.community.sync_database.execute(u"SELECT COUNT(1) FROM sync WHERE member = ? AND meta_message = ?",
+                                                                                     (message.community.my_member.database_id, message.database_id)).next()
     def claim_sequence_number(self):
         assert self._enable_sequence_number
         self._current_sequence_number += 1
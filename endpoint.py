@@ -6,6 +6,8 @@ import select
 import socket
 import sys
 import threading
+from Queue import Queue, Full, Empty
+from struct import Struct
 from time import time
 
 from candidate import Candidate
@@ -22,6 +24,200 @@ else:
 TUNNEL_PREFIX = "ffffffff".decode("HEX")
 DEBUG = False
 
+try:
+    # recvmmsg(2) and sendmmsg(2) allow us to move many datagrams per system call.  They are not
+    # exposed by the socket module, hence we use ctypes.  This is only available on Linux (recvmmsg
+    # since 2.6.33, sendmmsg since 3.0) and only for IPv4 sockets.
+    import ctypes
+    import ctypes.util
+
+    class _iovec(ctypes.Structure):
+        _fields_ = [("iov_base", ctypes.c_void_p),
+                    ("iov_len", ctypes.c_size_t)]
+
+    class _sockaddr_in(ctypes.Structure):
+        _fields_ = [("sin_family", ctypes.c_ushort),
+                    ("sin_port", ctypes.c_uint16),
+                    ("sin_addr", ctypes.c_uint32),
+                    ("sin_zero", ctypes.c_uint8 * 8)]
+
+    class _msghdr(ctypes.Structure):
+        _fields_ = [("msg_name", ctypes.c_void_p),
+                    ("msg_namelen", ctypes.c_uint32),
+                    ("msg_iov", ctypes.POINTER(_iovec)),
+                    ("msg_iovlen", ctypes.c_size_t),
+                    ("msg_control", ctypes.c_void_p),
+                    ("msg_controllen", ctypes.c_size_t),
+                    ("msg_flags", ctypes.c_int)]
+
+    class _mmsghdr(ctypes.Structure):
+        _fields_ = [("msg_hdr", _msghdr),
+                    ("msg_len", ctypes.c_uint)]
+
+    if not sys.platform.startswith("linux"):
+        raise ImportError("recvmmsg and sendmmsg are only available on Linux")
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _recvmmsg = _libc.recvmmsg
+    _recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    _recvmmsg.restype = ctypes.c_int
+    _sendmmsg = _libc.sendmmsg
+    _sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int]
+    _sendmmsg.restype = ctypes.c_int
+    # sin_addr is stored in network byte order, hence we use native packing
+    _struct_address = Struct("=L")
+    HAS_MMSG = True
+
+except (ImportError, OSError, AttributeError, TypeError):
+    HAS_MMSG = False
+
+class MMsgSocket(object):
+    """
+    Wraps a non-blocking IPv4 UDP socket and moves up to BATCH_SIZE datagrams per recvmmsg(2) or
+    sendmmsg(2) call.
+
+    The receive buffers, iovecs, and address structures are allocated once and reused for every
+    call.  Raises RuntimeError when recvmmsg/sendmmsg are not available, use HAS_MMSG to check this
+    beforehand.
+    """
+    def __init__(self, sock, batch_size=64, buffer_size=65535):
+        assert isinstance(batch_size, int)
+        assert batch_size > 0
+        assert isinstance(buffer_size, int)
+        assert buffer_size > 0
+        if not HAS_MMSG:
+            raise RuntimeError("recvmmsg and sendmmsg are not available")
+        if sock.family != socket.AF_INET:
+            raise RuntimeError("recvmmsg and sendmmsg are only used for AF_INET sockets")
+
+        self._socket = sock
+        self._fileno = sock.fileno()
+        self._batch_size = batch_size
+
+        # receive structures
+        self._recv_buffers = [ctypes.create_string_buffer(buffer_size) for _ in xrange(batch_size)]
+        self._recv_addresses = (_sockaddr_in * batch_size)()
+        self._recv_iovecs = (_iovec * batch_size)()
+        self._recv_headers = (_mmsghdr * batch_size)()
+        for index in xrange(batch_size):
+            self._recv_iovecs[index].iov_base = ctypes.addressof(self._recv_buffers[index])
+            self._recv_iovecs[index].iov_len = buffer_size
+            header = self._recv_headers[index].msg_hdr
+            header.msg_name = ctypes.addressof(self._recv_addresses[index])
+            header.msg_namelen = ctypes.sizeof(_sockaddr_in)
+            header.msg_iov = ctypes.pointer(self._recv_iovecs[index])
+            header.msg_iovlen = 1
+        self._recv_buffer_addresses = [ctypes.addressof(buffer_) for buffer_ in self._recv_buffers]
+        self._recv_first_header = ctypes.cast(self._recv_headers, ctypes.POINTER(_mmsghdr))
+        # accessing ctypes fields one by one is slow, instead we copy the received lengths and
+        # addresses in one go and unpack them with a Struct.  _recv_structs contains, for each
+        # possible number of received datagrams, the Structs needed to unpack them
+        self._recv_structs = {}
+
+        # send structures.  outgoing datagrams are copied into one contiguous buffer, each iovec
+        # points to its own part of this buffer
+        self._send_buffer = ctypes.create_string_buffer(buffer_size * batch_size)
+        self._send_buffer_address = ctypes.addressof(self._send_buffer)
+        self._send_buffer_size = buffer_size
+        self._send_addresses = (_sockaddr_in * batch_size)()
+        self._send_iovecs = (_iovec * batch_size)()
+        self._send_headers = (_mmsghdr * batch_size)()
+        for index in xrange(batch_size):
+            self._send_addresses[index].sin_family = socket.AF_INET
+            self._send_iovecs[index].iov_base = self._send_buffer_address + index * buffer_size
+            header = self._send_headers[index].msg_hdr
+            header.msg_name = ctypes.addressof(self._send_addresses[index])
+            header.msg_namelen = ctypes.sizeof(_sockaddr_in)
+            header.msg_iov = ctypes.pointer(self._send_iovecs[index])
+            header.msg_iovlen = 1
+        self._send_entries = [(self._send_addresses[index], self._send_iovecs[index], self._send_buffer_address + index * buffer_size)
+                              for index in xrange(batch_size)]
+        self._send_first_header = ctypes.cast(self._send_headers, ctypes.POINTER(_mmsghdr))
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+    def _get_recv_structs(self, count):
+        try:
+            return self._recv_structs[count]
+        except KeyError:
+            offset = _mmsghdr.msg_len.offset
+            lengths = Struct("=" + ("%dxI%dx" % (offset, ctypes.sizeof(_mmsghdr) - offset - 4)) * count)
+            addresses = Struct("!" + "2xH4s8x" * count)
+            self._recv_structs[count] = lengths, addresses
+            return lengths, addresses
+
+    def recv(self):
+        """
+        Receive all datagrams that are currently available, without blocking.
+
+        Returns a list containing (sock_addr, data) tuples.
+        """
+        string_at = ctypes.string_at
+        inet_ntoa = socket.inet_ntoa
+        headers_address = ctypes.addressof(self._recv_headers)
+        addresses_address = ctypes.addressof(self._recv_addresses)
+        header_size = ctypes.sizeof(_mmsghdr)
+        address_size = ctypes.sizeof(_sockaddr_in)
+        recv_buffer_addresses = self._recv_buffer_addresses
+        packets = []
+
+        while True:
+            count = _recvmmsg(self._fileno, self._recv_first_header, self._batch_size, socket.MSG_DONTWAIT, None)
+            if count <= 0:
+                break
+
+            # for AF_INET the kernel always sets msg_namelen to sizeof(sockaddr_in), hence the
+            # headers can be reused without resetting them
+            lengths, addresses = self._get_recv_structs(count)
+            lengths = lengths.unpack(string_at(headers_address, header_size * count))
+            addresses = addresses.unpack(string_at(addresses_address, address_size * count))
+            packets.extend(((inet_ntoa(addresses[index * 2 + 1]), addresses[index * 2]), string_at(buffer_address, length))
+                           for index, buffer_address, length
+                           in zip(xrange(count), recv_buffer_addresses, lengths))
+
+            if count < self._batch_size:
+                break
+
+        return packets
+
+    def send(self, items):
+        """
+        Send all (data, sock_addr) tuples in ITEMS, using as few system calls as possible.
+
+        Returns the number of datagrams that were sent.  Sending stops at the first datagram that
+        could not be sent (for instance, when the send buffer is full).
+        """
+        assert all(len(data) <= self._send_buffer_size for data, _ in items)
+        memmove = ctypes.memmove
+        inet_aton = socket.inet_aton
+        unpack_address = _struct_address.unpack
+        htons = socket.htons
+        send_entries = self._send_entries
+        batch_size = self._batch_size
+        # usually many datagrams are sent to only a few addresses
+        addresses = {}
+        sent = 0
+
+        for offset in xrange(0, len(items), batch_size):
+            chunk = items[offset:offset+batch_size]
+            for (address, iovec, buffer_address), (data, sock_addr) in zip(send_entries, chunk):
+                try:
+                    address.sin_addr, address.sin_port = addresses[sock_addr]
+                except KeyError:
+                    addresses[sock_addr] = address.sin_addr, address.sin_port = unpack_address(inet_aton(sock_addr[0]))[0], htons(sock_addr[1])
+                memmove(buffer_address, data, len(data))
+                iovec.iov_len = len(data)
+
+            count = _sendmmsg(self._fileno, self._send_first_header, len(chunk), 0)
+            if count <= 0:
+                break
+            sent += count
+            if count < len(chunk):
+                break
+
+        return sent
+
 class Endpoint(object):
     def __init__(self):
         self._total_up = 0
@@ -58,25 +254,52 @@ class DummyEndpoint(Endpoint):
         if __debug__: dprint("Thrown away ", sum(len(data) for data in packets), " bytes worth of outgoing data to ", ",".join(str(candidate) for candidate in candidates), level="warning")
 
 class StandaloneEndpoint(Endpoint):
-    def __init__(self, dispersy, port, ip="0.0.0.0"):
+    def __init__(self, dispersy, port, ip="0.0.0.0", batch_size=1):
+        """
+        Create a UDP endpoint that receives packets on its own thread.
+
+        When BATCH_SIZE is larger than one and recvmmsg/sendmmsg are available, up to BATCH_SIZE
+        datagrams are moved per system call.  Otherwise one recvfrom/sendto call is made per
+        datagram.  Run this module to compare both modes on the current machine.
+        """
         super(StandaloneEndpoint, self).__init__()
         self._running = True
         self._dispersy = dispersy
-        self._thread = threading.Thread(name="StandaloneEndpoint", target=self._loop, args=(port, ip))
-        self._thread.daemon = True
+        self._batch_size = batch_size
 
         while True:
             try:
-                self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 870400)
-                self._socket.bind((ip, port))
-                self._socket.setblocking(0)
+                self._socket = self._create_socket(ip, port)
                 if __debug__: dprint("Listening at ", port, force=True)
             except socket.error:
                 port += 1
                 continue
             break
 
+        self._mmsg_socket = self._create_mmsg_socket(self._socket)
+        if __debug__: dprint("batched recvmmsg/sendmmsg ", "enabled" if self._mmsg_socket else "disabled")
+
+        self._thread = threading.Thread(name="StandaloneEndpoint", target=self._loop, args=(self._socket, self._mmsg_socket))
+        self._thread.daemon = True
+
+    def _create_socket(self, ip, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 870400)
+        sock.bind((ip, port))
+        sock.setblocking(0)
+        return sock
+
+    def _create_mmsg_socket(self, sock):
+        """
+        Returns a MMsgSocket for SOCK when batching is enabled and available, otherwise None.
+        """
+        if self._batch_size > 1 and HAS_MMSG:
+            try:
+                return MMsgSocket(sock, self._batch_size)
+            except RuntimeError:
+                if __debug__: dprint("unable to use recvmmsg/sendmmsg, falling back to recvfrom/sendto", exception=True, level="warning")
+        return None
+
     def get_address(self):
         return self._socket.getsockname()
 
@@ -87,39 +310,52 @@ class StandaloneEndpoint(Endpoint):
         self._running = False
         self._thread.join(timeout)
 
-    def _loop(self, port, ip):
-        recvfrom = self._socket.recvfrom
-        register = self._dispersy.callback.register
-        dispersythread_data_came_in = self.dispersythread_data_came_in
+    def _recv_packets(self, sock, mmsg_socket):
+        """
+        Returns a list with all (sock_addr, data) tuples that can be read from SOCK without
+        blocking.
+        """
+        if mmsg_socket:
+            return mmsg_socket.recv()
+
+        recvfrom = sock.recvfrom
+        packets = []
+        try:
+            while True:
+                (data, sock_addr) = recvfrom(65535)
+                packets.append((sock_addr, data))
+        except socket.error:
+            pass
+        return packets
+
+    def _loop(self, sock, mmsg_socket):
+        recv_packets = self._recv_packets
+        data_came_in = self._data_came_in
         POLLIN, POLLOUT = select.POLLIN, select.POLLOUT
         poll = select.poll()
-        poll.register(self._socket, POLLIN)
+        poll.register(sock, POLLIN)
         do_poll = poll.poll
 
         while self._running:
             for _, event in do_poll(1.0):
                 if event & POLLIN:
-                    packets = []
-                    try:
-                        while True:
-                            (data, sock_addr) = recvfrom(65535)
-                            packets.append((sock_addr, data))
-                    except socket.error:
-                        pass
-
-                    finally:
-                        if packets:
-                            if __debug__:
-                                if DEBUG:
-                                    for sock_addr, data in packets:
-                                        try:
-                                            name = self._dispersy.convert_packet_to_meta_message(data, load=False, auto_load=False).name
-                                        except:
-                                            name = "???"
-                                        print >> sys.stderr, "endpoint: %.1f %30s <- %15s:%-5d %4d bytes" % (time(), name, sock_addr[0], sock_addr[1], len(data))
-
-                            self._total_down += sum(len(data) for _, data in packets)
-                            register(dispersythread_data_came_in, (packets,))
+                    packets = recv_packets(sock, mmsg_socket)
+                    if packets:
+                        if __debug__:
+                            if DEBUG:
+                                for sock_addr, data in packets:
+                                    try:
+                                        name = self._dispersy.convert_packet_to_meta_message(data, load=False, auto_load=False).name
+                                    except:
+                                        name = "???"
+                                    print >> sys.stderr, "endpoint: %.1f %30s <- %15s:%-5d %4d bytes" % (time(), name, sock_addr[0], sock_addr[1], len(data))
+
+                        data_came_in(packets)
+
+    def _data_came_in(self, packets):
+        # called on the endpoint thread
+        self._total_down += sum(len(data) for _, data in packets)
+        self._dispersy.callback.register(self.dispersythread_data_came_in, (packets,))
 
     def dispersythread_data_came_in(self, packets):
         self._dispersy.on_incoming_packets([(Candidate(sock_addr, False), data) for sock_addr, data in packets])
@@ -133,6 +369,7 @@ class StandaloneEndpoint(Endpoint):
 
         self._total_up += sum(len(data) for data in packets) * len(candidates)
         wan_address = self._dispersy.wan_address
+        items = []
 
         for candidate in candidates:
             sock_addr = candidate.get_destination_address(wan_address)
@@ -149,6 +386,14 @@ class StandaloneEndpoint(Endpoint):
 
                 if candidate.tunnel:
                     data = TUNNEL_PREFIX + data
+                items.append((data, sock_addr))
+
+        if self._mmsg_socket:
+            if self._mmsg_socket.send(items) < len(items):
+                return False
+
+        else:
+            for data, sock_addr in items:
                 try:
                     self._socket.sendto(data, sock_addr)
                 except socket.error:
@@ -157,6 +402,267 @@ class StandaloneEndpoint(Endpoint):
         # return True when something has been send
         return candidates and packets
 
+class ReusePortEndpoint(StandaloneEndpoint):
+    """
+    A StandaloneEndpoint that receives on THREAD_COUNT sockets bound to the same port using
+    SO_REUSEPORT.  The kernel distributes incoming datagrams over these sockets, each socket is read
+    by its own thread.
+
+    Each receive thread groups the datagrams by community id (packet[2:22]) and hands every group
+    to the Dispersy thread separately.  Hence on_incoming_packets receives batches that contain
+    packets for a single community.
+
+    Outgoing packets are sent using the first socket.
+    """
+    def __init__(self, dispersy, port, ip="0.0.0.0", thread_count=2, batch_size=1):
+        assert isinstance(thread_count, int)
+        assert thread_count > 0
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise RuntimeError("SO_REUSEPORT is not available")
+        super(ReusePortEndpoint, self).__init__(dispersy, port, ip, batch_size)
+        self._total_down_lock = threading.Lock()
+
+        # the first socket is created by StandaloneEndpoint without SO_REUSEPORT, hence it can not
+        # bind to a port that is already in use and the port may differ from the requested port.
+        # once the port is secured, SO_REUSEPORT is enabled on the first socket to allow the
+        # remaining sockets to bind to the same port
+        ip, port = self._socket.getsockname()
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self._sockets = [self._socket] + [self._create_reuse_port_socket(ip, port) for _ in xrange(thread_count - 1)]
+        self._threads = [self._thread]
+        for index, sock in enumerate(self._sockets[1:]):
+            thread = threading.Thread(name="ReusePortEndpoint-%d" % (index + 1), target=self._loop, args=(sock, self._create_mmsg_socket(sock)))
+            thread.daemon = True
+            self._threads.append(thread)
+        if __debug__: dprint("receiving on ", len(self._sockets), " SO_REUSEPORT sockets at port ", port)
+
+    def _create_reuse_port_socket(self, ip, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 870400)
+        sock.bind((ip, port))
+        sock.setblocking(0)
+        return sock
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=10.0):
+        self._running = False
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _data_came_in(self, packets):
+        # called on one of the endpoint threads
+        with self._total_down_lock:
+            self._total_down += sum(len(data) for _, data in packets)
+
+        # group by community id.  packets that are too short to contain a community id end up in
+        # some group and are dropped by Dispersy
+        groups = {}
+        for sock_addr, data in packets:
+            groups.setdefault(data[2:22], []).append((sock_addr, data))
+
+        register = self._dispersy.callback.register
+        for group in groups.itervalues():
+            register(self.dispersythread_data_came_in, (group,))
+
+def get_shard(cid, shard_count):
+    """
+    Returns the index of the shard, in [0, SHARD_COUNT), that handles the community CID.
+
+    The community id is a sha1 digest, hence its first four bytes are uniformly distributed.
+    """
+    assert isinstance(cid, str)
+    assert len(cid) == 20
+    assert shard_count > 0
+    return _struct_shard.unpack_from(cid)[0] % shard_count
+_struct_shard = Struct("!L")
+
+class ShardRouter(StandaloneEndpoint):
+    """
+    The front-end of a sharded deployment.
+
+    The ShardRouter owns the UDP socket and routes every incoming datagram, based on its community
+    id (packet[2:22]), to one of the worker processes.  Each worker is reachable through one
+    multiprocessing Connection and runs its own Dispersy instance with a ShardEndpoint.  Outgoing
+    datagrams from the workers are received through the same connections and sent using the UDP
+    socket.
+
+    Incoming datagrams are queued per worker, each queue holds at most QUEUE_SIZE batches.  A
+    worker that does not keep up loses its own datagrams without delaying the other workers.
+    """
+    def __init__(self, connections, port, ip="0.0.0.0", batch_size=1, queue_size=1024):
+        assert isinstance(connections, (tuple, list))
+        assert len(connections) > 0
+        assert isinstance(queue_size, int)
+        assert queue_size > 0
+        # the router does not run a Dispersy instance
+        super(ShardRouter, self).__init__(None, port, ip, batch_size)
+        self._thread.name = "ShardRouter-recv"
+        self._connections = connections
+        self._queues = [Queue(queue_size) for _ in connections]
+        self._drop_count = 0
+
+        # each worker connection has its own route and send thread, the send threads share the UDP
+        # socket and the MMsgSocket send buffers
+        self._send_lock = threading.Lock()
+        self._threads = [self._thread]
+        for index, (connection, queue) in enumerate(zip(connections, self._queues)):
+            self._threads.append(threading.Thread(name="ShardRouter-route-%d" % index, target=self._route_loop, args=(connection, queue)))
+            self._threads.append(threading.Thread(name="ShardRouter-send-%d" % index, target=self._send_loop, args=(connection,)))
+        for thread in self._threads:
+            thread.daemon = True
+
+    @property
+    def drop_count(self):
+        """
+        The number of datagrams that were dropped because the queue of their worker was full.
+        """
+        return self._drop_count
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=10.0):
+        self._running = False
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _data_came_in(self, packets):
+        # called on the receive thread
+        shard_count = len(self._connections)
+        shards = {}
+        for sock_addr, data in packets:
+            if len(data) < 22:
+                if __debug__: dprint("drop a ", len(data), " byte packet (too small to contain a community id) from ", sock_addr, level="warning")
+                continue
+            shards.setdefault(get_shard(data[2:22], shard_count), []).append((sock_addr, data))
+            self._total_down += len(data)
+
+        for index, packets in shards.iteritems():
+            try:
+                self._queues[index].put_nowait(packets)
+            except Full:
+                self._drop_count += len(packets)
+                if __debug__: dprint("drop ", len(packets), " packets, worker ", index, " is not keeping up", level="warning")
+
+    def _route_loop(self, connection, queue):
+        while self._running:
+            try:
+                packets = queue.get(timeout=1.0)
+            except Empty:
+                continue
+            try:
+                connection.send(packets)
+            except (IOError, EOFError):
+                if __debug__: dprint("unable to route ", len(packets), " packets to a worker", exception=True, level="error")
+
+        # tell the worker to stop
+        try:
+            connection.send(None)
+        except (IOError, EOFError):
+            pass
+
+    def _send_loop(self, connection):
+        sendto = self._socket.sendto
+        while self._running:
+            try:
+                items = connection.recv()
+            except (IOError, EOFError):
+                # the worker stopped
+                break
+            if items is None:
+                break
+
+            with self._send_lock:
+                self._total_up += sum(len(data) for data, _ in items)
+                if self._mmsg_socket:
+                    self._mmsg_socket.send(items)
+                else:
+                    for data, sock_addr in items:
+                        try:
+                            sendto(data, sock_addr)
+                        except socket.error:
+                            break
+
+class ShardEndpoint(Endpoint):
+    """
+    The endpoint used by a worker process in a sharded deployment.
+
+    All packets are received from, and sent through, the ShardRouter in the front-end process
+    using CONNECTION.  ADDRESS is the address of the front-end UDP socket.
+    """
+    def __init__(self, dispersy, connection, address):
+        super(ShardEndpoint, self).__init__()
+        self._running = True
+        self._dispersy = dispersy
+        self._connection = connection
+        self._address = address
+        self._send_lock = threading.Lock()
+        self._thread = threading.Thread(name="ShardEndpoint", target=self._loop)
+        self._thread.daemon = True
+
+    def get_address(self):
+        return self._address
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout=10.0):
+        self._running = False
+        self._thread.join(timeout)
+
+    def _loop(self):
+        register = self._dispersy.callback.register
+        while self._running:
+            try:
+                packets = self._connection.recv()
+            except (IOError, EOFError):
+                if __debug__: dprint("lost connection to the front-end", level="error")
+                packets = None
+            if packets is None:
+                # the front-end is shutting down, a worker can not continue without it
+                self._dispersy.callback.stop(wait=False)
+                break
+            self._total_down += sum(len(data) for _, data in packets)
+            register(self.dispersythread_data_came_in, (packets,))
+
+    def dispersythread_data_came_in(self, packets):
+        self._dispersy.on_incoming_packets([(Candidate(sock_addr, False), data) for sock_addr, data in packets])
+
+    def send(self, candidates, packets):
+        assert isinstance(candidates, (tuple, list, set)), type(candidates)
+        assert all(isinstance(candidate, Candidate) for candidate in candidates)
+        assert isinstance(packets, (tuple, list, set)), type(packets)
+        assert all(isinstance(packet, str) for packet in packets)
+        assert all(len(packet) > 0 for packet in packets)
+
+        self._total_up += sum(len(data) for data in packets) * len(candidates)
+        wan_address = self._dispersy.wan_address
+        items = []
+
+        for candidate in candidates:
+            sock_addr = candidate.get_destination_address(wan_address)
+            assert self._dispersy.is_valid_remote_address(sock_addr)
+
+            for data in packets:
+                if candidate.tunnel:
+                    data = TUNNEL_PREFIX + data
+                items.append((data, sock_addr))
+
+        if items:
+            try:
+                with self._send_lock:
+                    self._connection.send(items)
+            except (IOError, EOFError):
+                return False
+
+        # return True when something has been send
+        return candidates and packets
+
 class RawserverEndpoint(Endpoint):
     def __init__(self, rawserver, dispersy, port, ip="0.0.0.0"):
         super(RawserverEndpoint, self).__init__()
@@ -333,3 +839,65 @@ class TunnelEndpoint(Endpoint):
     def dispersythread_data_came_in(self, sock_addr, data, timestamp):
         # candidate = self._dispersy.get_candidate(sock_addr) or self._dispersy.create_candidate(WalkCandidate, sock_addr, True)
         self._dispersy.on_incoming_packets([(Candidate(sock_addr, True), data)], True, timestamp)
+
+if __debug__:
+    def _test_packets_per_second(count=200000, size=200, batch_size=64):
+        """
+        Measure the number of packets per second that can be moved over a loopback socket pair,
+        using one recvfrom/sendto call per datagram and using recvmmsg/sendmmsg.
+        """
+        def create_socket():
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 870400)
+            sock.bind(("127.0.0.1", 0))
+            sock.setblocking(0)
+            return sock
+
+        def run(name, send, recv):
+            data = "x" * size
+            items = [(data, receiver.getsockname())] * batch_size
+            sent = received = 0
+            start = time()
+            while sent < count:
+                sent += send(items)
+                received += len(recv())
+            while True:
+                packets = recv()
+                if not packets:
+                    break
+                received += len(packets)
+            duration = time() - start
+            print "%-10s sent %7d (%9.0f pps) received %7d (%9.0f pps)" % (name, sent, sent / duration, received, received / duration)
+
+        def sendto_send(items):
+            sent = 0
+            for data, sock_addr in items:
+                try:
+                    sender.sendto(data, sock_addr)
+                except socket.error:
+                    break
+                sent += 1
+            return sent
+
+        def recvfrom_recv():
+            packets = []
+            try:
+                while True:
+                    data, sock_addr = receiver.recvfrom(65535)
+                    packets.append((sock_addr, data))
+            except socket.error:
+                pass
+            return packets
+
+        sender, receiver = create_socket(), create_socket()
+        run("sendto", sendto_send, recvfrom_recv)
+
+        if HAS_MMSG:
+            sender, receiver = create_socket(), create_socket()
+            mmsg_sender, mmsg_receiver = MMsgSocket(sender, batch_size), MMsgSocket(receiver, batch_size)
+            run("sendmmsg", mmsg_sender.send, mmsg_receiver.recv)
+        else:
+            print "recvmmsg/sendmmsg not available"
+
+    if __name__ == "__main__":
+        _test_packets_per_second()
@@ -1,5 +1,6 @@
 from hashlib import sha1
 
+from cache import LinkedDict
 from dispersydatabase import DispersyDatabase
 from crypto import ec_from_private_bin, ec_from_public_bin, ec_signature_length, ec_verify, ec_sign
 
@@ -11,19 +12,11 @@ class DummyMember(object):
     def __init__(self, mid):
         assert isinstance(mid, str)
         assert len(mid) == 20
-        self._mid = mid
-
         assert DispersyDatabase.has_instance(), "DispersyDatabase has not yet been created"
-        database = DispersyDatabase.get_instance()
-
-        try:
-            database_id, = database.execute(u"SELECT id FROM member WHERE mid = ? LIMIT 1", (buffer(mid),)).next()
-        except StopIteration:
-            database.execute(u"INSERT INTO member (mid) VALUES (?)", (buffer(mid),))
-            database_id = database.last_insert_rowid
-
-        self._database_id = database_id
         self._mid = mid
+        # the database id is retrieved when it is first used.  a DummyMember is often only used for
+        # its mid, for instance when requesting a missing dispersy-identity message
+        self._database_id = None
 
     @property
     def mid(self):
@@ -38,6 +31,13 @@ class DummyMember(object):
         The database id.  This is the unsigned integer used to store
         this member in the Dispersy database.
         """
+        if self._database_id is None:
+            database = DispersyDatabase.get_instance()
+            try:
+                self._database_id, = database.execute(u"SELECT id FROM member WHERE mid = ? LIMIT 1", (buffer(self._mid),)).next()
+            except StopIteration:
+                database.execute(u"INSERT INTO member (mid) VALUES (?)", (buffer(self._mid),))
+                self._database_id = database.last_insert_rowid
         return self._database_id
 
     @property
@@ -202,8 +202,8 @@ class MemberBase(DummyMember):
 
         else:
             try:
-                self._database.execute(u"SELECT 1 FROM sync WHERE member = ? AND meta_message = ? LIMIT 1",
-                                       (self._database_id, community.get_meta_message(u"dispersy-identity").database_id)).next()
+                community.sync_database.execute(u"SELECT 1 FROM sync WHERE member = ? AND meta_message = ? LIMIT 1",
+                                                (self._database_id, community.get_meta_message(u"dispersy-identity").database_id)).next()
             except StopIteration:
                 return False
             else:
@@ -314,9 +314,114 @@ class MemberBase(DummyMember):
         """
         return "<%s %d %s>" % (self.__class__.__name__, self._database_id, self._mid.encode("HEX"))
 
+class MemberCache(object):
+    """
+    A least recently used cache of Member instances, indexed by both public key and mid.
+
+    Multiple public keys may, in theory, result in the same mid.  In this case only the most
+    recently added member is available through get_by_mid.
+    """
+    def __init__(self, max_size):
+        assert isinstance(max_size, int)
+        assert max_size > 0
+        self._max_size = max_size
+        # public key: member, ordered from least to most recently used
+        self._public_keys = LinkedDict()
+        # mid: (public key, member)
+        self._mids = {}
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def __len__(self):
+        return len(self._public_keys)
+
+    # @property
+    def __get_max_size(self):
+        return self._max_size
+    # @max_size.setter
+    def __set_max_size(self, max_size):
+        assert isinstance(max_size, int)
+        assert max_size > 0
+        self._max_size = max_size
+        self._evict()
+    # .setter was introduced in Python 2.6
+    max_size = property(__get_max_size, __set_max_size)
+
+    def get_by_public_key(self, public_key):
+        """
+        Returns the member with PUBLIC_KEY or None when it is not cached.
+        """
+        try:
+            member = self._public_keys.pop(public_key)
+        except KeyError:
+            self._misses += 1
+            return None
+        self._public_keys[public_key] = member
+        self._hits += 1
+        return member
+
+    def get_by_mid(self, mid):
+        """
+        Returns a member with MID or None when it is not cached.
+        """
+        try:
+            public_key, member = self._mids[mid]
+        except KeyError:
+            self._misses += 1
+            return None
+        self._public_keys[public_key] = self._public_keys.pop(public_key)
+        self._hits += 1
+        return member
+
+    def add(self, public_key, mid, member):
+        """
+        Add MEMBER to the cache, possibly evicting the least recently used member.
+        """
+        self._public_keys.pop(public_key, None)
+        self._public_keys[public_key] = member
+        self._mids[mid] = (public_key, member)
+        self._evict()
+
+    def _evict(self):
+        while len(self._public_keys) > self._max_size:
+            public_key, member = self._public_keys.popitem(last=False)
+            mid = sha1(public_key).digest()
+            if self._mids.get(mid, (None, None))[1] is member:
+                del self._mids[mid]
+            self._evictions += 1
+
+    def info(self):
+        """
+        Returns the cache statistics.
+        """
+        return {"size":len(self._public_keys),
+                "max_size":self._max_size,
+                "hits":self._hits,
+                "misses":self._misses,
+                "evictions":self._evictions}
+
+    def reset(self):
+        """
+        Returns, and subsequently removes, the cache statistics.  The cached members are kept.
+        """
+        try:
+            return self.info()
+
+        finally:
+            self._hits = 0
+            self._misses = 0
+            self._evictions = 0
+
 class Member(MemberBase):
-    _cache_length = 512
-    _cache = []
+    _cache = MemberCache(512)
+
+    @classmethod
+    def get_cache(cls):
+        """
+        Returns the MemberCache shared by Member, MemberFromId, and MemberWithoutCheck.
+        """
+        return Member._cache
 
     def __new__(cls, public_key, private_key=""):
         assert isinstance(public_key, str)
@@ -325,18 +430,11 @@ class Member(MemberBase):
         assert private_key == "" or ec_check_private_bin(private_key), [len(private_key), private_key.encode("HEX")]
 
         # retrieve Member from cache
-        for index, member in enumerate(cls._cache):
-            if member._public_key == public_key:
-                if cls._cache_length / 2 < index:
-                    del cls._cache[index]
-                    cls._cache.insert(0, member)
-                return member
-
-        # create new Member and store in cache
-        member = object.__new__(cls)
-        if len(cls._cache) >= cls._cache_length:
-            del cls._cache[-1]
-        cls._cache.insert(cls._cache_length / 3, member)
+        member = cls._cache.get_by_public_key(public_key)
+        if member is None:
+            # create new Member and store in cache
+            member = object.__new__(cls)
+            cls._cache.add(public_key, sha1(public_key).digest(), member)
 
         return member
 
@@ -346,14 +444,10 @@ class MemberFromId(Member):
         assert len(mid) == 20
 
         # retrieve Member from cache
-        for index, member in enumerate(cls._cache):
-            if member._mid == mid:
-                if cls._cache_length / 2 < index:
-                    del cls._cache[index]
-                    cls._cache.insert(0, member)
-                return member
-
-        raise LookupError(mid)
+        member = cls._cache.get_by_mid(mid)
+        if member is None:
+            raise LookupError(mid)
+        return member
 
 class MemberWithoutCheck(Member):
     def __new__(cls, public_key, private_key=""):
@@ -364,7 +458,5 @@ class MemberWithoutCheck(Member):
 
         # create new Member and store in cache
         member = object.__new__(cls)
-        if len(cls._cache) >= cls._cache_length:
-            del cls._cache[-1]
-        cls._cache.insert(cls._cache_length / 3, member)
+        cls._cache.add(public_key, sha1(public_key).digest(), member)
         return member
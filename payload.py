@@ -3,7 +3,7 @@ from hashlib import sha1
 from meta import MetaObject
 
 if __debug__:
-    from bloomfilter import BloomFilter
+    from bloomfilter import BloomFilter, InvertibleBloomLookupTable
 
     def is_address(address):
         assert isinstance(address, tuple), type(address)
@@ -31,7 +31,7 @@ class Payload(MetaObject):
 
 class IntroductionRequestPayload(Payload):
     class Implementation(Payload.Implementation):
-        def __init__(self, meta, destination_address, source_lan_address, source_wan_address, advice, connection_type, sync, identifier):
+        def __init__(self, meta, destination_address, source_lan_address, source_wan_address, advice, connection_type, sync, identifier, reconciliation=False, fingerprint=None):
             """
             Create the payload for an introduction-request message.
 
@@ -64,10 +64,19 @@ class IntroductionRequestPayload(Payload):
                packets in that range.
 
                BLOOM_FILTER is a BloomFilter object containing all packets that the sender has in
-               the given sync range.
+               the given sync range.  It may also be an InvertibleBloomLookupTable containing the
+               digests of these packets, but only when the receiver supports reconciliation.
 
             IDENTIFIER is a number that must be given in the associated introduction-response.  This
             number allows to distinguish between multiple introduction-response messages.
+
+            RECONCILIATION is a boolean indicating that the sender accepts an
+            InvertibleBloomLookupTable instead of a bloom filter.
+
+            FINGERPRINT is an optional (COUNT, XOR) tuple, see SyncFingerprintCache, of the packets
+            that the sender has in the sync range.  When the receiver has the same fingerprint for
+            this range it does not need to look for missing packets.  A fingerprint may only be
+            given with an InvertibleBloomLookupTable sync range that uses modulo one.
             """
             assert is_address(destination_address), destination_address
             assert is_address(source_lan_address), source_lan_address
@@ -78,6 +87,9 @@ class IntroductionRequestPayload(Payload):
             assert sync is None or len(sync) == 5, sync
             assert isinstance(identifier, int), identifier
             assert 0 <= identifier < 2**16, identifier
+            assert isinstance(reconciliation, bool), reconciliation
+            assert fingerprint is None or (sync and sync[2] == 1 and isinstance(sync[4], InvertibleBloomLookupTable)), "a fingerprint requires a lookup table sync range with modulo one"
+            assert fingerprint is None or (isinstance(fingerprint, tuple) and len(fingerprint) == 2), fingerprint
             super(IntroductionRequestPayload.Implementation, self).__init__(meta)
             self._destination_address = destination_address
             self._source_lan_address = source_lan_address
@@ -85,6 +97,8 @@ class IntroductionRequestPayload(Payload):
             self._advice = advice
             self._connection_type = connection_type
             self._identifier = identifier
+            self._reconciliation = reconciliation
+            self._fingerprint = fingerprint
             if sync:
                 self._time_low, self._time_high, self._modulo, self._offset, self._bloom_filter = sync
                 assert isinstance(self._time_low, (int, long))
@@ -95,7 +109,7 @@ class IntroductionRequestPayload(Payload):
                 assert 0 < self._modulo < 2**16
                 assert isinstance(self._offset, int)
                 assert 0 <= self._offset < self._modulo
-                assert isinstance(self._bloom_filter, BloomFilter)
+                assert isinstance(self._bloom_filter, (BloomFilter, InvertibleBloomLookupTable))
             else:
                 self._time_low, self._time_high, self._modulo, self._offset, self._bloom_filter = 0, 0, 1, 0, None
 
@@ -121,7 +135,7 @@ class IntroductionRequestPayload(Payload):
 
         @property
         def sync(self):
-            return True if self._bloom_filter else False
+            return self._bloom_filter is not None
 
         @property
         def time_low(self):
@@ -151,9 +165,17 @@ class IntroductionRequestPayload(Payload):
         def identifier(self):
             return self._identifier
 
+        @property
+        def reconciliation(self):
+            return self._reconciliation
+
+        @property
+        def fingerprint(self):
+            return self._fingerprint
+
 class IntroductionResponsePayload(Payload):
     class Implementation(Payload.Implementation):
-        def __init__(self, meta, destination_address, source_lan_address, source_wan_address, lan_introduction_address, wan_introduction_address, connection_type, tunnel, identifier):
+        def __init__(self, meta, destination_address, source_lan_address, source_wan_address, lan_introduction_address, wan_introduction_address, connection_type, tunnel, identifier, reconciliation=False):
             """
             Create the payload for an introduction-response message.
 
@@ -184,6 +206,9 @@ class IntroductionResponsePayload(Payload):
             IDENTIFIER is a number that was given in the associated introduction-request.  This
             number allows to distinguish between multiple introduction-response messages.
 
+            RECONCILIATION is a boolean indicating that the sender accepts an
+            InvertibleBloomLookupTable instead of a bloom filter in introduction-requests.
+
             When the associated request wanted advice the sender will also sent a puncture-request
             message to either the lan_introduction_address or the wan_introduction_address
             (depending on their positions).  The introduced node must sent a puncture message to the
@@ -198,6 +223,7 @@ class IntroductionResponsePayload(Payload):
             assert isinstance(tunnel, bool)
             assert isinstance(identifier, int)
             assert 0 <= identifier < 2**16
+            assert isinstance(reconciliation, bool)
             super(IntroductionResponsePayload.Implementation, self).__init__(meta)
             self._destination_address = destination_address
             self._source_lan_address = source_lan_address
@@ -207,6 +233,7 @@ class IntroductionResponsePayload(Payload):
             self._connection_type = connection_type
             self._tunnel = tunnel
             self._identifier = identifier
+            self._reconciliation = reconciliation
 
         @property
         def destination_address(self):
@@ -240,6 +267,10 @@ class IntroductionResponsePayload(Payload):
         def identifier(self):
             return self._identifier
 
+        @property
+        def reconciliation(self):
+            return self._reconciliation
+
 class PunctureRequestPayload(Payload):
     class Implementation(Payload.Implementation):
         def __init__(self, meta, lan_walker_address, wan_walker_address, identifier):
@@ -25,10 +25,12 @@ from crypto import ec_generate_key, ec_to_public_bin, ec_to_private_bin
 from debug import Node
 from dispersy import Dispersy
 from dispersydatabase import DispersyDatabase
+from distribution import LastSyncDistribution, SyncDistribution
 from dprint import dprint
 from member import Member
 from message import BatchConfiguration, Message, DelayMessageByProof, DropMessage
 from resolution import PublicResolution, LinearResolution
+from segmentstore import segment_location_range
 from singleton import Singleton
 
 from debugcommunity import DebugCommunity, DebugNode
@@ -42,7 +44,7 @@ def assert_message_stored(community, member, global_time, undone="done"):
     assert undone in ("done", "undone")
 
     try:
-        actual_undone, = community.dispersy.database.execute(u"SELECT undone FROM sync WHERE community = ? AND member = ? AND global_time = ?", (community.database_id, member.database_id, global_time)).next()
+        actual_undone, = community.sync_database.execute(u"SELECT undone FROM sync WHERE community = ? AND member = ? AND global_time = ?", (community.database_id, member.database_id, global_time)).next()
     except StopIteration:
         assert_(False, "Message must be stored in the database (", community.database_id, ", ", member.database_id, ", ", global_time, ")")
 
@@ -864,7 +866,7 @@ class DispersyTimelineScript(ScriptBase):
 
         # may NOT have been stored in the database
         try:
-            packet, =  self._dispersy_database.execute(u"SELECT packet FROM sync WHERE community = ? AND member = ? AND global_time = ?",
+            packet, =  self._dispersy_database.execute(u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? AND member = ? AND global_time = ?",
                                                        (community.database_id, node2.my_member.database_id, global_time)).next()
         except StopIteration:
             pass
@@ -894,7 +896,7 @@ class DispersyTimelineScript(ScriptBase):
         # must have been stored in the database
         dprint("SELF must have processed both the proof and the protected-full-sync-text message")
         try:
-            packet, =  self._dispersy_database.execute(u"SELECT packet FROM sync WHERE community = ? AND member = ? AND global_time = ?",
+            packet, =  self._dispersy_database.execute(u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? AND member = ? AND global_time = ?",
                                                        (community.database_id, node2.my_member.database_id, global_time)).next()
         except StopIteration:
             assert_(False, "should have been stored")
@@ -1189,6 +1191,10 @@ class DispersyBatchScript(ScriptBase):
         self.caller(self.one_big_batch, (length,))
         self.caller(self.many_small_batches, (length,))
 
+        # store throughput
+        self.caller(self.store_throughput, (u"full-sync-text", length, 100))
+        self.caller(self.store_throughput, (u"last-9-test", length, 100))
+
     def one_batch_binary_duplicate(self):
         """
         When multiple binary identical UDP packets are received, the duplicate packets need to be
@@ -1425,14 +1431,60 @@ class DispersyBatchScript(ScriptBase):
         community.create_dispersy_destroy_community(u"hard-kill")
         self._dispersy.get_community(community.cid).unload_community()
 
+    def store_throughput(self, meta_name, length, batch_size):
+        """
+        Measures how many messages per second Dispersy._store can insert, given batches of
+        BATCH_SIZE messages.
+        """
+        community = DebugCommunity.create_community(self._my_member)
+        meta = community.get_meta_message(meta_name)
+
+        # create node and ensure that SELF knows the node address
+        node = DebugNode()
+        node.init_socket()
+        node.set_community(community)
+        node.init_my_member()
+
+        create_message = getattr(node, "create_%s_message" % meta_name.replace("-", "_"))
+        messages = [create_message("Dprint=False, store throughput #%d" % global_time, global_time) for global_time in xrange(10, 10 + length)]
+
+        begin = time()
+        for index in xrange(0, length, batch_size):
+            self._dispersy._store(messages[index:index + batch_size])
+        end = time()
+        self._results.append("%.1f messages per second for store_throughput(%s, %d, %d)" % (length / (end - begin), meta_name, length, batch_size))
+        dprint(self._results, lines=1)
+
+        assert_(all(message.packet_id for message in messages))
+        count, = self._dispersy_database.execute(u"SELECT COUNT(1) FROM sync WHERE meta_message = ?", (meta.database_id,)).next()
+        if isinstance(meta.distribution, LastSyncDistribution):
+            assert_(count == meta.distribution.history_size, count)
+        else:
+            assert_(count == len(messages), count)
+
+        # cleanup
+        community.create_dispersy_destroy_community(u"hard-kill")
+        self._dispersy.get_community(community.cid).unload_community()
+
 class DispersySyncScript(ScriptBase):
     def run(self):
         ec = ec_generate_key(u"low")
         self._my_member = Member(ec_to_public_bin(ec), ec_to_private_bin(ec))
 
+        # sync response queries must use the priority direction index
+        self.caller(self.query_plan_test)
+
         # modulo sync handling
         self.caller(self.modulo_test)
 
+        # invertible bloom lookup table sync
+        self.caller(self.reconciliation_test)
+        self.caller(self.reconciliation_fallback_test)
+        self.caller(self.fingerprint_test)
+
+        # paced sync responses
+        self.caller(self.paced_response_test)
+
         # different sync policies
         self.caller(self.in_order_test)
         self.caller(self.out_order_test)
@@ -1446,6 +1498,28 @@ class DispersySyncScript(ScriptBase):
         # # TODO add more checks for the multimemberauthentication case
         # self.caller(self.last_9_multimember)
 
+    def query_plan_test(self):
+        """
+        The queries that select the packets for a sync response must be answered using
+        sync_community_undone_priority_direction_global_time_index, without sorting.
+        """
+        community = DebugCommunity.create_community(self._my_member)
+
+        for columns in (u"IFNULL(sync.packet, segment_packet(sync.location))",
+                        u"sync.digest, sync.id",
+                        u"IFNULL(sync.packet, segment_packet(sync.location)), sync.meta_message, sync.member"):
+            sqls = self._dispersy._get_sync_response_sql(community, columns)
+            assert_(sqls, "there must be at least one syncable message")
+            for sql in sqls:
+                plan = u" ".join(unicode(row[-1]) for row in self._dispersy_database.execute(u"EXPLAIN QUERY PLAN " + sql, (community.database_id, 1, 2**63 - 1, 0, 1)))
+                dprint(plan)
+                assert_(u"sync_community_undone_priority_direction_global_time_index" in plan, plan)
+                assert_(not u"TEMP B-TREE" in plan, plan)
+
+        # cleanup
+        community.create_dispersy_destroy_community(u"hard-kill")
+        self._dispersy.get_community(community.cid).unload_community()
+
     def modulo_test(self):
         """
         SELF creates several messages, NODE asks for specific modulo to sync and only those modulo
@@ -1487,6 +1561,192 @@ class DispersySyncScript(ScriptBase):
         community.create_dispersy_destroy_community(u"hard-kill")
         self._dispersy.get_community(community.cid).unload_community()
 
+    def reconciliation_test(self):
+        """
+        SELF creates several messages, NODE already has most of them and sends an introduction
+        request with an InvertibleBloomLookupTable.  Exactly the messages that NODE does not have
+        must be sent back.
+        """
+        community = DebugCommunity.create_community(self._my_member)
+
+        # create node and ensure that SELF knows the node address
+        node = DebugNode()
+        node.init_socket()
+        node.set_community(community)
+        node.init_my_member()
+
+        # SELF creates messages
+        messages = [community.create_full_sync_text("foo-bar", forward=False) for _ in xrange(30)]
+        known = messages[:25]
+        missing = messages[25:]
+
+        sync = (1, 0, 1, 0, [message.packet for message in known])
+        node.drop_packets()
+        node.give_message(node.create_dispersy_introduction_request_message(community.my_candidate, node.lan_address, node.wan_address, False, u"unknown", sync, 42, 110, reconciliation=True))
+
+        received = []
+        while True:
+            try:
+                _, message = node.receive_message(message_names=[u"full-sync-text"])
+                received.append(message.distribution.global_time)
+            except socket.error:
+                break
+
+        global_times = [message.distribution.global_time for message in missing]
+        assert_(sorted(global_times) == sorted(received), sorted(global_times), sorted(received))
+
+        # cleanup
+        community.create_dispersy_destroy_community(u"hard-kill")
+        self._dispersy.get_community(community.cid).unload_community()
+
+    def reconciliation_fallback_test(self):
+        """
+        NODE sends an introduction request with an InvertibleBloomLookupTable that has far more
+        differences than it can decode.  The next introduction response from SELF must ask NODE to
+        send a bloom filter instead, the one after that must accept lookup tables again.
+        """
+        class ReconciliationCommunity(DebugCommunity):
+            @property
+            def dispersy_sync_reconciliation(self):
+                return True
+
+        community = ReconciliationCommunity.create_community(self._my_member)
+
+        # create node and ensure that SELF knows the node address
+        node = DebugNode()
+        node.init_socket()
+        node.set_community(community)
+        node.init_my_member()
+
+        # SELF creates more messages than a 72 cell table can decode
+        for _ in xrange(100):
+            community.create_full_sync_text("foo-bar", forward=False)
+
+        for sync, expected in (((1, 0, 1, 0, []), True), (None, False), (None, True)):
+            node.drop_packets()
+            node.give_message(node.create_dispersy_introduction_request_message(community.my_candidate, node.lan_address, node.wan_address, False, u"unknown", sync, 42, 210, reconciliation=True))
+            _, response = node.receive_message(message_names=[u"dispersy-introduction-response"])
+            assert_(response.payload.reconciliation == expected, response.payload.reconciliation, expected)
+
+        # cleanup
+        community.create_dispersy_destroy_community(u"hard-kill")
+        self._dispersy.get_community(community.cid).unload_community()
+
+    def fingerprint_test(self):
+        """
+        NODE sends an introduction request with the fingerprint of the packets that SELF has in the
+        requested range.  SELF must skip the range.  With a different fingerprint the missing
+        packets must be sent back.
+        """
+        community = DebugCommunity.create_community(self._my_member)
+
+        # create node and ensure that SELF knows the node address
+        node = DebugNode()
+        node.init_socket()
+        node.set_community(community)
+        node.init_my_member()
+
+        # SELF creates messages
+        messages = [community.create_full_sync_text("foo-bar", forward=False) for _ in xrange(10)]
+        global_times = [message.distribution.global_time for message in messages]
+
+        fingerprint = community.get_sync_fingerprint(1, 0)
+        count, xor = fingerprint
+        for fingerprint, expected in ((fingerprint, []), ((count + 1, xor), global_times)):
+            node.drop_packets()
+            node.give_message(node.create_dispersy_introduction_request_message(community.my_candidate, node.lan_address, node.wan_address, False, u"unknown", (1, 0, 1, 0, []), 42, 110, reconciliation=True, fingerprint=fingerprint))
+
+            received = []
+            while True:
+                try:
+                    _, message = node.receive_message(message_names=[u"full-sync-text"])
+                    received.append(message.distribution.global_time)
+                except socket.error:
+                    break
+
+            assert_(sorted(received) == sorted(expected), sorted(received), sorted(expected))
+
+        # cleanup
+        community.create_dispersy_destroy_community(u"hard-kill")
+        self._dispersy.get_community(community.cid).unload_community()
+
+    def paced_response_test(self):
+        """
+        With a sync_response_rate of one packet per interval, the response that SELF sends to NODE
+        must be spread over several intervals.  When NODE sends a newer introduction request while
+        packets are still queued, only the response to the newer request must be sent.
+
+        Besides the full-sync-text messages the response contains the higher priority dispersy-*
+        messages of the community, hence every sync packet that NODE receives is counted.
+        """
+        community = DebugCommunity.create_community(self._my_member)
+
+        # create node and ensure that SELF knows the node address
+        node = DebugNode()
+        node.init_socket()
+        node.set_community(community)
+        node.init_my_member()
+
+        # SELF creates messages
+        messages = [community.create_full_sync_text("Paced #%d" % i, forward=False) for i in xrange(10)]
+        global_times = sorted(message.distribution.global_time for message in messages)
+
+        def receive():
+            received = []
+            while True:
+                try:
+                    _, message = node.receive_message()
+                except socket.error:
+                    break
+                if isinstance(message.meta.distribution, SyncDistribution):
+                    received.append((message.name, message.distribution.global_time))
+            return received
+
+        def texts(received):
+            return sorted(global_time for name, global_time in received if name == u"full-sync-text")
+
+        def wait_until_sent():
+            # the callback may run the intervals later than requested
+            for _ in xrange(100):
+                if not self._dispersy._sync_response_queues:
+                    break
+                yield 0.1
+            yield 0.1
+
+        # _paced_sync_response sends at least one packet every 0.1 seconds, the allowance is half a
+        # packet
+        sync_response_rate = self._dispersy.sync_response_rate
+        self._dispersy.sync_response_rate = 5 * max(len(message.packet) for message in messages)
+
+        # the response is spread over several intervals
+        node.drop_packets()
+        node.give_message(node.create_dispersy_introduction_request_message(community.my_candidate, node.lan_address, node.wan_address, False, u"unknown", (1, 0, 1, 0, []), 42, max(global_times)))
+        yield 0.05
+        first = receive()
+        assert_(0 < len(first) < len(messages), first)
+        assert_(self._dispersy._sync_response_queues, "the remaining packets must be queued")
+        for delay in wait_until_sent():
+            yield delay
+        rest = receive()
+        assert_(texts(first + rest) == global_times, texts(first + rest), global_times)
+        assert_(not self._dispersy._sync_response_queues, "all packets must be sent")
+
+        # a newer request replaces the queued response
+        node.give_message(node.create_dispersy_introduction_request_message(community.my_candidate, node.lan_address, node.wan_address, False, u"unknown", (1, 0, 1, 0, []), 43, max(global_times)))
+        yield 0.05
+        first = receive()
+        assert_(0 < len(first) < 5 and texts(first) == global_times[:len(texts(first))], first)
+        node.give_message(node.create_dispersy_introduction_request_message(community.my_candidate, node.lan_address, node.wan_address, False, u"unknown", (global_times[5], 0, 1, 0, []), 44, max(global_times)))
+        for delay in wait_until_sent():
+            yield delay
+        rest = receive()
+        assert_(texts(rest) == global_times[5:], texts(rest), global_times[5:])
+
+        # cleanup
+        self._dispersy.sync_response_rate = sync_response_rate
+        community.create_dispersy_destroy_community(u"hard-kill")
+        self._dispersy.get_community(community.cid).unload_community()
+
     def in_order_test(self):
         community = DebugCommunity.create_community(self._my_member)
         message = community.get_meta_message(u"ASC-text")
@@ -1700,7 +1960,7 @@ class DispersySyncScript(ScriptBase):
             node.give_message(message)
             number_of_messages += 1
             try:
-                packet, = self._dispersy_database.execute(u"SELECT packet FROM sync WHERE community = ? AND member = ? AND global_time = ? AND meta_message = ?", (community.database_id, node.my_member.database_id, global_time, message.database_id)).next()
+                packet, = self._dispersy_database.execute(u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? AND member = ? AND global_time = ? AND meta_message = ?", (community.database_id, node.my_member.database_id, global_time, message.database_id)).next()
             except StopIteration:
                 assert_(False)
             assert_(str(packet) == message.packet)
@@ -1724,7 +1984,7 @@ class DispersySyncScript(ScriptBase):
             message = node.create_last_9_test_message("wrong content!", global_time)
             node.give_message(message)
             try:
-                packet, = self._dispersy_database.execute(u"SELECT packet FROM sync WHERE community = ? AND member = ? AND global_time = ? AND meta_message = ?", (community.database_id, node.my_member.database_id, global_time, message.database_id)).next()
+                packet, = self._dispersy_database.execute(u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? AND member = ? AND global_time = ? AND meta_message = ?", (community.database_id, node.my_member.database_id, global_time, message.database_id)).next()
             except StopIteration:
                 assert_(False)
             assert_(not str(packet) == message.packet)
@@ -1741,7 +2001,7 @@ class DispersySyncScript(ScriptBase):
             match_times.append(global_time)
             match_times.sort()
             try:
-                packet, = self._dispersy_database.execute(u"SELECT packet FROM sync WHERE community = ? AND member = ? AND global_time = ? AND meta_message = ?", (community.database_id, node.my_member.database_id, global_time, message.database_id)).next()
+                packet, = self._dispersy_database.execute(u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? AND member = ? AND global_time = ? AND meta_message = ?", (community.database_id, node.my_member.database_id, global_time, message.database_id)).next()
             except StopIteration:
                 assert_(False)
             assert_(str(packet) == message.packet)
@@ -1935,6 +2195,7 @@ class DispersyIdenticalPayloadScript(ScriptBase):
 
         self.caller(self.incoming__drop_first)
         self.caller(self.incoming__drop_second)
+        self.caller(self.incoming__replace_last_sync)
 
     def incoming__drop_first(self):
         """
@@ -1970,7 +2231,7 @@ class DispersyIdenticalPayloadScript(ScriptBase):
 
         # only one message may be in the database
         try:
-            packet, =  self._dispersy_database.execute(u"SELECT packet FROM sync WHERE community = ? AND member = ? AND global_time = ?",
+            packet, =  self._dispersy_database.execute(u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? AND member = ? AND global_time = ?",
                                                        (community.database_id, node.my_member.database_id, global_time)).next()
         except StopIteration:
             assert_(False, "neither messages is stored")
@@ -2025,7 +2286,7 @@ class DispersyIdenticalPayloadScript(ScriptBase):
 
         # only one message may be in the database
         try:
-            packet, =  self._dispersy_database.execute(u"SELECT packet FROM sync WHERE community = ? AND member = ? AND global_time = ?",
+            packet, =  self._dispersy_database.execute(u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? AND member = ? AND global_time = ?",
                                                        (community.database_id, node.my_member.database_id, global_time)).next()
         except StopIteration:
             assert_(False, "neither messages is stored")
@@ -2046,6 +2307,57 @@ class DispersyIdenticalPayloadScript(ScriptBase):
         community.create_dispersy_destroy_community(u"hard-kill")
         self._dispersy.get_community(community.cid).unload_community()
 
+    def incoming__replace_last_sync(self):
+        """
+        NODE creates two last-1-test messages with the same community/member/global-time triplets,
+        followed by a newer last-1-test message.
+
+        - The stored message is replaced by the message with the higher packet
+        - The newer message replaces the replaced message, according to the updated history
+        """
+        community = DebugCommunity.create_community(self._my_member)
+        meta = community.get_meta_message(u"last-1-test")
+
+        # create node and ensure that SELF knows the node address
+        node = DebugNode()
+        node.init_socket()
+        node.set_community(community)
+        node.init_my_member()
+        yield 0.555
+
+        # create messages
+        global_time = 10
+        messages = []
+        messages.append(node.create_last_1_test_message("Identical payload message", global_time))
+        messages.append(node.create_last_1_test_message("Identical payload message", global_time))
+        messages.sort(key=lambda x: x.packet)
+
+        node.give_message(messages[0])
+        yield 0.555
+        node.give_message(messages[1])
+        yield 0.555
+
+        # the history of the replaced message must not be kept
+        key = (meta.database_id, (node.my_member.database_id,))
+        assert_(not key in self._dispersy._last_sync_histories)
+        packet, = self._dispersy_database.execute(u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? AND member = ? AND meta_message = ?",
+                                                  (community.database_id, node.my_member.database_id, meta.database_id)).next()
+        assert_(str(packet) == messages[1].packet)
+
+        # the newer message must replace the stored one
+        message = node.create_last_1_test_message("Newer message", global_time + 1)
+        node.give_message(message)
+        yield 0.555
+        packets = [str(packet) for packet, in self._dispersy_database.execute(u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? AND member = ? AND meta_message = ?",
+                                                                                 (community.database_id, node.my_member.database_id, meta.database_id))]
+        assert_(packets == [message.packet], len(packets))
+        history = self._dispersy._last_sync_histories[key]
+        assert_([(history_time, digest) for history_time, digest, _, _ in history] == [(global_time + 1, sha1(message.packet).digest())], history)
+
+        # cleanup
+        community.create_dispersy_destroy_community(u"hard-kill")
+        self._dispersy.get_community(community.cid).unload_community()
+
 class DispersySignatureScript(ScriptBase):
     def run(self):
         ec = ec_generate_key(u"low")
@@ -2967,7 +3279,7 @@ class DispersyUndoScript(ScriptBase):
             undone = list(self._dispersy_database.execute(u"SELECT undone FROM sync WHERE community = ? AND member = ? AND global_time = ?",
                                                           (community.database_id, node.my_member.database_id, message.distribution.global_time)))
             assert_(len(undone) == 1)
-            undone_packet, = self._dispersy_database.execute(u"SELECT packet FROM sync WHERE id = ?", (undone[0][0],)).next()
+            undone_packet, = self._dispersy_database.execute(u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE id = ?", (undone[0][0],)).next()
             undone_packet = str(undone_packet)
             assert_(undo.packet == undone_packet, undone)
 
@@ -3021,7 +3333,7 @@ class DispersyUndoScript(ScriptBase):
             undone = list(self._dispersy_database.execute(u"SELECT undone FROM sync WHERE community = ? AND member = ? AND global_time = ?",
                                                           (community.database_id, node2.my_member.database_id, message.distribution.global_time)))
             assert_(len(undone) == 1)
-            undone_packet, = self._dispersy_database.execute(u"SELECT packet FROM sync WHERE id = ?", (undone[0][0],)).next()
+            undone_packet, = self._dispersy_database.execute(u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE id = ?", (undone[0][0],)).next()
             undone_packet = str(undone_packet)
             assert_(undo.packet == undone_packet)
 
@@ -3100,7 +3412,7 @@ class DispersyUndoScript(ScriptBase):
         assert_(Member(node.my_member.public_key).must_blacklist)
 
         # all messages for the malicious member must be removed
-        packets = list(self._dispersy_database.execute(u"SELECT packet FROM sync WHERE community = ? AND member = ?",
+        packets = list(self._dispersy_database.execute(u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ? AND member = ?",
                                                        (community.database_id, node.my_member.database_id)))
         assert_(packets == [])
 
@@ -3163,7 +3475,7 @@ class DispersyUndoScript(ScriptBase):
         undone = list(self._dispersy_database.execute(u"SELECT undone FROM sync WHERE community = ? AND member = ? AND global_time = ?",
                                                       (community.database_id, message.authentication.member.database_id, message.distribution.global_time)))
         assert_(len(undone) == 1)
-        undone_packet, = self._dispersy_database.execute(u"SELECT packet FROM sync WHERE id = ?", (undone[0][0],)).next()
+        undone_packet, = self._dispersy_database.execute(u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE id = ?", (undone[0][0],)).next()
         undone_packet = str(undone_packet)
         assert_(undo.packet == undone_packet)
 
@@ -3220,7 +3532,7 @@ class DispersyUndoScript(ScriptBase):
             undone = list(self._dispersy_database.execute(u"SELECT undone FROM sync WHERE community = ? AND member = ? AND global_time = ?",
                                                           (community.database_id, node.my_member.database_id, message.distribution.global_time)))
             assert_(len(undone) == 1)
-            undone_packet, = self._dispersy_database.execute(u"SELECT packet FROM sync WHERE id = ?", (undone[0][0],)).next()
+            undone_packet, = self._dispersy_database.execute(u"SELECT IFNULL(packet, segment_packet(location)) FROM sync WHERE id = ?", (undone[0][0],)).next()
             undone_packet = str(undone_packet)
             assert_(undo.packet == undone_packet)
 
@@ -3287,6 +3599,199 @@ class DispersyUndoScript(ScriptBase):
         community.create_dispersy_destroy_community(u"hard-kill")
         self._dispersy.get_community(community.cid).unload_community()
 
+class DispersyPacketSegmentScript(ScriptBase):
+    def run(self):
+        ec = ec_generate_key(u"low")
+        self._my_member = Member(ec_to_public_bin(ec), ec_to_private_bin(ec))
+
+        self.caller(self.store_undo_sync_compact)
+
+    def store_undo_sync_compact(self):
+        """
+        With packet segments enabled, SELF stores messages from NODE in a new segment, NODE undoes
+        them, and NODE syncs them back.  Once most packets in the segment are replaced by newer
+        LastSyncDistribution messages the segment must be compacted without losing any packets.
+        """
+        packet_segments = self._dispersy.packet_segments
+        self._dispersy.packet_segments = True
+        packet_store = self._dispersy_database.packet_store
+        packet_store.seal()
+
+        community = DebugCommunity.create_community(self._my_member)
+
+        node = DebugNode()
+        node.init_socket()
+        node.set_community(community)
+        node.init_my_member()
+
+        # SELF grants undo permission to NODE
+        community.create_dispersy_authorize([(node.my_member, community.get_meta_message(u"full-sync-text"), u"undo")])
+        segment = packet_store.active_segment
+        assert_(segment is not None)
+
+        # store: the packets must be in the segment, not in the sync table
+        messages = [node.create_full_sync_text_message("Should undo @%d" % global_time, global_time) for global_time in xrange(10, 20)]
+        node.give_messages(messages)
+        for message in messages:
+            packet, location = self._dispersy_database.execute(u"SELECT packet, location FROM sync WHERE community = ? AND member = ? AND global_time = ?",
+                                                               (community.database_id, node.my_member.database_id, message.distribution.global_time)).next()
+            assert_(packet is None, "the packet must be stored in a segment")
+            assert_(location >> 48 == segment, location >> 48, segment)
+            assert_(packet_store.read(location) == message.packet)
+
+        # undo: decoding a dispersy-undo-own message reads the undone packet from the segment
+        undoes = [node.create_dispersy_undo_own_message(message, message.distribution.global_time + 100, i + 1) for i, message in enumerate(messages)]
+        node.give_messages(undoes)
+        for message in messages:
+            assert_message_stored(community, node.my_member, message.distribution.global_time, undone="undone")
+        for message in undoes:
+            assert_message_stored(community, node.my_member, message.distribution.global_time)
+
+        # sync: the packets are read from the segment, only the undo messages are not undone
+        node.drop_packets()
+        node.give_message(node.create_dispersy_introduction_request_message(community.my_candidate, node.lan_address, node.wan_address, False, u"unknown", (1, 0, 1, 0, []), 42, 200))
+        received = []
+        while True:
+            try:
+                _, message = node.receive_message(message_names=[u"full-sync-text", u"dispersy-undo-own"])
+                received.append(message.packet)
+            except socket.error:
+                break
+        assert_(sorted(received) == sorted(message.packet for message in undoes), len(received))
+
+        # LastSyncDistribution replaces the previous message, leaving mostly unreferenced packets in
+        # the segment
+        for global_time in xrange(300, 340):
+            node.give_message(node.create_last_1_test_message("x" * 200 + str(global_time), global_time))
+        count, = self._dispersy_database.execute(u"SELECT COUNT(*) FROM sync WHERE community = ? AND meta_message = ?",
+                                                 (community.database_id, community.get_meta_message(u"last-1-test").database_id)).next()
+        assert_(count == 1, count)
+        packets = dict((id_, str(packet)) for id_, packet in self._dispersy_database.execute(u"SELECT id, IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ?", (community.database_id,)))
+
+        # compact: all packets are moved from SEGMENT to the new active segment
+        packet_store.seal()
+        community.create_full_sync_text("Seal", forward=False)
+        compact = self._dispersy._compact_packet_segments()
+        for _ in xrange(100):
+            compact.next()
+            if segment in packet_store.retired_segments:
+                break
+        assert_(segment in packet_store.retired_segments, "the segment must be compacted")
+        count, = self._dispersy_database.execute(u"SELECT COUNT(*) FROM sync WHERE location BETWEEN ? AND ?", segment_location_range(segment)).next()
+        assert_(count == 0, count)
+        compacted = dict((id_, str(packet)) for id_, packet in self._dispersy_database.execute(u"SELECT id, IFNULL(packet, segment_packet(location)) FROM sync WHERE community = ?", (community.database_id,)))
+        assert_(all(compacted[id_] == packet for id_, packet in packets.iteritems()), "packets must not change during compaction")
+
+        # cleanup
+        community.create_dispersy_destroy_community(u"hard-kill")
+        self._dispersy.get_community(community.cid).unload_community()
+        self._dispersy.packet_segments = packet_segments
+
+class CommunityDatabaseCommunity(DebugCommunity):
+    @property
+    def dispersy_community_database(self):
+        return True
+
+class DispersyCommunityDatabaseScript(ScriptBase):
+    def run(self):
+        ec = ec_generate_key(u"low")
+        self._my_member = Member(ec_to_public_bin(ec), ec_to_private_bin(ec))
+
+        self.caller(self.store_undo_sync_reload)
+        self.caller(self.move_existing_messages)
+
+    def store_undo_sync_reload(self):
+        """
+        SELF creates a community with its own database.  Messages from NODE must be stored in the
+        community database, where they can be undone and synced.  Once the community is unloaded
+        the community database must be closed, and the messages must be available after it is
+        loaded again.
+        """
+        community = CommunityDatabaseCommunity.create_community(self._my_member)
+        database = community.sync_database
+        assert_(not database is self._dispersy_database)
+
+        node = DebugNode()
+        node.init_socket()
+        node.set_community(community)
+        node.init_my_member()
+
+        # store: the messages must be in the community database, not in the Dispersy database
+        messages = [node.create_full_sync_text_message("Community database @%d" % global_time, global_time) for global_time in xrange(10, 20)]
+        node.give_messages(messages)
+        for message in messages:
+            assert_message_stored(community, node.my_member, message.distribution.global_time)
+        count, = self._dispersy_database.execute(u"SELECT COUNT(*) FROM sync WHERE community = ?", (community.database_id,)).next()
+        assert_(count == 0, count)
+
+        # undo: decoding a dispersy-undo-own message reads the undone packet from the community
+        # database
+        undo = node.create_dispersy_undo_own_message(messages[0], 100, 1)
+        node.give_message(undo)
+        assert_message_stored(community, node.my_member, messages[0].distribution.global_time, undone="undone")
+        assert_message_stored(community, node.my_member, undo.distribution.global_time)
+
+        # sync: all messages except the undone one are returned
+        node.drop_packets()
+        node.give_message(node.create_dispersy_introduction_request_message(community.my_candidate, node.lan_address, node.wan_address, False, u"unknown", (1, 0, 1, 0, []), 42, 200))
+        received = []
+        while True:
+            try:
+                _, message = node.receive_message(message_names=[u"full-sync-text", u"dispersy-undo-own"])
+                received.append(message.packet)
+            except socket.error:
+                break
+        assert_(sorted(received) == sorted([message.packet for message in messages[1:]] + [undo.packet]), len(received))
+
+        # reload: the community database is closed and opened again
+        master = community.master_member
+        community.unload_community()
+        assert_(database.closed)
+        community = CommunityDatabaseCommunity.load_community(master)
+        assert_(not community.sync_database is database)
+        times = [global_time for global_time, in community.sync_database.execute(u"SELECT global_time FROM sync WHERE community = ? AND member = ? AND meta_message = ?",
+                                                                                 (community.database_id, node.my_member.database_id, community.get_meta_message(u"full-sync-text").database_id))]
+        assert_(sorted(times) == range(10, 20), times)
+        assert_message_stored(community, node.my_member, messages[0].distribution.global_time, undone="undone")
+
+        # cleanup
+        community.create_dispersy_destroy_community(u"hard-kill")
+        self._dispersy.get_community(community.cid).unload_community()
+
+    def move_existing_messages(self):
+        """
+        SELF stores messages from NODE in the Dispersy database.  Once the community is
+        reclassified to use its own database the messages must be moved into the community
+        database.
+        """
+        community = DebugCommunity.create_community(self._my_member)
+        assert_(community.sync_database is self._dispersy_database)
+
+        node = DebugNode()
+        node.init_socket()
+        node.set_community(community)
+        node.init_my_member()
+
+        messages = [node.create_full_sync_text_message("Move @%d" % global_time, global_time) for global_time in xrange(10, 20)]
+        node.give_messages(messages)
+        for message in messages:
+            assert_message_stored(community, node.my_member, message.distribution.global_time)
+
+        # reclassify: the messages are moved when the community database is opened
+        community = self._dispersy.reclassify_community(community, CommunityDatabaseCommunity)
+        assert_(not community.sync_database is self._dispersy_database)
+        count, = self._dispersy_database.execute(u"SELECT COUNT(*) FROM sync WHERE community = ?", (community.database_id,)).next()
+        assert_(count == 0, count)
+        for message in messages:
+            assert_message_stored(community, node.my_member, message.distribution.global_time)
+            packet, = community.sync_database.execute(u"SELECT packet FROM sync WHERE community = ? AND member = ? AND global_time = ?",
+                                                      (community.database_id, node.my_member.database_id, message.distribution.global_time)).next()
+            assert_(str(packet) == message.packet)
+
+        # cleanup
+        community.create_dispersy_destroy_community(u"hard-kill")
+        self._dispersy.get_community(community.cid).unload_community()
+
 class DispersyCryptoScript(ScriptBase):
     def run(self):
         ec = ec_generate_key(u"low")
@@ -3319,8 +3824,8 @@ class DispersyCryptoScript(ScriptBase):
         node.give_packet(invalid_packet)
 
         # ensure that the message was not stored in the database
-        ids = list(self._dispersy_database.execute(u"SELECT id FROM sync WHERE community = ? AND packet = ?",
-                                                   (community.database_id, buffer(invalid_packet))))
+        ids = list(self._dispersy_database.execute(u"SELECT id FROM sync WHERE community = ? AND digest = ?",
+                                                   (community.database_id, buffer(sha1(invalid_packet).digest()))))
         assert_(ids == [], ids)
 
         # cleanup
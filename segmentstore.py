@@ -0,0 +1,243 @@
+"""
+Store packets in append-only segment files instead of the sync table.
+
+Every packet is normally stored as a BLOB in the sync table.  When the PacketSegmentStore is used,
+the packet is appended to a segment file and the sync table only stores its location.  Segments
+are read through mmap, i.e. packets are served from the page cache without being copied through
+sqlite.
+
+A location is one integer containing the segment number, the offset in the segment, and the
+packet length:
+
+ location = segment << 48 | offset << 16 | length
+
+Hence a segment is at most 4GB and a packet at most 64KB, the latter is larger than any UDP
+datagram.  Segments are never modified once written.  Packets that are no longer referenced are
+removed by copying the remaining packets of a segment to the active segment, after which the old
+segment is removed, see Dispersy._compact_packet_segments.
+"""
+
+from mmap import mmap, ACCESS_READ
+from os import path, listdir, makedirs, remove, fsync
+from time import time
+
+if __debug__:
+    from dprint import dprint
+
+def make_location(segment, offset, length):
+    assert 0 <= segment < 2**15, segment
+    assert 0 <= offset < 2**32, offset
+    assert 0 < length < 2**16, length
+    return segment << 48 | offset << 16 | length
+
+def split_location(location):
+    """
+    Returns the (segment, offset, length) tuple for LOCATION.
+    """
+    return location >> 48, (location >> 16) & 0xffffffff, location & 0xffff
+
+def segment_location_range(segment):
+    """
+    Returns the lowest and highest possible location in SEGMENT.
+    """
+    return segment << 48, ((segment + 1) << 48) - 1
+
+class PacketSegmentStore(object):
+    """
+    Reads and appends packets to segment files in DIRECTORY.
+
+    A PacketSegmentStore may only be used from one thread.  Other threads must use their own
+    instance, see create_reader.  Only one instance may append packets.
+    """
+    def __init__(self, directory, segment_size=2**26, read_only=False):
+        assert isinstance(directory, unicode)
+        assert isinstance(segment_size, (int, long))
+        assert 0 < segment_size < 2**32
+        assert isinstance(read_only, bool)
+        self._directory = directory
+        self._segment_size = segment_size
+        self._read_only = read_only
+        # _maps contains the (file, mmap) for each segment that has been read
+        self._maps = {}
+        # _active is the (segment, file, size) of the segment where packets are appended
+        self._active = None
+        self._dirty = False
+        # when _sealed is True the next packet is appended to a new segment
+        self._sealed = False
+        # _retired contains (timestamp, segment) tuples for segments that will be removed
+        self._retired = []
+        self._append_count = 0
+        self._read_count = 0
+
+    @property
+    def directory(self):
+        return self._directory
+
+    def _segment_path(self, segment):
+        return path.join(self._directory, u"segment-%05d" % segment)
+
+    def segments(self):
+        """
+        Returns a sorted list with (segment, size) tuples for all segments on disk.
+        """
+        if not path.isdir(self._directory):
+            return []
+        segments = []
+        for filename in listdir(self._directory):
+            if filename.startswith(u"segment-"):
+                segment = int(filename[8:])
+                segments.append((segment, path.getsize(self._segment_path(segment))))
+        return sorted(segments)
+
+    @property
+    def active_segment(self):
+        """
+        The segment where packets are appended, or None when no packets were appended yet.
+        """
+        return self._active[0] if self._active else None
+
+    def _open_active(self, length):
+        """
+        Ensure that the active segment has room for LENGTH more bytes.
+        """
+        if self._active and self._active[2] + length <= self._segment_size and not self._sealed:
+            return
+
+        if self._active:
+            self.sync()
+            self._active[1].close()
+
+        segments = self.segments()
+        if self._active is None and not self._sealed and segments and segments[-1][1] + length <= self._segment_size:
+            # continue with the most recent segment
+            segment, size = segments[-1]
+        else:
+            segment, size = (segments[-1][0] + 1 if segments else 0), 0
+            assert segment < 2**15, "too many segments"
+        if not path.isdir(self._directory):
+            makedirs(self._directory)
+        self._active = (segment, open(self._segment_path(segment), "ab"), size)
+        self._sealed = False
+        if __debug__: dprint("appending to segment ", segment, " (", size, " bytes)")
+
+    def append(self, packet):
+        """
+        Append PACKET to the active segment and return its location.
+
+        The packet is not durable until sync() is called.
+        @rtype: int or long
+        """
+        assert not self._read_only
+        assert isinstance(packet, str)
+        self._open_active(len(packet))
+        segment, handle, size = self._active
+        handle.write(packet)
+        self._active = (segment, handle, size + len(packet))
+        self._dirty = True
+        self._append_count += 1
+        return make_location(segment, size, len(packet))
+
+    def seal(self):
+        """
+        Stop appending to the active segment, the next packet is appended to a new segment.
+        """
+        assert not self._read_only
+        self._sealed = True
+
+    def sync(self):
+        """
+        Flush and fsync the active segment when packets were appended since the previous sync.
+
+        This must be called before the database commit that references the appended packets.
+        """
+        if self._dirty:
+            handle = self._active[1]
+            handle.flush()
+            fsync(handle.fileno())
+            self._dirty = False
+
+    def read(self, location):
+        """
+        Returns the packet at LOCATION.
+        @rtype: str
+        """
+        segment, offset, length = split_location(location)
+        try:
+            _, data = self._maps[segment]
+        except KeyError:
+            data = None
+
+        if data is None or offset + length > len(data):
+            # map the segment, or map it again when it has grown
+            if self._active and self._active[0] == segment:
+                self._active[1].flush()
+            if segment in self._maps:
+                handle, data = self._maps.pop(segment)
+                data.close()
+                handle.close()
+            handle = open(self._segment_path(segment), "rb")
+            data = mmap(handle.fileno(), 0, access=ACCESS_READ)
+            self._maps[segment] = (handle, data)
+
+        self._read_count += 1
+        return data[offset:offset + length]
+
+    def retire(self, segment, delay=60.0):
+        """
+        Remove SEGMENT once it is no longer referenced.
+
+        The segment file is removed after DELAY seconds, allowing queries on other connections to
+        finish reading from it.
+        """
+        assert not self._read_only
+        assert segment != self.active_segment
+        assert not segment in self.retired_segments
+        self._retired.append((time() + delay, segment))
+
+    @property
+    def retired_segments(self):
+        """
+        The segments that will be removed.
+        """
+        return [segment for _, segment in self._retired]
+
+    def remove_retired(self):
+        """
+        Remove the retired segments whose delay has passed.
+        """
+        now = time()
+        retired = [segment for timestamp, segment in self._retired if timestamp <= now]
+        self._retired = [(timestamp, segment) for timestamp, segment in self._retired if timestamp > now]
+        for segment in retired:
+            if segment in self._maps:
+                handle, data = self._maps.pop(segment)
+                data.close()
+                handle.close()
+            if __debug__: dprint("removing segment ", segment)
+            remove(self._segment_path(segment))
+
+    def create_reader(self):
+        """
+        Returns a read-only PacketSegmentStore for the same directory.
+        @rtype: PacketSegmentStore
+        """
+        return PacketSegmentStore(self._directory, self._segment_size, read_only=True)
+
+    def close(self):
+        if self._active:
+            self.sync()
+            self._active[1].close()
+            self._active = None
+        for handle, data in self._maps.itervalues():
+            data.close()
+            handle.close()
+        self._maps = {}
+
+    def info(self):
+        segments = self.segments()
+        return {"segments":len(segments),
+                "size":sum(size for _, size in segments),
+                "active":self.active_segment,
+                "retired":len(self._retired),
+                "appended":self._append_count,
+                "read":self._read_count}
@@ -0,0 +1,200 @@
+"""
+Choose sync ranges based on the number of new packets that previous syncs produced.
+
+Every introduction-request includes a sync range, selected by one of the
+Community.dispersy_claim_sync_bloom_filter_* strategies.  These strategies do not take into account
+whether a range recently produced any missing packets.  The SyncPlanner records, for each claimed
+range, how many new packets were received from the candidate that the request was sent to.  The
+adaptive strategy uses these yields to claim high yield ranges more often, while the remaining
+claims use a uniformly chosen pivot to ensure that every range is eventually synchronized.
+
+Only packets that arrive in response to a sync request are counted.  Every packet that is created
+after a peer received the introduction-request has a higher global time than the requester had
+when it sent the request.  Hence packets above that global time are live gossip rather than a
+sync response, even when they fall within the claimed range.
+
+The SyncPlanner also keeps telemetry for every strategy, allowing the bytes spent per new packet to
+be compared between strategies.
+"""
+
+from random import Random
+from time import time
+
+if __debug__:
+    from dprint import dprint
+
+class SyncPlanner(object):
+    """
+    Records the yield of claimed sync ranges for a single community.
+
+    A claimed range is pending from the moment its introduction-request is sent until TIMEOUT
+    seconds later, or until a new request is sent to the same candidate.  New packets received from
+    that candidate within the range are attributed to the claim.
+
+    The score of a range is an exponential moving average, with weight DECAY for the previous
+    score, of the new packets per claim.  At most MAX_RANGES scores are kept.  EXPLOIT is the
+    probability that a pivot is chosen by score instead of uniformly.  RANDOM is the Random
+    instance used to choose pivots, allowing the choices to be reproduced.
+    """
+    def __init__(self, random=None, timeout=15.0, decay=0.5, max_ranges=256, exploit=0.5):
+        assert random is None or isinstance(random, Random)
+        assert isinstance(timeout, float)
+        assert timeout > 0.0
+        assert isinstance(decay, float)
+        assert 0.0 <= decay < 1.0
+        assert isinstance(max_ranges, int)
+        assert max_ranges > 0
+        assert isinstance(exploit, float)
+        assert 0.0 <= exploit <= 1.0
+        self._random = random or Random()
+        self._timeout = timeout
+        self._decay = decay
+        self._max_ranges = max_ranges
+        self._exploit = exploit
+        # _last_claim is the (strategy, time_low, time_high, modulo, offset) of the most recent claim
+        self._last_claim = None
+        # _pending contains sock_addr / [timestamp, strategy, time_low, time_high, modulo, offset,
+        # new_packets] pairs, where time_high is at most the global time when the request was sent
+        self._pending = {}
+        # _scores contains time_low / score pairs
+        self._scores = {}
+        # _strategies contains strategy / {"claims", "new_packets", "request_bytes", "response_bytes"}
+        # pairs
+        self._strategies = {}
+
+    def choose_pivot(self, global_time):
+        """
+        Returns the time_low of a high yield range, a uniformly chosen global time, or None when
+        no range has a positive score and the pivot should be chosen by the caller.
+        """
+        assert isinstance(global_time, (int, long))
+        random = self._random.random
+        candidates = [(score, time_low) for time_low, score in self._scores.iteritems() if score > 0.0 and time_low <= global_time]
+        if candidates and random() < self._exploit:
+            # weighted by score
+            point = random() * sum(score for score, _ in candidates)
+            for score, time_low in candidates:
+                point -= score
+                if point <= 0.0:
+                    return time_low
+            return candidates[-1][1]
+
+        if candidates:
+            return 1 + int(random() * global_time)
+
+        return None
+
+    def get_score(self, time_low):
+        """
+        Returns the score of the range starting at TIME_LOW, i.e. the recent number of new packets
+        per claim, or 0.0 when the range has no score.
+        """
+        return self._scores.get(time_low, 0.0)
+
+    def claim(self, strategy, sync):
+        """
+        Remember that STRATEGY claimed SYNC, a (time_low, time_high, modulo, offset, bloom_filter)
+        tuple or None, for the introduction-request that will be sent next.
+        """
+        assert isinstance(strategy, unicode)
+        if sync:
+            time_low, time_high, modulo, offset, _ = sync
+            self._last_claim = (strategy, time_low, time_high, modulo, offset)
+        else:
+            self._last_claim = None
+
+    def sent(self, sock_addr, request_bytes, global_time, now=None):
+        """
+        The introduction-request containing the most recently claimed range, using REQUEST_BYTES
+        for the sync, was sent to SOCK_ADDR at GLOBAL_TIME.
+        """
+        assert isinstance(global_time, (int, long))
+        if now is None:
+            now = time()
+        self.expire(now)
+        if self._last_claim:
+            if sock_addr in self._pending:
+                self._finish(self._pending.pop(sock_addr))
+
+            strategy, time_low, time_high, modulo, offset = self._last_claim
+            self._last_claim = None
+            statistics = self._get_strategy(strategy)
+            statistics["claims"] += 1
+            statistics["request_bytes"] += request_bytes
+            # packets created after SOCK_ADDR received the request have a higher global time
+            time_high = min(time_high, global_time) if time_high else global_time
+            self._pending[sock_addr] = [now, strategy, time_low, time_high, modulo, offset, 0]
+
+    def received(self, sock_addr, global_time, packet_bytes):
+        """
+        A new syncable packet with GLOBAL_TIME, of PACKET_BYTES bytes, was stored after it was
+        received from SOCK_ADDR.
+        """
+        pending = self._pending.get(sock_addr)
+        if pending:
+            _, strategy, time_low, time_high, modulo, offset, _ = pending
+            if time_low <= global_time <= time_high and (global_time + offset) % modulo == 0:
+                pending[6] += 1
+                statistics = self._get_strategy(strategy)
+                statistics["new_packets"] += 1
+                statistics["response_bytes"] += packet_bytes
+
+    def expire(self, now=None):
+        """
+        Finish the pending claims that are older than TIMEOUT seconds.
+        """
+        if now is None:
+            now = time()
+        for sock_addr in [sock_addr for sock_addr, pending in self._pending.iteritems() if pending[0] + self._timeout < now]:
+            self._finish(self._pending.pop(sock_addr))
+
+    def _finish(self, pending):
+        _, strategy, time_low, _, modulo, _, new_packets = pending
+        if modulo == 1:
+            # ranges using a modulo cover all global times, they are not scored
+            self._scores[time_low] = self._scores.get(time_low, 0.0) * self._decay + new_packets * (1.0 - self._decay)
+            if __debug__: dprint("range ", time_low, " yielded ", new_packets, " packets, score ", self._scores[time_low])
+            if len(self._scores) > self._max_ranges:
+                del self._scores[min(self._scores.iterkeys(), key=self._scores.get)]
+
+    def _get_strategy(self, strategy):
+        statistics = self._strategies.get(strategy)
+        if statistics is None:
+            self._strategies[strategy] = statistics = {"claims":0, "new_packets":0, "request_bytes":0, "response_bytes":0}
+        return statistics
+
+    def info(self):
+        """
+        Returns the planner statistics, including the bytes per new packet for each strategy.
+        """
+        now = time()
+        strategies = {}
+        for strategy, statistics in self._strategies.iteritems():
+            strategies[strategy] = dict(statistics)
+            strategies[strategy]["bytes_per_new_packet"] = float(statistics["request_bytes"] + statistics["response_bytes"]) / statistics["new_packets"] if statistics["new_packets"] else None
+        return {"pending":len([pending for pending in self._pending.itervalues() if pending[0] + self._timeout >= now]),
+                "ranges":len(self._scores),
+                "positive_ranges":len([score for score in self._scores.itervalues() if score > 0.0]),
+                "strategies":strategies}
+
+if __debug__:
+    if __name__ == "__main__":
+        p = SyncPlanner(Random(42), timeout=10.0)
+        p.claim(u"adaptive", (100, 200, 1, 0, None))
+        p.sent(("127.0.0.1", 1), 1000, 180, now=1.0)
+        p.received(("127.0.0.1", 1), 150, 100)
+        p.received(("127.0.0.1", 1), 190, 100)
+        p.received(("127.0.0.1", 1), 250, 100)
+        p.received(("127.0.0.1", 2), 150, 100)
+        info = p.info()
+        assert info["pending"] == 0, "the claim expired, although info does not finish it"
+        p.expire(now=20.0)
+        info = p.info()
+        assert info["strategies"][u"adaptive"]["new_packets"] == 1, info
+        assert info["strategies"][u"adaptive"]["bytes_per_new_packet"] == 1100.0, info
+        assert info["positive_ranges"] == 1, info
+
+        pivots = [p.choose_pivot(1000) for _ in xrange(10)]
+        q = SyncPlanner(Random(42))
+        q._scores = dict(p._scores)
+        assert pivots == [q.choose_pivot(1000) for _ in xrange(10)], "the same seed must give the same pivots"
@@ -0,0 +1,153 @@
+"""
+Select the packets for sync responses on a separate thread.
+
+Answering an introduction request requires a range query on the sync table and checking each
+resulting packet against the bloom filter of the requester.  When many peers synchronize at the
+same time these queries delay the processing of incoming messages on the callback thread.
+
+The SyncResponder runs these queries on a worker thread using its own read-only connection to the
+database, see DatabaseReader.  The database is switched to write-ahead logging so that the reader
+and the callback thread, which stores incoming messages, do not block each other.  The selected
+packets are handed back to the callback thread, where they are sent.
+"""
+
+from Queue import Queue, Full, Empty
+from threading import Thread
+from time import time
+
+if __debug__:
+    from dprint import dprint
+
+class SyncResponder(object):
+    """
+    Runs sync response jobs on a worker thread.
+
+    A job is a function that is called with a DatabaseReader.execute method as its first argument.
+    Its result is passed to a result function that is registered on the callback thread.  At most
+    MAX_PENDING jobs are queued, additional jobs are dropped since the requesting peer will retry
+    with a new introduction request anyway.
+
+    A job may use another database than DATABASE, for instance the database of a community, see
+    Community.dispersy_community_database.  The worker thread keeps one DatabaseReader for each
+    database and closes it once that database is closed.
+    """
+    def __init__(self, callback, database, max_pending=256):
+        assert isinstance(max_pending, int)
+        assert max_pending > 0
+        self._callback = callback
+        self._database = database
+        self._queue = Queue(max_pending)
+        self._thread = None
+        self._job_count = 0
+        self._drop_count = 0
+        self._fail_count = 0
+        self._duration = 0.0
+
+    @property
+    def is_running(self):
+        return self._thread is not None
+
+    def start(self):
+        """
+        Switch the database to write-ahead logging and start the worker thread.
+
+        Returns False, and does not start the worker thread, when the database could not be
+        switched to write-ahead logging.
+        @rtype: bool
+        """
+        assert self._thread is None
+        if not self._database.enable_write_ahead_log():
+            if __debug__: dprint("unable to enable write-ahead logging, not starting the SyncResponder", level="warning")
+            return False
+
+        self._thread = Thread(target=self._loop, name="SyncResponder")
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def stop(self, timeout=10.0):
+        """
+        Stop the worker thread once the queued jobs have been processed.
+        """
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def submit(self, func, args, result_func, result_args=(), database=None):
+        """
+        Queue FUNC(execute, *ARGS) to run on the worker thread.
+
+        EXECUTE queries DATABASE, or the database given to the constructor when DATABASE is None.
+        Once FUNC returns, RESULT_FUNC(*RESULT_ARGS + (result,)) is registered on the callback
+        thread.  Returns False when the job was dropped because too many jobs are pending.
+        @rtype: bool
+        """
+        assert self._thread, "SyncResponder.start() must be called first"
+        assert hasattr(func, "__call__")
+        assert isinstance(args, tuple)
+        assert hasattr(result_func, "__call__")
+        assert isinstance(result_args, tuple)
+        try:
+            self._queue.put_nowait((func, args, result_func, result_args, database or self._database))
+        except Full:
+            self._drop_count += 1
+            if __debug__: dprint("dropping sync response job, ", self._queue.qsize(), " jobs pending", level="warning")
+            return False
+        return True
+
+    def _loop(self):
+        # readers contains Database / DatabaseReader pairs
+        readers = {self._database:self._database.create_reader()}
+        try:
+            while True:
+                try:
+                    job = self._queue.get(timeout=10.0)
+                except Empty:
+                    job = ()
+
+                # close the readers of databases that have been closed, e.g. because their
+                # community was unloaded
+                for database in [database for database in readers if database.closed]:
+                    if __debug__: dprint("closing reader for ", database.file_path)
+                    readers.pop(database).close()
+
+                if job is None:
+                    break
+                if not job:
+                    continue
+
+                func, args, result_func, result_args, database = job
+                if database.closed:
+                    self._drop_count += 1
+                    continue
+
+                reader = readers.get(database)
+                if reader is None:
+                    reader = readers[database] = database.create_reader()
+
+                start = time()
+                try:
+                    result = func(reader.execute, *args)
+                except Exception:
+                    if __debug__: dprint(exception=True, level="error")
+                    self._fail_count += 1
+                else:
+                    self._callback.register(result_func, result_args + (result,))
+                self._duration += time() - start
+                self._job_count += 1
+
+        finally:
+            for reader in readers.itervalues():
+                reader.close()
+
+    def info(self):
+        """
+        Returns the SyncResponder statistics.
+        """
+        return {"running":self.is_running,
+                "pending":self._queue.qsize(),
+                "jobs":self._job_count,
+                "dropped":self._drop_count,
+                "failed":self._fail_count,
+                "duration":self._duration}
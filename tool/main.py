@@ -18,12 +18,23 @@ import threading
 
 from callback import Callback
 from dispersy import Dispersy
-from endpoint import TunnelEndpoint, StandaloneEndpoint
+from endpoint import TunnelEndpoint, StandaloneEndpoint, ReusePortEndpoint
+from syncresponder import SyncResponder
+from verifier import SignatureVerifier
 
 def main():
     def start():
         # start Dispersy
         dispersy = Dispersy.get_instance(callback, unicode(opt.statedir))
+        dispersy.signature_verifier = signature_verifier
+        dispersy.packet_segments = opt.packet_segments
+        if opt.commit_latency > 0.0:
+            dispersy.database.set_group_commit(opt.commit_latency, opt.commit_rows)
+        dispersy.sync_response_rate = opt.sync_response_rate
+        if opt.sync_responder:
+            sync_responder = SyncResponder(callback, dispersy.database)
+            if sync_responder.start():
+                dispersy.sync_responder = sync_responder
 
         if opt.swiftproc:
             # start swift
@@ -38,7 +49,10 @@ def main():
             def exception(exception, fatal):
                 if fatal:
                     dispersy.endpoint.stop()
-            dispersy.endpoint = StandaloneEndpoint(dispersy, opt.port, opt.ip)
+            if opt.receive_threads > 1:
+                dispersy.endpoint = ReusePortEndpoint(dispersy, opt.port, opt.ip, opt.receive_threads, opt.batch_size)
+            else:
+                dispersy.endpoint = StandaloneEndpoint(dispersy, opt.port, opt.ip, opt.batch_size)
             dispersy.endpoint.start()
             dispersy.callback.attach_exception_handler(exception)
 
@@ -54,15 +68,17 @@ def main():
                     script_kargs[key] = value
 
             if opt.enable_dispersy_script:
-                from script import DispersyClassificationScript, DispersyTimelineScript, DispersyDestroyCommunityScript, DispersyBatchScript, DispersySyncScript, DispersyIdenticalPayloadScript, DispersySubjectiveSetScript, DispersySignatureScript, DispersyMemberTagScript, DispersyMissingMessageScript, DispersyUndoScript, DispersyCryptoScript, DispersyDynamicSettings, DispersyBootstrapServers, DispersyBootstrapServersStresstest
+                from script import DispersyClassificationScript, DispersyTimelineScript, DispersyDestroyCommunityScript, DispersyBatchScript, DispersySyncScript, DispersyIdenticalPayloadScript, DispersySubjectiveSetScript, DispersySignatureScript, DispersyMemberTagScript, DispersyMissingMessageScript, DispersyUndoScript, DispersyPacketSegmentScript, DispersyCommunityDatabaseScript, DispersyCryptoScript, DispersyDynamicSettings, DispersyBootstrapServers, DispersyBootstrapServersStresstest
                 script.add("dispersy-batch", DispersyBatchScript)
                 script.add("dispersy-classification", DispersyClassificationScript)
+                script.add("dispersy-community-database", DispersyCommunityDatabaseScript)
                 script.add("dispersy-crypto", DispersyCryptoScript)
                 script.add("dispersy-destroy-community", DispersyDestroyCommunityScript)
                 script.add("dispersy-dynamic-settings", DispersyDynamicSettings)
                 script.add("dispersy-identical-payload", DispersyIdenticalPayloadScript)
                 script.add("dispersy-member-tag", DispersyMemberTagScript)
                 script.add("dispersy-missing-message", DispersyMissingMessageScript)
+                script.add("dispersy-packet-segment", DispersyPacketSegmentScript)
                 script.add("dispersy-signature", DispersySignatureScript)
                 script.add("dispersy-subjective-set", DispersySubjectiveSetScript)
                 script.add("dispersy-sync", DispersySyncScript)
@@ -117,6 +133,14 @@ def main():
     command_line_parser.add_option("--statedir", action="store", type="string", help="Use an alternate statedir", default=u".")
     command_line_parser.add_option("--ip", action="store", type="string", default="0.0.0.0", help="Dispersy uses this ip")
     command_line_parser.add_option("--port", action="store", type="int", help="Dispersy uses this UDL port", default=12345)
+    command_line_parser.add_option("--batch-size", action="store", type="int", help="Receive and send up to BATCH_SIZE datagrams per system call (requires recvmmsg/sendmmsg)", default=1)
+    command_line_parser.add_option("--receive-threads", action="store", type="int", help="Receive on RECEIVE_THREADS SO_REUSEPORT sockets, each with its own thread", default=1)
+    command_line_parser.add_option("--verify-processes", action="store", type="int", help="Verify the signatures of incoming batches using VERIFY_PROCESSES worker processes", default=0)
+    command_line_parser.add_option("--commit-latency", action="store", type="float", help="Group database commits, committing at most COMMIT_LATENCY seconds after a change", default=0.0)
+    command_line_parser.add_option("--commit-rows", action="store", type="int", help="Group database commits, committing once COMMIT_ROWS rows are pending (requires --commit-latency)", default=1000)
+    command_line_parser.add_option("--packet-segments", action="store_true", help="Store new packets in append-only segment files instead of the database", default=False)
+    command_line_parser.add_option("--sync-responder", action="store_true", help="Select the packets for sync responses on a separate thread using a read-only database connection", default=False)
+    command_line_parser.add_option("--sync-response-rate", action="store", type="int", help="Send sync responses at most SYNC_RESPONSE_RATE bytes per second to each candidate (0 sends each response at once)", default=0)
     command_line_parser.add_option("--timeout-check-interval", action="store", type="float", default=1.0)
     command_line_parser.add_option("--timeout", action="store", type="float", default=300.0)
     command_line_parser.add_option("--enable-allchannel-script", action="store_true", help="Include allchannel scripts", default=False)
@@ -139,10 +163,15 @@ def main():
     opt, args = command_line_parser.parse_args()
     print "Press Ctrl-C to stop Dispersy"
 
+    # the worker processes must be forked before any threads are started
+    signature_verifier = SignatureVerifier(opt.verify_processes) if opt.verify_processes > 0 else None
+
     # start threads
     callback = Callback()
     callback.register(start)
     callback.loop()
+    if signature_verifier:
+        signature_verifier.close()
 
     if callback.exception:
         global exit_exception
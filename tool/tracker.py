@@ -16,10 +16,12 @@ http://www.python.org/dev/peps/pep-0328/
    regardless of where the module is actually located on the file system.
 """
 
+from multiprocessing import Pipe, Process
 from random import random
 from time import time
 import errno
 import optparse
+import os
 import signal
 import sys
 
@@ -30,7 +32,7 @@ from conversion import BinaryConversion
 from crypto import ec_generate_key, ec_to_public_bin, ec_to_private_bin
 from dispersy import Dispersy
 from dprint import dprint
-from endpoint import StandaloneEndpoint
+from endpoint import StandaloneEndpoint, ShardEndpoint, ShardRouter
 from member import DummyMember, Member
 
 if sys.platform == 'win32':
@@ -86,7 +88,7 @@ class TrackerCommunity(Community):
     def initiate_conversions(self):
         return [BinaryTrackerConversion(self, "\x00")]
 
-    def dispersy_claim_sync_bloom_filter(self, identifier):
+    def dispersy_claim_sync_bloom_filter(self, identifier, bloom_filter=True):
         # disable the sync mechanism
         return None
 
@@ -231,11 +233,16 @@ def main():
     command_line_parser.add_option("--statedir", action="store", type="string", help="Use an alternate statedir", default=".")
     command_line_parser.add_option("--ip", action="store", type="string", default="0.0.0.0", help="Dispersy uses this ip")
     command_line_parser.add_option("--port", action="store", type="int", help="Dispersy uses this UDL port", default=6421)
+    command_line_parser.add_option("--workers", action="store", type="int", help="Shard the communities over WORKERS processes, each with its own database in STATEDIR/worker-N", default=0)
 
     # parse command-line arguments
     opt, _ = command_line_parser.parse_args()
     print "Press Ctrl-C to stop Dispersy"
 
+    if opt.workers > 0:
+        main_sharded(opt)
+        return
+
     # start Dispersy
     dispersy = TrackerDispersy.get_instance(Callback(), unicode(opt.statedir), opt.port)
     dispersy.endpoint = StandaloneEndpoint(dispersy, opt.port, opt.ip)
@@ -251,5 +258,64 @@ def main():
     dispersy.callback.loop()
     dispersy.endpoint.stop()
 
+def main_worker(connection, inherited, statedir, port, address):
+    """
+    Run one TrackerDispersy worker process.  All traffic goes through the ShardRouter in the
+    front-end process.
+
+    INHERITED contains the pipe ends of the other workers that were copied into this process when
+    it was forked.  They are closed, otherwise the ShardRouter would not notice when the other
+    workers stop.
+    """
+    for other in inherited:
+        other.close()
+
+    # the front-end handles Ctrl-C and closes our connection
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    dispersy = TrackerDispersy.get_instance(Callback(), unicode(statedir), port)
+    dispersy.endpoint = ShardEndpoint(dispersy, connection, address)
+    dispersy.endpoint.start()
+    dispersy.define_auto_load(TrackerCommunity)
+
+    # wait until the front-end stops
+    dispersy.callback.loop()
+    dispersy.endpoint.stop()
+
+def main_sharded(opt):
+    """
+    Run the front-end process.  It owns the UDP socket and routes packets, by community id, to
+    OPT.WORKERS worker processes.  Each worker owns a subset of the communities and its own
+    database.
+    """
+    pipes = [Pipe() for _ in xrange(opt.workers)]
+    router = ShardRouter([front for front, _ in pipes], opt.port, opt.ip)
+    address = router.get_address()
+
+    workers = []
+    for index, (_, back) in enumerate(pipes):
+        statedir = os.path.join(opt.statedir, "worker-%d" % index)
+        if not os.path.isdir(statedir):
+            os.makedirs(statedir)
+        inherited = [other for pipe in pipes for other in pipe if not other is back]
+        worker = Process(name="worker-%d" % index, target=main_worker, args=(back, inherited, statedir, address[1], address))
+        worker.start()
+        workers.append(worker)
+        # only the worker uses this end, closing it ensures that the router notices when the worker
+        # stops
+        back.close()
+    router.start()
+
+    def signal_handler(sig, frame):
+        print "Received", sig, "signal in", frame
+        router.stop()
+    signal.signal(signal.SIGINT, signal_handler)
+
+    # wait until all workers stopped
+    for worker in workers:
+        while worker.is_alive():
+            worker.join(1.0)
+    print "BANDWIDTH", router.total_up, router.total_down
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,121 @@
+"""
+Verify the signatures of incoming packets in parallel.
+
+Verifying an EC signature is the most expensive step when decoding an incoming packet.  The
+SignatureVerifier collects the (public key, digest, signature) triples for an entire batch and
+verifies them using a pool of worker processes.  The resulting packets can then be decoded without
+verifying their signatures again.
+"""
+
+from multiprocessing import Pool
+from time import time
+
+from crypto import ec_from_public_bin, ec_signature_length, ec_verify
+
+if __debug__:
+    from dprint import dprint
+
+# each worker process keeps the EC objects for recently used public keys
+_ec_cache = {}
+_ec_cache_length = 1024
+
+def _verify(triple):
+    """
+    Returns True when SIGNATURE is a valid signature for DIGEST made by PUBLIC_KEY.
+
+    This function is called in the worker processes.  The EC objects can not be pickled, hence
+    they are created (and cached) in the worker from the binary public key.
+    """
+    public_key, digest, signature = triple
+    try:
+        ec = _ec_cache[public_key]
+    except KeyError:
+        try:
+            ec = ec_from_public_bin(public_key)
+        except:
+            return False
+        if len(_ec_cache) >= _ec_cache_length:
+            _ec_cache.clear()
+        _ec_cache[public_key] = ec
+
+    return ec_signature_length(ec) == len(signature) and bool(ec_verify(ec, digest, signature))
+
+class SignatureVerifier(object):
+    """
+    Verifies batches of (public_key, digest, signature) triples.
+
+    When PROCESSES is zero the triples are verified on the calling thread, otherwise a pool of
+    PROCESSES worker processes is used.  The pool is created immediately and worker processes are
+    forked from the current process, hence the SignatureVerifier should be created before any
+    threads or database connections are.
+    """
+    def __init__(self, processes=0, chunk_size=16):
+        assert isinstance(processes, int)
+        assert processes >= 0
+        assert isinstance(chunk_size, int)
+        assert chunk_size > 0
+        self._processes = processes
+        self._chunk_size = chunk_size
+        self._pool = Pool(processes) if processes else None
+        self._batch_count = 0
+        self._signature_count = 0
+        self._invalid_count = 0
+        self._duration = 0.0
+
+    @property
+    def processes(self):
+        return self._processes
+
+    def verify(self, triples):
+        """
+        Verify all (public_key, digest, signature) triples in TRIPLES.
+
+        Returns a list containing True or False for each triple.
+        """
+        assert isinstance(triples, list)
+        assert all(isinstance(triple, tuple) and len(triple) == 3 for triple in triples)
+        start = time()
+        if self._pool:
+            results = self._pool.map(_verify, triples, self._chunk_size)
+        else:
+            results = map(_verify, triples)
+
+        self._duration += time() - start
+        self._batch_count += 1
+        self._signature_count += len(triples)
+        self._invalid_count += results.count(False)
+        if __debug__: dprint("verified ", len(triples), " signatures in ", time() - start, " seconds (", results.count(False), " invalid)")
+        return results
+
+    def info(self):
+        """
+        Returns the verification statistics.
+        """
+        return {"processes":self._processes,
+                "batches":self._batch_count,
+                "signatures":self._signature_count,
+                "invalid":self._invalid_count,
+                "duration":self._duration,
+                "signatures_per_second":self._signature_count / self._duration if self._duration else 0.0}
+
+    def reset(self):
+        """
+        Returns, and subsequently removes, the verification statistics.
+        """
+        try:
+            return self.info()
+
+        finally:
+            self._batch_count = 0
+            self._signature_count = 0
+            self._invalid_count = 0
+            self._duration = 0.0
+
+    def close(self):
+        """
+        Stop the worker processes.
+        """
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None